@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+import argparse
+import glob
+import sys
+import time
+
+import morph_kgc
+
+import initiate
+import native_backend
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Materializa reglas YARRRML con morph_kgc y con el backend nativo, "
+                    "comprueba que generan las mismas tripletas y mide las tripletas por segundo de cada uno."
+    )
+    parser.add_argument("rules", nargs="+", help="Archivos YARRRML o patrones glob (p. ej. '../rules/*.yarrrml')")
+    parser.add_argument("--udf", default="udf.py", help="Ruta al archivo de UDFs")
+    args = parser.parse_args()
+
+    mapping_paths = sorted({path for pattern in args.rules for path in glob.glob(pattern)})
+    if not mapping_paths:
+        print("No se encontraron reglas.", file=sys.stderr)
+        sys.exit(2)
+
+    initiate.cache_udf_loading()
+    times = {'morph': 0.0, 'native': 0.0}
+    triples = 0
+    different = 0
+    for mapping_path in mapping_paths:
+        start = time.perf_counter()
+        morph_triples = morph_kgc.materialize_set(initiate.build_materialize_config(args.udf, mapping_path, 1))
+        times['morph'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        native_triples = native_backend.materialize_set(mapping_path, args.udf)
+        times['native'] += time.perf_counter() - start
+
+        # morph_kgc deja un espacio al final de cada tripleta
+        morph_triples = {triple.rstrip() for triple in morph_triples}
+        triples += len(morph_triples)
+        if morph_triples != native_triples:
+            different += 1
+            print(f"{mapping_path}: morph_kgc {len(morph_triples)} tripletas, nativo {len(native_triples)}")
+            for triple in sorted(morph_triples - native_triples)[:3]:
+                print(f"  solo morph_kgc: {triple}")
+            for triple in sorted(native_triples - morph_triples)[:3]:
+                print(f"  solo nativo:    {triple}")
+
+    print(f"{len(mapping_paths)} archivos de reglas, {triples} tripletas")
+    for backend, seconds in times.items():
+        print(f"{backend:>6}: {seconds:.2f} s, {triples / seconds if seconds else 0:,.0f} tripletas/s")
+
+    if different:
+        print(f"{different} archivos generan tripletas diferentes.")
+        sys.exit(1)
+    print("Los dos backends generan las mismas tripletas.")
+    sys.exit(0)
+
+if __name__ == "__main__":
+    main()
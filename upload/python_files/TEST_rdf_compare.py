@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+
+import config
+import rdf_compare
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compara las tripletas de dos archivos RDF (N-Triples, N-Quads o Turtle) sin importar el "
+                    "orden, los prefijos ni el formato, con memoria acotada, y muestra las tripletas añadidas y "
+                    "eliminadas."
+    )
+    parser.add_argument("rdf1", help="Ruta al archivo RDF de referencia")
+    parser.add_argument("rdf2", help="Ruta al archivo RDF a comparar")
+    parser.add_argument("--memory-mb", type=float, default=config.DEDUP_MEMORY_MB,
+                        help="Memoria para ordenar las tripletas, en MB; el resto se ordena en disco")
+    parser.add_argument("--diff", default=None,
+                        help="Archivo donde escribir todas las tripletas eliminadas ('- ') y añadidas ('+ ')")
+    parser.add_argument("--examples", type=int, default=5,
+                        help="Número de tripletas eliminadas y añadidas que se muestran")
+    args = parser.parse_args()
+
+    result = rdf_compare.compare_files(args.rdf1, args.rdf2, args.memory_mb, args.diff, args.examples)
+
+    print(f"{args.rdf1}: {result['left']} tripletas distintas")
+    print(f"{args.rdf2}: {result['right']} tripletas distintas")
+    print(f"En ambos: {result['common']}, eliminadas: {result['removed']}, añadidas: {result['added']}")
+    for side, path in (('left_invalid', args.rdf1), ('right_invalid', args.rdf2)):
+        if result[side]:
+            print(f"Se ignoraron {result[side]} líneas no válidas de {path}", file=sys.stderr)
+    for triple in result['removed_examples']:
+        print(f"- {triple}")
+    for triple in result['added_examples']:
+        print(f"+ {triple}")
+
+    if result['removed'] or result['added']:
+        print("Los grafos son diferentes.")
+        sys.exit(1)
+    else:
+        print("Los grafos son iguales.")
+        sys.exit(0)
+
+if __name__ == "__main__":
+    main()
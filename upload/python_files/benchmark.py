@@ -0,0 +1,298 @@
+import argparse
+import importlib.metadata
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import pandas as pd
+
+import config
+import dataPreprocessing
+import initiate
+import mapping_cache
+import profiling
+import synthetic_cohort
+
+# Stages of the pipeline timed by the benchmark, in the order they run
+STAGES = ['load_data', 'process_data', 'intermediate_io', 'rule_generation', 'materialization', 'serialization',
+          'cache', 'combine']
+
+
+def git_commit():
+    """
+    Returns the commit of the working tree, with a '+dirty' suffix if it has uncommitted changes, or None outside
+    a git repository.
+    """
+
+    folder = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=folder, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=folder,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('+dirty' if status else '')
+
+
+def prepare_main_folder(main_folder):
+    """
+    Creates an empty project folder with the layout that initiate.py expects, and copies the UDF file into it.
+    Returns:
+        str: Path to the UDF file of the project.
+    """
+
+    shutil.rmtree(main_folder, ignore_errors=True)
+    initiate.check_or_create_directories(main_folder)
+    udf_path = os.path.join(main_folder, config.PYTHON_FOLDER, config.UDF_FILENAME)
+    shutil.copyfile(os.path.join(os.path.dirname(os.path.abspath(__file__)), config.UDF_FILENAME), udf_path)
+    return udf_path
+
+
+def add_record(stages, record):
+    """
+    Adds the time of each step of a field record of initiate.py to the stages of the benchmark. The export of the
+    data files is counted as rule generation.
+    """
+
+    for step, seconds in record['seconds'].items():
+        stage = 'rule_generation' if step == 'export' else step
+        stages[stage] = stages.get(stage, 0.0) + seconds
+
+
+def materialize_fields(df, main_folder, stages, output_format, backend, data_format='csv', environment=None):
+    """
+    Materializes the shared mappings and then each valid field of the preprocessed data with the functions of
+    initiate.py in field mode, adding the time of each step to its stage.
+    Returns:
+        tuple: Number of triples and list of fields that failed.
+    """
+
+    record = profiling.new_field_record(0)
+    initiate.materialize_shared((group for _, group in initiate.filter_valid_groups(df)), main_folder,
+                                output_format, data_format, environment, backend=backend, record=record)
+    add_record(stages, record)
+    triples_count = record['triples'] or 0
+    failed_fields = []
+
+    for field_id, group in initiate.filter_valid_groups(df):
+        record = profiling.new_field_record(len(group))
+        try:
+            initiate.materialize_field(field_id, group, main_folder, output_format=output_format,
+                                       intermediate_format=data_format, environment=environment, backend=backend,
+                                       record=record)
+        except RuntimeError as e:
+            print(f"Exiting '{field_id}' due to: {e}", file=sys.stderr)
+            failed_fields.append(field_id)
+        add_record(stages, record)
+        triples_count += record['triples'] or 0
+
+    return triples_count, failed_fields
+
+
+def materialize_catalogue(groups, main_folder, stages, output_format, backend, processes, data_format='csv'):
+    """
+    Materializes every valid field in a single call with initiate.generate_catalogue_and_serialize, as in catalogue
+    mode, adding the time of each step to its stage.
+    Returns:
+        tuple: Number of triples and list of fields that failed.
+    """
+
+    groups = list(groups)
+    if not groups:
+        return 0, []
+    record = profiling.new_field_record(0)
+    initiate.generate_catalogue_and_serialize(groups, main_folder, processes, output_format, data_format, backend,
+                                              record)
+    add_record(stages, record)
+    return record['triples'], []
+
+
+def run_benchmark(mapping_path, cases, fields, work_folder, mode='field', backend='morph', output_format='turtle',
+                  processes=None, missing_rate=0.1, seed=0, in_memory=False, cache_max_mb=0):
+    """
+    Generates a synthetic cohort and runs the whole pipeline on it, timing each stage separately.
+    Args:
+        mapping_path (str): Path to the CSV mapping file.
+        cases (int): Number of cases of the cohort.
+        fields (int, optional): Number of fields of the cohort, None for every field of the mappings file.
+        work_folder (str): Folder where the cohort and the project folder of the run are written.
+        mode (str): 'field' or 'catalogue', as in initiate.py.
+        backend (str): 'morph' or 'native', as in initiate.py.
+        output_format (str): 'turtle' or 'ntriples'.
+        processes (int, optional): Number of morph_kgc processes in catalogue mode.
+        missing_rate (float): Fraction of empty values of each field.
+        seed (int): Seed of the cohort.
+        in_memory (bool): Hand the data of each field to the backend in memory, as initiate.py --in-memory.
+        cache_max_mb (float): Size cap of the build cache of the run, 0 to disable it. The project folder is new,
+            so every field is a miss and the cost of storing it is measured.
+    Returns:
+        dict: Settings of the run, sizes of the data and of the output, and seconds spent in each stage.
+    """
+
+    stages = dict.fromkeys(STAGES, 0.0)
+    main_folder = os.path.join(work_folder, 'project')
+    prepare_main_folder(main_folder)
+
+    start = time.perf_counter()
+    data_path, cohort_mapping_path = synthetic_cohort.main(mapping_path, os.path.join(work_folder, 'cohort'), cases,
+                                                           fields, missing_rate, seed)
+    cohort_seconds = time.perf_counter() - start
+
+    run_start = time.perf_counter()
+    with profiling.timed(stages, 'load_data'):
+        mapping_df = dataPreprocessing.clean_data(pd.read_csv(cohort_mapping_path, encoding='utf-8-sig'))
+        data_df = dataPreprocessing.read_data_file(data_path, mapping_df)
+    with profiling.timed(stages, 'process_data'):
+        result_df = dataPreprocessing.process_data(data_df, mapping_df)
+    with profiling.timed(stages, 'intermediate_io'):
+        preprocessed_path = os.path.join(main_folder, config.PREPROCESSED_FOLDER, config.PREPROCESSED_FILENAME)
+        result_df.to_csv(preprocessed_path, index=False, encoding='utf-8-sig')
+        df = initiate.load_preprocessed_csv(main_folder)
+
+    initiate.cache_udf_loading()
+    data_format = 'memory' if in_memory else 'csv'
+    if mode == 'catalogue':
+        triples, failed_fields = materialize_catalogue(initiate.filter_valid_groups(df), main_folder, stages,
+                                                       output_format, backend, processes, data_format)
+    else:
+        environment = None
+        if cache_max_mb > 0:
+            environment = initiate.cache_environment(main_folder, output_format, backend)
+            if backend == 'morph':
+                mapping_cache.install(os.path.join(main_folder, config.CACHE_FOLDER))
+        triples, failed_fields = materialize_fields(df, main_folder, stages, output_format, backend, data_format,
+                                                    environment)
+
+    instances_folder = os.path.join(main_folder, config.INSTANCES_FOLDER)
+    with profiling.timed(stages, 'combine'):
+        if output_format == 'ntriples':
+            output_path = os.path.join(main_folder, config.FINAL_NT_OUTPUT_FILENAME)
+            initiate.combine_nt_files(instances_folder, output_path, config.DEDUP_MEMORY_MB)
+        else:
+            output_path = os.path.join(main_folder, config.FINAL_OUTPUT_FILENAME)
+            initiate.combine_ttl_files(instances_folder, output_path)
+    total_seconds = time.perf_counter() - run_start
+
+    return {
+        'cases': cases,
+        'fields': int(mapping_df['field_id'].nunique()),
+        'mode': mode,
+        'backend': backend,
+        'output_format': output_format,
+        'in_memory': in_memory,
+        'preprocessed_rows': len(result_df),
+        'triples': triples,
+        'output_bytes': os.path.getsize(output_path),
+        'failed_fields': failed_fields,
+        'cohort_seconds': round(cohort_seconds, 3),
+        'stages': {stage: round(seconds, 3) for stage, seconds in stages.items()},
+        'total_seconds': round(total_seconds, 3),
+        'triples_per_second': round(triples / total_seconds, 1) if total_seconds else None,
+        'peak_rss_mb': round(initiate.peak_rss_mb(), 1),
+    }
+
+
+def run_key(run):
+    return run['cases'], run['fields'], run['mode'], run['backend'], run['output_format'], run.get('in_memory', False)
+
+
+def format_comparison(baseline, results):
+    """
+    Returns a table with the seconds of each stage in a baseline result file and in the current results, for the
+    runs that have the same settings in both.
+    """
+
+    baseline_runs = {run_key(run): run for run in baseline['runs']}
+    lines = [f"Baseline {baseline.get('commit')} ({baseline.get('date')}) -> {results.get('commit')}"]
+    for run in results['runs']:
+        old = baseline_runs.get(run_key(run))
+        if old is None:
+            continue
+        lines.append(f"{run['cases']} cases, {run['fields']} fields, {run['mode']}, {run['backend']}, "
+                     f"{run['output_format']}")
+        for stage in STAGES + ['total']:
+            old_seconds = old['total_seconds'] if stage == 'total' else old['stages'].get(stage, 0.0)
+            new_seconds = run['total_seconds'] if stage == 'total' else run['stages'][stage]
+            speedup = f"{old_seconds / new_seconds:.2f}x" if new_seconds else '-'
+            lines.append(f"  {stage:<16} {old_seconds:>10.3f} {new_seconds:>10.3f} {speedup:>8}")
+    return '\n'.join(lines)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Time each stage of the pipeline on synthetic cohorts')
+    parser.add_argument('--mappings', type=str, default=os.path.join('..', 'input_data', 'mappings.csv'),
+                        help='Path to the CSV mapping file used to generate the cohorts')
+    parser.add_argument('--cases', type=int, nargs='+', default=[1000],
+                        help='Numbers of cases of the cohorts, e.g. 1000 10000 100000 1000000')
+    parser.add_argument('--fields', type=int, nargs='+', default=[None],
+                        help='Numbers of fields of the cohorts, repeating the fields of the mappings file when it '
+                             'has fewer. Defaults to every field of the mappings file')
+    parser.add_argument('--mode', choices=['field', 'catalogue'], default='field',
+                        help='Materialize each field separately, or every field in a single call')
+    parser.add_argument('--backend', choices=config.BACKENDS, default='morph',
+                        help='Materialize the rules with morph_kgc or with the native backend')
+    parser.add_argument('--output-format', choices=sorted(config.OUTPUT_EXTENSIONS), default='turtle',
+                        help='Format of the instance files and of the combined output')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help='Number of morph_kgc processes used in catalogue mode')
+    parser.add_argument('--in-memory', action='store_true',
+                        help='Hand the data of each field to the backend in memory, as initiate.py --in-memory')
+    parser.add_argument('--cache-max-mb', type=float, default=0,
+                        help='Size cap of the build cache in field mode, to measure the cost of filling it. Disabled '
+                             'by default')
+    parser.add_argument('--missing-rate', type=float, default=0.1, help='Fraction of empty values of each field')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the cohorts')
+    parser.add_argument('--work-folder', type=str, default=None,
+                        help='Folder for the cohorts and the outputs, kept after the run. Defaults to a temporary '
+                             'folder that is removed')
+    parser.add_argument('--output', type=str, default='benchmark_results.json', help='JSON file with the results')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='JSON results of an earlier run, e.g. from another commit, to compare against')
+    args = parser.parse_args()
+
+    work_folder = args.work_folder or tempfile.mkdtemp(prefix='benchmark_')
+    results = {
+        'commit': git_commit(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'morph_kgc': importlib.metadata.version('morph_kgc'),
+        'pandas': pd.__version__,
+        'cpu_count': os.cpu_count(),
+        'runs': [],
+    }
+
+    try:
+        for fields in args.fields:
+            for cases in args.cases:
+                run = run_benchmark(args.mappings, cases, fields, work_folder, args.mode, args.backend,
+                                    args.output_format, args.processes, args.missing_rate, args.seed, args.in_memory,
+                                    args.cache_max_mb)
+                results['runs'].append(run)
+                stages = ', '.join(f"{stage} {seconds:.2f}s" for stage, seconds in run['stages'].items())
+                print(f"{run['cases']} cases, {run['fields']} fields: {run['triples']} triples in "
+                      f"{run['total_seconds']:.2f}s ({stages})")
+                # Saved after every run, so that a long benchmark that is interrupted keeps its results
+                with open(args.output, 'w', encoding='utf-8') as output_file:
+                    json.dump(results, output_file, indent=2)
+    except (FileNotFoundError, KeyError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        if args.work_folder is None:
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as baseline_file:
+            print(format_comparison(json.load(baseline_file), results))
+
+
+if __name__ == '__main__':
+    main()
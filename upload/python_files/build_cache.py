@@ -0,0 +1,113 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+import pandas as pd
+
+
+def hash_files(paths):
+    """
+    Returns the SHA-256 of the contents of several files, in the given order.
+    """
+
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as input_file:
+            digest.update(hashlib.sha256(input_file.read()).digest())
+    return digest.hexdigest()
+
+
+def hash_group(group):
+    """
+    Returns a hash of the content of a DataFrame: column names, dtypes and values, ignoring the index.
+    """
+
+    digest = hashlib.sha256()
+    digest.update(repr(list(zip(group.columns, map(str, group.dtypes)))).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(group, index=False).values.tobytes())
+    return digest.hexdigest()
+
+
+def build_key(*parts):
+    """
+    Combines the given strings into a cache key.
+    """
+
+    return hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest()
+
+
+def lookup(cache_folder, key, targets):
+    """
+    Copies the files of a cache entry to their target paths, and marks the entry as recently used.
+    Args:
+        cache_folder (str): Folder of the cache.
+        key (str): Key of the entry.
+        targets (list): Paths where the files of the entry are restored, matched by file name.
+    Returns:
+        bool: True if the entry exists and every file was restored.
+    """
+
+    entry = os.path.join(cache_folder, key)
+    sources = [os.path.join(entry, os.path.basename(target)) for target in targets]
+    if not all(os.path.isfile(source) for source in sources):
+        return False
+
+    for source, target in zip(sources, targets):
+        shutil.copyfile(source, target)
+    os.utime(entry)
+    return True
+
+
+def store(cache_folder, key, sources):
+    """
+    Saves copies of some files as a cache entry. The entry is written to a temporary folder and then renamed,
+    so concurrent workers never see half written entries.
+    """
+
+    entry = os.path.join(cache_folder, key)
+    if os.path.isdir(entry):
+        shutil.rmtree(entry, ignore_errors=True)
+
+    os.makedirs(cache_folder, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix='.staging_', dir=cache_folder)
+    try:
+        for source in sources:
+            shutil.copyfile(source, os.path.join(staging, os.path.basename(source)))
+        os.rename(staging, entry)
+    except OSError:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+def entry_size(entry):
+    return sum(os.path.getsize(os.path.join(entry, filename)) for filename in os.listdir(entry))
+
+
+def evict(cache_folder, max_mb):
+    """
+    Removes the least recently used entries until the cache takes at most max_mb.
+    Args:
+        cache_folder (str): Folder of the cache.
+        max_mb (float): Size cap of the cache, in MB.
+    Returns:
+        tuple: Number of entries removed and size of the cache afterwards, in bytes.
+    """
+
+    if not os.path.isdir(cache_folder):
+        return 0, 0
+
+    entries = []
+    for name in os.listdir(cache_folder):
+        entry = os.path.join(cache_folder, name)
+        if os.path.isdir(entry) and not name.startswith('.staging_'):
+            entries.append((os.path.getmtime(entry), entry_size(entry), entry))
+
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, entry in sorted(entries):
+        if total <= max_mb * 1024 * 1024:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+        removed += 1
+    return removed, total
@@ -6,13 +6,58 @@ REQUIRED_MAPPING_COLS = {
     'categorical_ontology_mapping', 'procedure_result'
 }
 REQUIRED_DATA_COLS = {'case_id'}
+# Value types whose values are passed through as the text of the data file, read as categorical columns with
+# --text-categories
+TEXT_VALUE_TYPES = {'Boolean', 'Categorical', 'String', 'Date', 'DateTime'}
+# Parsers of the data file, pyarrow is faster on large files but cannot read it in chunks
+CSV_ENGINES = ['c', 'pyarrow']
 
 # Initiate.py constants
 PREPROCESSED_FOLDER = 'preprocessed_data'
 PREPROCESSED_FILENAME = 'preprocessed_data.csv'
+PREPROCESSED_PARQUET_FILENAME = 'preprocessed_data.parquet'
+# Compiled mapping index of dataPreprocessing.py, kept next to the preprocessed data
+MAPPING_INDEX_FILENAME = 'mapping_index.pkl'
 CSV_FOLDER = 'csv'
 RULES_FOLDER = 'rules'
 PYTHON_FOLDER = 'python_files'
 UDF_FILENAME = 'udf.py'
 INSTANCES_FOLDER = 'instances'
-FINAL_OUTPUT_FILENAME = 'output_RDF_Guttman.ttl'
\ No newline at end of file
+FINAL_OUTPUT_FILENAME = 'output_RDF_Guttman.ttl'
+FINAL_NT_OUTPUT_FILENAME = 'output_RDF_Guttman.nt'
+EMITTED_CASES_FILENAME = 'output_RDF_Guttman.cases'
+# Reference rows of the cases of the incremental runs, which the rules of the next runs are generated from
+REFERENCE_ROWS_FILENAME = 'output_RDF_Guttman.reference.csv'
+CATALOGUE_NAME = '_catalogue'
+# Name of the rules and instance files of the mappings shared by every field
+SHARED_NAME = '_shared'
+CACHE_FOLDER = 'cache'
+# Folder with the data, rules, instances and output of each shard of a run, see sharding.py
+SHARDS_FOLDER = 'shards'
+# Work folder of rdf_daemon.py
+DAEMON_FOLDER = 'daemon'
+
+# File extension of the per-field instance files for each output format
+OUTPUT_EXTENSIONS = {'turtle': '.ttl', 'ntriples': '.nt'}
+
+# Formats of the preprocessed data and of the per-field data files read by morph_kgc
+INTERMEDIATE_FORMATS = ['csv', 'parquet']
+
+# Engines that materialize the generated rules: morph_kgc, or native_backend.py for the rules of generateRules
+BACKENDS = ['morph', 'native']
+
+# Memory budget, in MB, for removing duplicate triples when combining N-Triples files
+DEDUP_MEMORY_MB = 512
+
+# Size cap, in MB, of the cache of rules and instance files of unchanged fields
+CACHE_MAX_MB = 1024
+
+# Fields waiting between two stages of initiate.py --pipeline, which caps the triples held in memory
+PIPELINE_QUEUE_SIZE = 2
+
+# Number of results kept per UDF by initiate.py --udf-cache
+UDF_CACHE_SIZE = 4096
+
+# Port of rdf_daemon.py, and number of recent requests of each endpoint its latency percentiles cover
+DAEMON_PORT = 8765
+DAEMON_LATENCY_WINDOW = 10000
@@ -1,8 +1,16 @@
+import numpy as np
 import pandas as pd
 import argparse
+import build_cache
 import config
+import io
+import profiling
+import sharding
 import os
+import pickle
+import shutil
 import sys
+import uuid
 
 ### SETUP FUNCTIONS ###
 
@@ -15,12 +23,10 @@ def clean_data(df):
         pd.DataFrame: The cleaned DataFrame with stripped whitespace in specified columns.
     """
 
-    if 'field_id' in df.columns:
-        df['field_id'] = df['field_id'].str.strip()
-    if 'categorical_value' in df.columns:
-        df['categorical_value'] = df['categorical_value'].str.strip()
-    if 'procedure_result' in df.columns:
-        df['procedure_result'] = df['procedure_result'].str.strip()
+    # A column without any value is read as float, and has nothing to strip
+    for column in ('field_id', 'categorical_value', 'procedure_result'):
+        if column in df.columns and df[column].dtype == object:
+            df[column] = df[column].str.strip()
     return df
 
 
@@ -44,6 +50,59 @@ def validate_inputs(data_df: pd.DataFrame, mapping_df: pd.DataFrame):
         raise KeyError(f"The following columns are missing in the mappings file: {missing_map}")
 
 
+def get_data_schema(mapping_df, columns, text_categories=False):
+    """
+    Chooses the columns of the data file that are read, and their dtypes, from the mappings. Only the required
+    columns and the mapped fields are read, and every column keeps the dtype pandas infers. With text_categories,
+    the fields whose values are passed through as text (see config.TEXT_VALUE_TYPES) are read as categorical
+    columns holding the text of the file, which takes far less memory than object columns for the few distinct
+    values of a clinical field, but makes the C parser about twice slower. Their values are then the text of the
+    file, where pandas would turn TRUE/FALSE into booleans and drop the leading zeros of numeric-looking text.
+    Numeric fields always keep the dtype pandas infers, which get_field_value relies on.
+    Args:
+        mapping_df (pd.DataFrame): The DataFrame containing the mapping information.
+        columns (list): The columns of the data file, in order.
+        text_categories (bool): Read the text fields as categorical columns.
+    Returns:
+        tuple: The columns to read, and the dtype of each text field.
+    """
+
+    fields = set(mapping_df['field_id'])
+    usecols = [column for column in columns if column in config.REQUIRED_DATA_COLS or column in fields]
+
+    dtypes = {}
+    if not text_categories:
+        return usecols, dtypes
+    for field, field_df in mapping_df[mapping_df['field_id'].isin(usecols)].groupby('field_id', sort=False):
+        value_types = set(field_df['value_type'].dropna().astype(str).str.strip())
+        # Categorical values that are not text can only match values of a numeric column
+        text_values = field_df['categorical_value'].dropna().map(lambda value: isinstance(value, str)).all()
+        if value_types and value_types <= config.TEXT_VALUE_TYPES and text_values \
+                and field not in config.REQUIRED_DATA_COLS:
+            dtypes[field] = 'category'
+    return usecols, dtypes
+
+
+def read_data_file(source, mapping_df, csv_engine='c', text_categories=False):
+    """
+    Reads the columns of the data file that the mappings use, with the dtypes chosen by get_data_schema.
+    Args:
+        source (str or bytes): Path to the CSV data file, or its content.
+        mapping_df (pd.DataFrame): The DataFrame containing the mapping information.
+        csv_engine (str): Parser of pandas.read_csv, 'c' or 'pyarrow'.
+        text_categories (bool): Read the text fields as categorical columns, see get_data_schema.
+    Returns:
+        pd.DataFrame: The data rows.
+    """
+
+    def open_source():
+        return io.BytesIO(source) if isinstance(source, bytes) else source
+
+    header_df = pd.read_csv(open_source(), encoding='utf-8-sig', nrows=0)
+    usecols, dtypes = get_data_schema(mapping_df, header_df.columns, text_categories)
+    return pd.read_csv(open_source(), encoding='utf-8-sig', usecols=usecols, dtype=dtypes, engine=csv_engine)
+
+
 def build_mapping_indices(mapping_df):
     """
     Builds two structures by analyzing the mapping DataFrame:
@@ -57,10 +116,9 @@ def build_mapping_indices(mapping_df):
     mapping_by_field = {}
     proc_result_index = {}
 
-    for _, row in mapping_df.iterrows():
+    for row_dict in mapping_df.to_dict('records'):
         # Process the mapping by field
-        field = row['field_id']
-        row_dict = row.to_dict()
+        field = row_dict['field_id']
         mapping_by_field.setdefault(field, []).append(row_dict)
 
         # Process the procedure result index
@@ -71,6 +129,106 @@ def build_mapping_indices(mapping_df):
     
     return mapping_by_field, proc_result_index
 
+
+def build_categorical_dispatch(mapping_by_field):
+    """
+    Indexes the mapping rows of each field by their categorical value, so that the rows matching a raw value are
+    found with one lookup instead of comparing the value with every categorical row of the field. Rows without a
+    categorical value match every raw value.
+    Args:
+        mapping_by_field (dict): Mapping rows of each field, as returned by build_mapping_indices.
+    Returns:
+        dict: For each field, the rows matching any raw value, and a dict from each categorical value to the rows
+        matching it, both in the order of the mappings file.
+    """
+
+    dispatch = {}
+    for field, map_rows in mapping_by_field.items():
+        plain_rows = [map_row for map_row in map_rows if pd.isna(map_row.get('categorical_value'))]
+        categorical_values = dict.fromkeys(map_row['categorical_value'] for map_row in map_rows
+                                           if pd.notna(map_row.get('categorical_value')))
+        rows_by_value = {value: [map_row for map_row in map_rows
+                                 if pd.isna(map_row.get('categorical_value'))
+                                 or map_row['categorical_value'] == value]
+                         for value in categorical_values}
+        dispatch[field] = (plain_rows, rows_by_value)
+    return dispatch
+
+
+def compile_mapping_indices(mapping_df):
+    """
+    Builds every index of the mapping rows that the preprocessing uses.
+    Returns:
+        tuple: mapping_by_field and proc_result_index, as returned by build_mapping_indices, and the categorical
+        dispatch of build_categorical_dispatch.
+    """
+
+    mapping_by_field, proc_result_index = build_mapping_indices(mapping_df)
+    return mapping_by_field, proc_result_index, build_categorical_dispatch(mapping_by_field)
+
+
+def mapping_index_key(path_csv_mapping):
+    """
+    Returns the key of the compiled mapping index of a mappings file: a hash of the file, of this module, which
+    cleans the mappings and builds the index, of config.py and the required mapping columns, and the versions of
+    pandas and numpy, whose objects the pickled index holds.
+    """
+
+    return build_cache.build_key(
+        build_cache.hash_files([path_csv_mapping, os.path.abspath(__file__), os.path.abspath(config.__file__)]),
+        *sorted(config.REQUIRED_MAPPING_COLS), f"pandas={pd.__version__}", f"numpy={np.__version__}")
+
+
+def load_mapping_index(path_csv_mapping, mapping_df, index_path):
+    """
+    Returns the mapping indices of every field of a mappings file. They are read from index_path when it was
+    compiled from the same file, or else built from mapping_df and saved to index_path, so that repeated runs and
+    every shard of a run load them instead of building them again.
+    Args:
+        path_csv_mapping (str): Path to the CSV mapping file.
+        mapping_df (pd.DataFrame): The cleaned mappings of that file.
+        index_path (str): File of the compiled index.
+    Returns:
+        tuple: mapping_by_field, proc_result_index and the categorical dispatch, as returned by
+        compile_mapping_indices.
+    """
+
+    key = mapping_index_key(path_csv_mapping)
+    try:
+        with open(index_path, 'rb') as index_file:
+            index_key, indices = pickle.load(index_file)
+        if index_key == key:
+            return indices
+    except Exception:
+        # A missing index, or one written by other versions of pandas
+        pass
+
+    indices = compile_mapping_indices(mapping_df)
+    try:
+        # Written to a file of its own first, as several shards can compile the index at the same time. Unlike
+        # tempfile.mkstemp, open gives it the permissions of the other outputs.
+        staging_path = f"{index_path}.{uuid.uuid4().hex}.tmp"
+        with open(staging_path, 'xb') as index_file:
+            pickle.dump((key, indices), index_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(staging_path, index_path)
+    except OSError as e:
+        print(f"The mapping index could not be saved: {e}")
+    return indices
+
+
+def select_mapping_indices(indices, columns):
+    """
+    Keeps the mapping indices of the fields that are columns of the data, which are the indices that
+    compile_mapping_indices returns for the mapping rows of those fields.
+    """
+
+    mapping_by_field, proc_result_index, dispatch = indices
+    columns = set(columns)
+    return ({field: map_rows for field, map_rows in mapping_by_field.items() if field in columns},
+            {field: index for field, index in proc_result_index.items() if field in columns},
+            {field: field_dispatch for field, field_dispatch in dispatch.items() if field in columns})
+
+
 def get_field_value(data_row, map_row):
     """
     Obtains the value of a field from a data row based on the mapping row.
@@ -132,43 +290,33 @@ def get_procedure_result(data_row, map_row, proc_result_index):
 ### PROCESSING FUNCTIONS ###
 
 
-def process_data(data_df, mapping_df):
+def process_rows(data_df, mapping_by_field, proc_result_index, keep_value_types=False, dispatch=None):
     """
-    Processes the data DataFrame using the mapping DataFrame to generate a new DataFrame with the processed results.
+    Row by row engine: builds the result rows iterating over every data row, field and mapping row.
     Args:
         data_df (pd.DataFrame): The DataFrame containing the data to be processed.
-        mapping_df (pd.DataFrame): The DataFrame containing the mapping information.
+        mapping_by_field (dict): Mapping rows of each field, as returned by build_mapping_indices.
+        proc_result_index (dict): The index mapping procedure results to their URIs.
+        keep_value_types (bool): Keep field_value as an object column, instead of letting pandas infer its dtype.
+        dispatch (dict, optional): The categorical dispatch of the fields, as returned by build_categorical_dispatch.
+            It is built from mapping_by_field when not given.
     Returns:
         pd.DataFrame: A new DataFrame containing the processed results.
     """
-    
-    # 1. Validates that the necessary columns are present in the data and mapping DataFrames.
-    validate_inputs(data_df, mapping_df)
-
-    # 2. Selects only the fields that are present in the data file
-    filtered_mapping_df = mapping_df[mapping_df['field_id'].isin(data_df.columns)]
-
-    # 3. Builds the mapping indexes
-    mapping_by_field, proc_result_index = build_mapping_indices(filtered_mapping_df)
 
     results = []
+    if dispatch is None:
+        dispatch = build_categorical_dispatch(mapping_by_field)
 
-    # 4. Build the result row using data from the indexes that were built before
     for _, data_row in data_df.iterrows():
         case_id = data_row[config.CASE_ID_COLUMN]
 
-        for field_id, map_rows in mapping_by_field.items():
+        for field_id in mapping_by_field:
             raw_value = data_row[field_id]
-            
-            # Checks the correct mapping row based on the value
-            for map_row in map_rows:
-                categorical_value = map_row.get('categorical_value')
-
-                # If the row is categorical, we have to find the correct one
-                # Otherwise, we can process it directly
-                if pd.notna(categorical_value) and raw_value != categorical_value:
-                    continue
+            plain_rows, rows_by_value = dispatch[field_id]
 
+            # Only the categorical rows of the raw value apply, besides the rows that are not categorical
+            for map_row in rows_by_value.get(raw_value, plain_rows):
                 value = get_field_value(data_row, map_row)
                 # If the value is None it means that the field is not valid or not present, and the row should be skipped
                 if value is None:
@@ -184,11 +332,475 @@ def process_data(data_df, mapping_df):
 
                 results.append(result_row)
 
-    return pd.DataFrame(results)
+    result_df = pd.DataFrame(results)
+    if keep_value_types and results:
+        result_df['field_value'] = pd.Series([row['field_value'] for row in results], dtype=object)
+    return result_df
+
+
+def get_field_values(raw_values, dtype):
+    """
+    Columnar version of get_field_value: processes all the values of a field at once.
+    Args:
+        raw_values (np.ndarray): Object array with the raw values of the field.
+        dtype (str): The value_type of the mapping row.
+    Returns:
+        tuple: Object array with the processed values, and a boolean mask of the valid ones.
+    """
+
+    if dtype == 'Boolean':
+        return raw_values, pd.notna(raw_values)
+
+    if dtype == 'Integer':
+        valid = pd.notna(raw_values)
+        # int() is only called once for each distinct value
+        distinct_values = pd.Index(pd.unique(raw_values[valid]), dtype=object)
+        converted = np.empty(len(distinct_values), dtype=object)
+        for i, raw_value in enumerate(distinct_values):
+            try:
+                converted[i] = int(raw_value)
+            except ValueError:
+                converted[i] = None
+        values = np.full(len(raw_values), None, dtype=object)
+        values[valid] = converted[distinct_values.get_indexer(raw_values[valid])]
+        return values, valid & pd.notna(values)
+
+    return raw_values, np.ones(len(raw_values), dtype=bool)
+
+
+def get_procedure_results(data_df, proc_field, proc_result_index, cache):
+    """
+    Columnar version of get_procedure_result: obtains the procedure result URI of every data row.
+    Args:
+        data_df (pd.DataFrame): The DataFrame containing the data to be processed.
+        proc_field: The procedure_result field of the mapping row.
+        proc_result_index (dict): The index mapping procedure results to their URIs.
+        cache (dict): Results already computed for other mapping rows, by procedure field.
+    Returns:
+        np.ndarray: Object array with the URI of each data row, or None.
+    """
+
+    if pd.isna(proc_field) or proc_field not in data_df.columns or proc_field not in proc_result_index:
+        return np.full(len(data_df), None, dtype=object)
+
+    if proc_field not in cache:
+        uris = data_df[proc_field].map(proc_result_index[proc_field]).to_numpy(dtype=object)
+        cache[proc_field] = np.where(pd.notna(uris), uris, None)
+    return cache[proc_field]
+
 
+def process_columnar(data_df, mapping_by_field, proc_result_index, keep_value_types=False):
+    """
+    Columnar engine: gives the same result as process_rows using pandas/NumPy operations over whole columns.
+    Categorical mapping rows are hash-joined on (field_id, categorical_value), and the values of each field
+    are coerced in bulk. The matches are finally sorted in the order the row by row engine produces them.
+    Args:
+        data_df (pd.DataFrame): The DataFrame containing the data to be processed.
+        mapping_by_field (dict): Mapping rows of each field, as returned by build_mapping_indices.
+        proc_result_index (dict): The index mapping procedure results to their URIs.
+        keep_value_types (bool): Keep field_value as an object column, instead of letting pandas infer its dtype.
+    Returns:
+        pd.DataFrame: A new DataFrame containing the processed results.
+    """
 
+    map_rows = [map_row for rows in mapping_by_field.values() for map_row in rows]
+    case_ids = data_df[config.CASE_ID_COLUMN].to_numpy(dtype=object)
+    proc_results_cache = {}
+
+    case_pos_parts, map_pos_parts, value_parts, proc_parts = [], [], [], []
+
+    def add_matches(case_pos, map_pos, raw_values, map_row):
+        values, valid = get_field_values(raw_values, map_row['value_type'])
+        proc_results = get_procedure_results(data_df, map_row.get('procedure_result'),
+                                             proc_result_index, proc_results_cache)
+        case_pos_parts.append(case_pos[valid])
+        map_pos_parts.append(np.full(valid.sum(), map_pos))
+        value_parts.append(values[valid])
+        proc_parts.append(proc_results[case_pos[valid]])
+
+    all_cases = np.arange(len(data_df))
+    map_pos = 0
+    for field_id, rows in mapping_by_field.items():
+        column = data_df[field_id]
+        raw_values = column.to_numpy(dtype=object)
+
+        categorical = [pd.notna(map_row.get('categorical_value')) for map_row in rows]
+        if any(categorical):
+            # Hash join between the raw values and the categorical values of the field
+            categorical_values = pd.Index(pd.unique(np.array(
+                [map_row['categorical_value'] for map_row, is_cat in zip(rows, categorical) if is_cat],
+                dtype=object)), dtype=object)
+            if isinstance(column.dtype, pd.CategoricalDtype):
+                # Only the distinct values of a categorical column are joined
+                category_codes = np.append(categorical_values.get_indexer(column.cat.categories), -1)
+                codes = category_codes[column.cat.codes.to_numpy()]
+            else:
+                codes = categorical_values.get_indexer(raw_values)
+
+        for map_row, is_cat in zip(rows, categorical):
+            if is_cat:
+                code = categorical_values.get_loc(map_row['categorical_value'])
+                case_pos = np.flatnonzero(codes == code)
+            else:
+                case_pos = all_cases
+            add_matches(case_pos, map_pos, raw_values[case_pos], map_row)
+            map_pos += 1
+
+    if not map_rows or not sum(len(part) for part in case_pos_parts):
+        return pd.DataFrame([])
+
+    case_pos = np.concatenate(case_pos_parts)
+    map_pos = np.concatenate(map_pos_parts)
+    order = np.lexsort((map_pos, case_pos))
+    case_pos, map_pos = case_pos[order], map_pos[order]
+
+    # Same columns, in the same order, as the dictionaries built by process_rows
+    columns = {}
+    for column in map_rows[0]:
+        columns[column] = np.array([map_row[column] for map_row in map_rows], dtype=object)[map_pos]
+    columns['case_id'] = case_ids[case_pos]
+    columns['field_value'] = np.concatenate(value_parts)[order]
+    columns['procedure_result'] = np.concatenate(proc_parts)[order]
+
+    # Building the DataFrame from lists applies the same type inference as building it from dictionaries
+    return pd.DataFrame({column: values if keep_value_types and column == 'field_value' else values.tolist()
+                         for column, values in columns.items()})
+
+
+def process_data(data_df, mapping_df, engine='columnar', report=None, indices=None):
+    """
+    Processes the data DataFrame using the mapping DataFrame to generate a new DataFrame with the processed results.
+    Args:
+        data_df (pd.DataFrame): The DataFrame containing the data to be processed.
+        mapping_df (pd.DataFrame): The DataFrame containing the mapping information.
+        engine (str): 'columnar' to process whole columns at once, or 'rows' to iterate over every data row.
+        report (dict, optional): Profiling report where the time of each phase is recorded.
+        indices (tuple, optional): The mapping indices of every field, as returned by load_mapping_index. They are
+            built from mapping_df when not given.
+    Returns:
+        pd.DataFrame: A new DataFrame containing the processed results.
+    """
+    
+    # 1. Validates that the necessary columns are present in the data and mapping DataFrames.
+    with profiling.stage(report, 'validate'):
+        validate_inputs(data_df, mapping_df)
+
+    with profiling.stage(report, 'build_indices'):
+        # 2. Selects only the fields that are present in the data file
+        if indices is not None:
+            mapping_by_field, proc_result_index, dispatch = select_mapping_indices(indices, data_df.columns)
+        else:
+            filtered_mapping_df = mapping_df[mapping_df['field_id'].isin(data_df.columns)]
 
-def main(path_csv_data, path_csv_mapping, output_path):
+            # 3. Builds the mapping indexes
+            mapping_by_field, proc_result_index, dispatch = compile_mapping_indices(filtered_mapping_df)
+
+    # 4. Build the result rows using data from the indexes that were built before
+    with profiling.stage(report, 'process') as entry:
+        result_df = process_with_indices(data_df, mapping_by_field, proc_result_index, engine, dispatch=dispatch)
+        entry['rows'] = len(result_df)
+    return result_df
+
+
+def process_with_indices(data_df, mapping_by_field, proc_result_index, engine='columnar', keep_value_types=False,
+                         dispatch=None):
+    """
+    Processes the data DataFrame with mapping indices that were already built by compile_mapping_indices.
+    Args:
+        data_df (pd.DataFrame): The DataFrame containing the data to be processed.
+        mapping_by_field (dict): Mapping rows of each field.
+        proc_result_index (dict): The index mapping procedure results to their URIs.
+        engine (str): 'columnar' or 'rows'.
+        keep_value_types (bool): Keep field_value as an object column, instead of letting pandas infer its dtype.
+        dispatch (dict, optional): The categorical dispatch of the fields, used by the rows engine.
+    Returns:
+        pd.DataFrame: A new DataFrame containing the processed results.
+    """
+
+    if engine == 'rows':
+        return process_rows(data_df, mapping_by_field, proc_result_index, keep_value_types, dispatch)
+    return process_columnar(data_df, mapping_by_field, proc_result_index, keep_value_types)
+
+
+### STREAMING FUNCTIONS ###
+
+
+def get_chunk_kind(column):
+    """
+    Classifies the dtype pandas inferred for a column of a single chunk.
+    Returns:
+        str: One of 'empty', 'bool', 'int', 'float' or 'str'.
+    """
+
+    if column.isna().all():
+        return 'empty'
+    if pd.api.types.is_bool_dtype(column) or pd.api.types.infer_dtype(column, skipna=True) == 'boolean':
+        return 'bool'
+    if pd.api.types.is_integer_dtype(column):
+        return 'int'
+    if pd.api.types.is_float_dtype(column):
+        return 'float'
+    return 'str'
+
+
+def infer_chunk_dtypes(path_csv_data, usecols, chunksize):
+    """
+    Reads the data CSV chunk by chunk to find which columns would get a different dtype in some chunks
+    than when reading the whole file at once. Reading every chunk with the returned dtypes gives the
+    same values as a full read.
+    Args:
+        path_csv_data (str): Path to the CSV data file.
+        usecols (list): Columns to read.
+        chunksize (int): Number of rows per chunk.
+    Returns:
+        dict: The dtype to force for each column that needs it.
+    """
+
+    kinds = {}
+    for chunk in pd.read_csv(path_csv_data, encoding='utf-8-sig', usecols=usecols, chunksize=chunksize):
+        for column in chunk.columns:
+            kinds.setdefault(column, set()).add(get_chunk_kind(chunk[column]))
+
+    dtypes = {}
+    for column, column_kinds in kinds.items():
+        if 'str' in column_kinds or ('bool' in column_kinds and column_kinds & {'int', 'float'}):
+            dtypes[column] = str
+        elif 'int' in column_kinds and column_kinds & {'float', 'empty'}:
+            dtypes[column] = 'float64'
+    return dtypes
+
+
+def process_data_in_chunks(path_csv_data, mapping_df, result_data_file, chunksize, engine='columnar',
+                           output_format='csv', emitted_case_ids=frozenset(), shard=None, indices=None,
+                           text_categories=False):
+    """
+    Streaming version of process_data: reads the data CSV in chunks of case rows, processes each chunk against
+    mapping indices built only once, and appends the results to the output file as they are produced. Peak
+    memory depends on the chunk size instead of on the number of cases.
+    Args:
+        path_csv_data (str): Path to the CSV data file.
+        mapping_df (pd.DataFrame): The DataFrame containing the mapping information.
+        result_data_file (str): Path of the output CSV or Parquet file.
+        chunksize (int): Number of case rows processed at a time.
+        engine (str): 'columnar' or 'rows'.
+        output_format (str): 'csv' or 'parquet'.
+        emitted_case_ids (set): Case ids to skip, already emitted by a previous incremental run.
+        shard (tuple, optional): Shard index and count. Only the rows of that shard are written, see
+            sharding.shard_rows.
+        indices (tuple, optional): The mapping indices of every field, as returned by load_mapping_index.
+        text_categories (bool): Read the text fields as categorical columns, see get_data_schema.
+    Returns:
+        int: Number of rows written.
+    """
+
+    # 1. Validates the columns using only the header of the data file
+    header_df = pd.read_csv(path_csv_data, encoding='utf-8-sig', nrows=0)
+    validate_inputs(header_df, mapping_df)
+
+    # 2. Builds the mapping indexes once, for the fields present in the data file
+    if indices is not None:
+        mapping_by_field, proc_result_index, dispatch = select_mapping_indices(indices, header_df.columns)
+    else:
+        filtered_mapping_df = mapping_df[mapping_df['field_id'].isin(header_df.columns)]
+        mapping_by_field, proc_result_index, dispatch = compile_mapping_indices(filtered_mapping_df)
+
+    # 3. Only the case id and the mapped fields are read, the text fields as categories with text_categories and the
+    # rest with the dtypes a full read would give them
+    usecols, dtypes = get_data_schema(mapping_df, header_df.columns, text_categories)
+    inferred_columns = [column for column in usecols if column not in dtypes]
+    dtypes.update(infer_chunk_dtypes(path_csv_data, inferred_columns, chunksize))
+
+    if output_format == 'parquet':
+        return write_parquet_chunks(path_csv_data, usecols, dtypes, mapping_by_field, proc_result_index,
+                                    result_data_file, chunksize, engine, mapping_df, emitted_case_ids, shard,
+                                    dispatch)
+
+    # 4. Processes each chunk and appends its rows. The file is opened once so the BOM is written only once.
+    written = 0
+    sharder = sharding.ChunkSharder(shard)
+    with open(result_data_file, 'w', encoding='utf-8-sig', newline='') as output_file:
+        for chunk in pd.read_csv(path_csv_data, encoding='utf-8-sig', usecols=usecols, dtype=dtypes,
+                                 chunksize=chunksize):
+            chunk_df = sharder.select(process_with_indices(drop_emitted_cases(chunk, emitted_case_ids),
+                                                           mapping_by_field, proc_result_index, engine,
+                                                           keep_value_types=True, dispatch=dispatch))
+            if chunk_df.empty:
+                continue
+            chunk_df.to_csv(output_file, index=False, header=(written == 0))
+            written += len(chunk_df)
+
+        if written == 0:
+            pd.DataFrame([]).to_csv(output_file, index=False)
+
+    # 5. The reference rows of other shards go before the rows of the shard
+    foreign_rows = sharder.foreign_rows()
+    if not foreign_rows.empty:
+        prepend_csv_rows(result_data_file, foreign_rows)
+        written += len(foreign_rows)
+    return written
+
+
+def prepend_csv_rows(result_data_file, rows):
+    """
+    Writes rows at the start of a CSV file written by process_data_in_chunks, before the rows it already has.
+    """
+
+    staging_file = result_data_file + '.rows'
+    os.replace(result_data_file, staging_file)
+    try:
+        with open(staging_file, 'r', encoding='utf-8-sig', newline='') as rows_file, \
+                open(result_data_file, 'w', encoding='utf-8-sig', newline='') as output_file:
+            rows_file.readline()
+            rows.to_csv(output_file, index=False)
+            shutil.copyfileobj(rows_file, output_file)
+    finally:
+        os.remove(staging_file)
+
+
+def write_parquet_chunks(path_csv_data, usecols, dtypes, mapping_by_field, proc_result_index, result_data_file,
+                         chunksize, engine, mapping_df, emitted_case_ids=frozenset(), shard=None, dispatch=None):
+    """
+    Parquet counterpart of the chunk loop of process_data_in_chunks: every processed chunk is appended to the
+    output file as a row group.
+    Returns:
+        int: Number of rows written.
+    """
+
+    import pyarrow.parquet as pq
+
+    written = 0
+    writer = None
+    sharder = sharding.ChunkSharder(shard)
+    try:
+        for chunk in pd.read_csv(path_csv_data, encoding='utf-8-sig', usecols=usecols, dtype=dtypes,
+                                 chunksize=chunksize):
+            chunk_df = sharder.select(process_with_indices(drop_emitted_cases(chunk, emitted_case_ids),
+                                                           mapping_by_field, proc_result_index, engine,
+                                                           keep_value_types=True, dispatch=dispatch))
+            if chunk_df.empty:
+                continue
+            table = to_parquet_table(chunk_df, get_parquet_dtypes(mapping_df, chunk[config.CASE_ID_COLUMN].dtype))
+            if writer is None:
+                writer = pq.ParquetWriter(result_data_file, table.schema)
+            writer.write_table(table)
+            written += len(chunk_df)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if written == 0:
+        pd.DataFrame([]).to_parquet(result_data_file, index=False)
+
+    # The reference rows of other shards go before the rows of the shard
+    foreign_rows = sharder.foreign_rows()
+    if not foreign_rows.empty:
+        table = to_parquet_table(foreign_rows, get_parquet_dtypes(mapping_df, chunk[config.CASE_ID_COLUMN].dtype))
+        prepend_parquet_rows(result_data_file, table)
+        written += len(foreign_rows)
+    return written
+
+
+def prepend_parquet_rows(result_data_file, table):
+    """
+    Writes a table at the start of a Parquet file written by write_parquet_chunks, as its first row group.
+    """
+
+    import pyarrow.parquet as pq
+
+    staging_file = result_data_file + '.rows'
+    os.replace(result_data_file, staging_file)
+    try:
+        rows_file = pq.ParquetFile(staging_file)
+        with pq.ParquetWriter(result_data_file, rows_file.schema_arrow) as writer:
+            writer.write_table(table)
+            for row_group in range(rows_file.num_row_groups):
+                writer.write_table(rows_file.read_row_group(row_group))
+    finally:
+        os.remove(staging_file)
+
+
+### INCREMENTAL FUNCTIONS ###
+
+
+def load_emitted_case_ids(state_path):
+    """
+    Reads the case ids already emitted by previous incremental runs, one per line.
+    Args:
+        state_path (str): Path of the state file. A missing file means that no case was emitted yet.
+    Returns:
+        set: The emitted case ids, as strings.
+    """
+
+    if not os.path.isfile(state_path):
+        return set()
+    with open(state_path, 'r', encoding='utf-8') as state_file:
+        return {line.rstrip('\n') for line in state_file if line.strip()}
+
+
+def drop_emitted_cases(data_df, emitted_case_ids):
+    """
+    Keeps only the data rows whose case id was not emitted yet.
+    """
+
+    if not emitted_case_ids:
+        return data_df
+    return data_df[~data_df[config.CASE_ID_COLUMN].astype(str).isin(emitted_case_ids)]
+
+
+### PARQUET FUNCTIONS ###
+
+
+def get_parquet_dtypes(mapping_df, case_id_dtype):
+    """
+    Chooses the dtype of each column of the preprocessed table when it is written as Parquet. The mapping columns
+    keep the dtype they have in the mapping file and the case id the one it has in the data file, so every chunk
+    of a streamed run is written with the same schema as a full run. field_value mixes values of every value type,
+    so it is stored as the text that the CSV output would contain.
+    Args:
+        mapping_df (pd.DataFrame): The DataFrame containing the mapping information.
+        case_id_dtype: dtype of the case id column in the data file.
+    Returns:
+        dict: The dtype of each output column, with 'string' for text columns.
+    """
+
+    dtypes = {}
+    for column, dtype in mapping_df.dtypes.items():
+        dtypes[column] = 'string' if dtype == object else dtype
+    dtypes[config.CASE_ID_COLUMN] = 'string' if case_id_dtype == object else case_id_dtype
+    dtypes['field_value'] = 'string'
+    return dtypes
+
+
+def to_parquet_table(result_df, dtypes):
+    """
+    Converts a processed DataFrame into an Arrow table with the given column dtypes.
+    """
+
+    import pyarrow as pa
+
+    dtypes = {column: dtype for column, dtype in dtypes.items() if column in result_df.columns}
+    return pa.Table.from_pandas(result_df.astype(dtypes), preserve_index=False)
+
+
+def write_parquet(result_df, result_data_file, dtypes):
+    """
+    Writes the processed DataFrame to a Parquet file.
+    Args:
+        result_df (pd.DataFrame): The processed data, possibly empty.
+        result_data_file (str): Path of the output Parquet file.
+        dtypes (dict): The dtype of each output column, as returned by get_parquet_dtypes.
+    """
+
+    import pyarrow.parquet as pq
+
+    if result_df.empty:
+        result_df.to_parquet(result_data_file, index=False)
+        return
+    pq.write_table(to_parquet_table(result_df, dtypes), result_data_file)
+
+
+def main(path_csv_data, path_csv_mapping, output_path, engine='columnar', chunksize=None, output_format='csv',
+         incremental_state=None, profile_report=None, shard=None, csv_engine='c', text_categories=False):
 
     # Error handling for file paths
     if not os.path.exists(path_csv_data):
@@ -196,22 +808,13 @@ def main(path_csv_data, path_csv_mapping, output_path):
     if not os.path.exists(path_csv_mapping):
         raise FileNotFoundError(f"The CSV mapping file does not exist: {path_csv_mapping}")
 
-    # Load CSV data file
-    try:
-        data_df = pd.read_csv(path_csv_data, encoding='utf-8-sig')
-    except pd.errors.EmptyDataError:
-        print(f"Error: file '{path_csv_data}' is empty.")
-        sys.exit(1)
-    except pd.errors.ParserError as e:
-        print(f"Error when parsing the data csv '{path_csv_data}': {e}")
-        sys.exit(1)
-    except Exception as e:
-        print(f"Unexpected error when reading '{path_csv_data}': {e}")
-        sys.exit(1)
+    report = profiling.new_report('dataPreprocessing.py') if profile_report else None
 
     # Load mapping CSV file
     try:
-        mapping_df = pd.read_csv(path_csv_mapping, encoding='utf-8-sig')
+        with profiling.stage(report, 'read_mappings') as entry:
+            mapping_df = pd.read_csv(path_csv_mapping, encoding='utf-8-sig')
+            entry['rows'] = len(mapping_df)
     except pd.errors.EmptyDataError:
         print(f"Error: mapping file '{path_csv_mapping}' is empty.")
         sys.exit(1)
@@ -225,17 +828,107 @@ def main(path_csv_data, path_csv_mapping, output_path):
     # Clean whitespace around field IDs and other necessary fields
     mapping_df = clean_data(mapping_df)
 
+    # The mapping indices are compiled once per mappings file, next to the preprocessed data
+    with profiling.stage(report, 'mapping_index'):
+        indices = load_mapping_index(path_csv_mapping, mapping_df,
+                                     os.path.join(output_path, config.MAPPING_INDEX_FILENAME))
+
+    # In incremental mode, the cases already emitted to the RDF output are skipped
+    emitted_case_ids = load_emitted_case_ids(incremental_state) if incremental_state else set()
+
+    # Each shard writes its own file, so that shards can run at the same time on a shared filesystem
+    if shard is not None:
+        output_path = os.path.join(output_path, sharding.shard_name(*shard))
+        os.makedirs(output_path, exist_ok=True)
+
+    if output_format == 'parquet':
+        result_data_file = f'{output_path}/{config.PREPROCESSED_PARQUET_FILENAME}'
+    else:
+        result_data_file = f'{output_path}/preprocessed_data.csv'
+
+    # Stream the CSV data file chunk by chunk, appending to the output
+    if chunksize:
+        try:
+            with profiling.stage(report, 'process_chunks') as entry:
+                entry['rows'] = process_data_in_chunks(path_csv_data, mapping_df, result_data_file, chunksize, engine,
+                                                       output_format, emitted_case_ids, shard, indices,
+                                                       text_categories)
+        except pd.errors.EmptyDataError:
+            print(f"Error: file '{path_csv_data}' is empty.")
+            sys.exit(1)
+        except pd.errors.ParserError as e:
+            print(f"Error when parsing the data csv '{path_csv_data}': {e}")
+            sys.exit(1)
+        if report is not None:
+            profiling.write_report(report, profile_report)
+        return
+
+    # Load CSV data file
+    try:
+        with profiling.stage(report, 'read_data') as entry:
+            data_df = read_data_file(path_csv_data, mapping_df, csv_engine, text_categories)
+            entry['rows'] = len(data_df)
+    except pd.errors.EmptyDataError:
+        print(f"Error: file '{path_csv_data}' is empty.")
+        sys.exit(1)
+    except pd.errors.ParserError as e:
+        print(f"Error when parsing the data csv '{path_csv_data}': {e}")
+        sys.exit(1)
+    except Exception as e:
+        print(f"Unexpected error when reading '{path_csv_data}': {e}")
+        sys.exit(1)
+
     # Process the data using the mapping
-    result_df = process_data(data_df, mapping_df)
+    with profiling.stage(report, 'drop_emitted_cases') as entry:
+        data_df = drop_emitted_cases(data_df, emitted_case_ids)
+        entry['rows'] = len(data_df)
+    result_df = process_data(data_df, mapping_df, engine, report, indices)
+
+    # Every case is processed, as the rules of a field depend on its first row over every case
+    if shard is not None:
+        with profiling.stage(report, 'select_shard') as entry:
+            result_df = sharding.shard_rows(result_df, shard)
+            entry['rows'] = len(result_df)
 
     # Guardar el DataFrame resultante en un archivo CSV
-    result_data_file = f'{output_path}/preprocessed_data.csv'
-    result_df.to_csv(result_data_file, index=False, encoding='utf-8-sig')
+    with profiling.stage(report, 'write') as entry:
+        if output_format == 'parquet':
+            write_parquet(result_df, result_data_file,
+                          get_parquet_dtypes(mapping_df, data_df[config.CASE_ID_COLUMN].dtype))
+        else:
+            result_df.to_csv(result_data_file, index=False, encoding='utf-8-sig')
+        entry['rows'] = len(result_df)
+
+    if report is not None:
+        profiling.write_report(report, profile_report)
     
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process CSV data and mapping files using pandas.")
     parser.add_argument('csv_data_path', type=str, help='Path to the CSV data file')
     parser.add_argument('csv_mapping_path', type=str, help='Path to the CSV mapping file')
     parser.add_argument('output_path', type=str, help='Output path for the processed CSV file')
+    parser.add_argument('--engine', choices=['columnar', 'rows'], default='columnar',
+                        help='Process whole columns at once, or iterate over every data row')
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='Process the data file in chunks of this many case rows, appending to the output')
+    parser.add_argument('--csv-engine', choices=config.CSV_ENGINES, default='c',
+                        help='Parser of the data file, pyarrow is faster on large files (requires pyarrow)')
+    parser.add_argument('--text-categories', action='store_true',
+                        help='Read the text fields as categorical columns with the text of the file, which uses less '
+                             'memory but parses slower')
+    parser.add_argument('--output-format', choices=['csv', 'parquet'], default='csv',
+                        help='Write the preprocessed data as CSV, or as Parquet (requires pyarrow)')
+    parser.add_argument('--incremental-state', type=str, default=None,
+                        help='State file of initiate.py --incremental, only the cases not listed in it are processed')
+    parser.add_argument('--profile-report', type=str, default=None, metavar='PATH',
+                        help='Write a JSON report with the time, row count and peak memory of each phase')
+    parser.add_argument('--shard-index', type=int, default=None,
+                        help='Only process the cases of this shard, writing them to a shard-<i>-of-<n> subfolder')
+    parser.add_argument('--shard-count', type=int, default=None,
+                        help='Number of shards the cases are split into by a hash of their case id')
     args = parser.parse_args()
-    main(args.csv_data_path, args.csv_mapping_path, args.output_path)
+    shard = sharding.check_shard_arguments(parser, args)
+    if args.chunksize and args.csv_engine == 'pyarrow':
+        parser.error("--csv-engine pyarrow cannot read the data file in chunks, use the c engine with --chunksize")
+    main(args.csv_data_path, args.csv_mapping_path, args.output_path, args.engine, args.chunksize,
+         args.output_format, args.incremental_state, args.profile_report, shard, args.csv_engine, args.text_categories)
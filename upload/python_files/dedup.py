@@ -0,0 +1,188 @@
+import heapq
+import math
+import os
+import sys
+import tempfile
+import zlib
+
+# Rough ratio between the memory used by a set of lines and the size of those lines on disk
+SET_MEMORY_FACTOR = 2.5
+# Upper bound of spill files open at the same time
+MAX_PARTITIONS = 512
+# Memory used by each line of a sorted run, besides the line itself: the pointer in the list
+LIST_ENTRY_BYTES = 8
+
+
+def count_partitions(input_bytes, memory_budget_mb):
+    """
+    Computes how many hash partitions are needed so that the lines of each partition fit in the memory budget.
+    Args:
+        input_bytes (int): Approximate size of all the input lines.
+        memory_budget_mb (float): Memory available for the set of seen lines, in MB.
+    Returns:
+        int: Number of partitions, 1 meaning that everything can be deduplicated in memory.
+    """
+
+    budget_bytes = max(memory_budget_mb, 1) * 1024 * 1024
+    partitions = math.ceil(input_bytes * SET_MEMORY_FACTOR / budget_bytes)
+    return min(max(partitions, 1), MAX_PARTITIONS)
+
+
+def partition_of(line, partitions):
+    """
+    Returns the partition of a line. A stable hash is used, so runs are reproducible.
+    """
+    return zlib.crc32(line.encode('utf-8')) % partitions
+
+
+def write_unique(lines, output_file):
+    """
+    Writes the first occurrence of each line.
+    Returns:
+        tuple: Number of lines read and number of lines written.
+    """
+
+    seen = set()
+    read = 0
+    for line in lines:
+        read += 1
+        if line not in seen:
+            seen.add(line)
+            output_file.write(line + '\n')
+    return read, len(seen)
+
+
+def read_spill_file(path):
+    with open(path, 'r', encoding='utf-8') as spill_file:
+        for line in spill_file:
+            yield line.rstrip('\n')
+
+
+def deduplicate_lines(lines, output_file, input_bytes, memory_budget_mb, spill_folder=None):
+    """
+    Writes the distinct lines of an iterable to an open file, using at most memory_budget_mb for the set of
+    seen lines. If the input does not fit in the budget, the lines are first spilled to hash-partitioned
+    temporary files, and each partition is then deduplicated on its own. Equal lines always land in the
+    same partition, so the result is exact.
+    Args:
+        lines (iterable): Lines without the trailing newline.
+        output_file (file): Open text file where the distinct lines are written.
+        input_bytes (int): Approximate size of the input, used to choose the number of partitions.
+        memory_budget_mb (float): Memory available for deduplication, in MB.
+        spill_folder (str, optional): Folder for the temporary spill files. Defaults to the system temp folder.
+    Returns:
+        dict: Number of lines read, lines written, duplicates removed and partitions used.
+    """
+
+    partitions = count_partitions(input_bytes, memory_budget_mb)
+
+    if partitions == 1:
+        read, written = write_unique(lines, output_file)
+    else:
+        read = written = 0
+        with tempfile.TemporaryDirectory(prefix='dedup_', dir=spill_folder) as spill_dir:
+            spill_paths = [os.path.join(spill_dir, f"partition_{i}.nt") for i in range(partitions)]
+            spill_files = [open(path, 'w', encoding='utf-8') for path in spill_paths]
+            try:
+                for line in lines:
+                    spill_files[partition_of(line, partitions)].write(line + '\n')
+            finally:
+                for spill_file in spill_files:
+                    spill_file.close()
+
+            for path in spill_paths:
+                partition_read, partition_written = write_unique(read_spill_file(path), output_file)
+                read += partition_read
+                written += partition_written
+                os.remove(path)
+
+    return {
+        'lines': read,
+        'written': written,
+        'duplicates': read - written,
+        'partitions': partitions,
+    }
+
+
+def unique_sorted(lines):
+    """
+    Removes the repeated lines of a sorted iterable.
+    """
+
+    previous = None
+    for line in lines:
+        if line != previous:
+            yield line
+            previous = line
+
+
+def write_run(lines, spill_dir):
+    """
+    Writes sorted lines to a new temporary file of spill_dir, and returns its path.
+    """
+
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=spill_dir, prefix='run_', suffix='.nt',
+                                     delete=False) as run_file:
+        for line in lines:
+            run_file.write(line + '\n')
+    return run_file.name
+
+
+def merge_runs(run_paths):
+    """
+    Merges sorted files into a single sorted iterator without repeated lines.
+    """
+
+    run_files = [open(path, 'r', encoding='utf-8') for path in run_paths]
+    try:
+        yield from unique_sorted(heapq.merge(*((line.rstrip('\n') for line in run_file) for run_file in run_files)))
+    finally:
+        for run_file in run_files:
+            run_file.close()
+
+
+def sort_unique_lines(lines, memory_budget_mb, spill_folder=None):
+    """
+    External sort: yields the distinct lines of an iterable in sorted order, using at most about memory_budget_mb
+    for the lines held in memory. Lines are gathered into runs that fit in the budget, each run is sorted and
+    written to a temporary file, and the runs are then merged, at most MAX_PARTITIONS at a time.
+    Args:
+        lines (iterable): Lines without the trailing newline or surrounding whitespace.
+        memory_budget_mb (float): Memory available for a run, in MB.
+        spill_folder (str, optional): Folder for the temporary run files. Defaults to the system temp folder.
+    Yields:
+        str: Each distinct line, in code point order.
+    """
+
+    budget_bytes = max(memory_budget_mb, 1) * 1024 * 1024
+    with tempfile.TemporaryDirectory(prefix='sort_', dir=spill_folder) as spill_dir:
+        run_paths = []
+        run = []
+        run_bytes = 0
+        for line in lines:
+            run.append(line)
+            run_bytes += sys.getsizeof(line) + LIST_ENTRY_BYTES
+            if run_bytes >= budget_bytes:
+                run_paths.append(write_run(unique_sorted(sorted(run)), spill_dir))
+                run = []
+                run_bytes = 0
+
+        # Everything fits in memory, there is nothing to merge
+        if not run_paths:
+            yield from unique_sorted(sorted(run))
+            return
+        if run:
+            run_paths.append(write_run(unique_sorted(sorted(run)), spill_dir))
+            run = []
+
+        # Merges groups of runs until they can all be open at the same time
+        while len(run_paths) > MAX_PARTITIONS:
+            merged_paths = []
+            for start in range(0, len(run_paths), MAX_PARTITIONS):
+                group = run_paths[start:start + MAX_PARTITIONS]
+                merged_paths.append(write_run(merge_runs(group), spill_dir))
+                for path in group:
+                    os.remove(path)
+            run_paths = merged_paths
+
+        yield from merge_runs(run_paths)
@@ -1,6 +1,16 @@
 import csv
+import re
 import argparse
+import pandas as pd
 import template_manager
+import udf_folding
+
+# Mapping names are the keys indented directly below 'mappings:' in the template and the handlers
+MAPPING_NAME_PATTERN = re.compile(r'^( {8})([^\s:#-][^\s:]*):\s*$', re.MULTILINE)
+
+# Columns read by the context mappings of the template, see template_manager.generate_context_mappings
+CONTEXT_COLUMNS = ['temporal_context', 'statement_context', 'procedure_location', 'procedure_reason', 'procedure',
+                   'categorical_ontology_mapping']
 
 ### GENERATION FUNCTIONS ###
 
@@ -72,6 +82,26 @@ def generate_procedure(row,csv_file_name):
     return regla
 
 
+def generate_shared_procedure(source_procedure_iri, case_column, csv_file_name):
+    """
+    Generates the rule of a source procedure for every case that has a field resulting from it. The data source has
+    one row per case, and case_column holds the case id only for the cases of this procedure, so the rest are
+    dropped as missing values.
+    """
+
+    source_procedure = extract_last_part(source_procedure_iri)
+    regla = f"""
+        ResultOfProcedure_{case_column}:
+            sources:
+                - ['{csv_file_name}~csv']
+            s: base:Procedure_{source_procedure}_$({case_column})
+            po:
+                - [a, {source_procedure_iri}~iri]
+    """
+
+    return regla
+
+
 def generate_observation_result(row,csv_file_name):
     rule_name = row['ontology_mapping'].strip() + '_' + row['field_id'].strip()
     field_id = row['field_id'].strip()
@@ -358,6 +388,11 @@ def load_template(csv_file_name):
     return template_manager.generate_yarrrml_template(csv_file_name)
 
 
+# Handlers whose rules only depend on the case id and not on the field, generated once per run by
+# generate_shared_yarrrml instead of once per field
+SHARED_HANDLERS = (generate_procedure,)
+
+
 def load_pattern_handlers():
     """
     Returns a dictionary mapping pattern types to their respective handler functions.
@@ -380,12 +415,50 @@ def load_pattern_handlers():
     }
 
 
-def generate_rules(csv_file_name, pattern_handlers):
+def field_pattern_handlers(pattern_handlers):
     """
-    Reads a CSV file and generates YARRRML rules based on the patterns defined in pattern_handlers.
+    Returns the pattern handlers without the SHARED_HANDLERS, for the rules of a field whose shared rules are
+    generated by generate_shared_yarrrml.
+    """
+    return {pattern_type: [handler for handler in handlers if handler not in SHARED_HANDLERS]
+            for pattern_type, handlers in pattern_handlers.items()}
+
+
+def read_rows(csv_file_name):
+    """
+    Reads the rows of a CSV file as dictionaries of strings.
     Args:
         csv_file_name (str): Path to the input CSV file.
+    Returns:
+        list: List of rows, one dictionary per CSV line.
+    """
+
+    with open(csv_file_name, mode='r', encoding='utf-8-sig') as file:
+        return list(csv.DictReader(file))
+
+
+def rows_from_dataframe(df):
+    """
+    Converts a DataFrame into the same string-valued rows that csv.DictReader would yield
+    after exporting it to CSV. Only the first row of each field is kept, as the rest are
+    skipped by generate_rules_from_rows anyway.
+    Args:
+        df (pd.DataFrame): Preprocessed rows of one or more fields.
+    Returns:
+        list: List of rows, one dictionary per field.
+    """
+
+    first_rows = df.drop_duplicates(subset='field_id', keep='first')
+    return first_rows.fillna('').astype(str).to_dict('records')
+
+
+def generate_rules_from_rows(rows, pattern_handlers, csv_file_name):
+    """
+    Generates YARRRML rules for already loaded rows, based on the patterns defined in pattern_handlers.
+    Args:
+        rows (iterable): Rows as dictionaries of strings.
         pattern_handlers (dict): Dictionary mapping pattern types to handler functions.
+        csv_file_name (str): Data source referenced by the generated rules.
     Returns:
         list: List of generated YARRRML rules.
     """
@@ -393,23 +466,266 @@ def generate_rules(csv_file_name, pattern_handlers):
     rules = []
     field_ids_seen = set()
 
-    # Leer CSV y acumular reglas, saltando duplicados
-    with open(csv_file_name, mode='r', encoding='utf-8-sig') as file:
-        csv_reader = csv.DictReader(file)
-        for row in csv_reader:
-            field_id = row['field_id'].strip()
-            if field_id in field_ids_seen:
-                continue   # Saltar duplicados, no romper el bucle
-            field_ids_seen.add(field_id)
-
-            print(f"field:{field_id}")
-            rule = generate_rule(row, pattern_handlers, csv_file_name)
-            if rule:
-                rules.append(rule)
+    # Acumular reglas, saltando duplicados
+    for row in rows:
+        field_id = row['field_id'].strip()
+        if field_id in field_ids_seen:
+            continue   # Saltar duplicados, no romper el bucle
+        field_ids_seen.add(field_id)
+
+        print(f"field:{field_id}")
+        rule = generate_rule(row, pattern_handlers, csv_file_name)
+        if rule:
+            rules.append(rule)
 
     return rules
+
+
+def generate_rules(csv_file_name, pattern_handlers):
+    """
+    Reads a CSV file and generates YARRRML rules based on the patterns defined in pattern_handlers.
+    Args:
+        csv_file_name (str): Path to the input CSV file.
+        pattern_handlers (dict): Dictionary mapping pattern types to handler functions.
+    Returns:
+        list: List of generated YARRRML rules.
+    """
+
+    return generate_rules_from_rows(read_rows(csv_file_name), pattern_handlers, csv_file_name)
+
+
+def namespace_rules(rules, prefix):
+    """
+    Prefixes the mapping names of generated rules, so that the rules of several fields
+    can be placed in the same YARRRML document without clashing.
+    Args:
+        rules (list): List of generated YARRRML rules.
+        prefix (str): Prefix added to every mapping name, usually the field_id.
+    Returns:
+        list: List of rules with prefixed mapping names.
+    """
+    return [MAPPING_NAME_PATTERN.sub(rf'\g<1>{prefix}__\g<2>:', rule) for rule in rules]
+
+
+def fold_udfs(yarrrml, data, udf_path):
+    """
+    Replaces the function calls of the mappings that do not depend on the row data by their result, evaluated at
+    generation time with the functions of the UDF file. See udf_folding.fold_mapping.
+    Args:
+        yarrrml (str): YARRRML text whose mappings all read the given data.
+        data (pd.DataFrame): All the rows of the data source.
+        udf_path (str): Path to the UDF file used by morph_kgc.
+    Returns:
+        str: The YARRRML text with the folded functions.
+    """
+
+    functions = udf_folding.load_udfs(udf_path)
+    starts = [match.start() for match in MAPPING_NAME_PATTERN.finditer(yarrrml)]
+    if not starts:
+        return yarrrml
+
+    parts = [yarrrml[:starts[0]]]
+    for start, end in zip(starts, starts[1:] + [len(yarrrml)]):
+        parts.append(udf_folding.fold_mapping(yarrrml[start:end], functions, data))
+    return ''.join(parts)
+
+
+def build_yarrrml(template, rules):
+    """
+    Combines the YARRRML template and the generated rules into a single document.
+    Args:
+        template (str): The YARRRML template.
+        rules (list): List of generated rules.
+    Returns:
+        str: The YARRRML document.
+    """
+    return template + '\n'.join(rules)
+
+
+def generate_yarrrml(rows, csv_file_name, pattern_handlers=None, udf_path=None, shared=True):
+    """
+    Generates the complete YARRRML document for a set of preprocessed rows, without
+    going through the command line interface.
+    Args:
+        rows (iterable or pd.DataFrame): Rows as dictionaries of strings, or a DataFrame.
+        csv_file_name (str): Data source referenced by the generated rules.
+        pattern_handlers (dict, optional): Dictionary mapping pattern types to handler functions.
+            Defaults to the handlers returned by load_pattern_handlers.
+        udf_path (str, optional): UDF file used by morph_kgc. When given, the function calls that
+            do not depend on the row data are replaced by their result.
+        shared (bool): Whether to include the case, context and procedure mappings. Leave them out when they are
+            generated once for all the fields by generate_shared_yarrrml.
+    Returns:
+        str: The YARRRML document.
+    """
+
+    if pattern_handlers is None:
+        pattern_handlers = load_pattern_handlers()
+    if hasattr(rows, 'columns'):
+        data, rows = rows, rows_from_dataframe(rows)
+    else:
+        rows = list(rows)
+        data = pd.DataFrame(rows)
+
+    if shared:
+        template = load_template(csv_file_name)
+    else:
+        pattern_handlers = field_pattern_handlers(pattern_handlers)
+        template = template_manager.generate_yarrrml_header() + template_manager.generate_field_mappings(csv_file_name)
+
+    rules = generate_rules_from_rows(rows, pattern_handlers, csv_file_name)
+    yarrrml = build_yarrrml(template, rules)
+    if udf_path is not None:
+        yarrrml = fold_udfs(yarrrml, data, udf_path)
+    return yarrrml
+
+
+def generate_catalogue_yarrrml(field_sources, catalogue_csv_file_name, pattern_handlers=None, udf_path=None,
+                               shared_sources=None):
+    """
+    Generates a single YARRRML document with the rules of several fields. Each field keeps
+    its own data source, while the shared template reads the rows of every field at once.
+    Args:
+        field_sources (iterable): Pairs of (rows or DataFrame, csv file name), one per field.
+        catalogue_csv_file_name (str): Data source containing the rows of all the fields.
+        pattern_handlers (dict, optional): Dictionary mapping pattern types to handler functions.
+            Defaults to the handlers returned by load_pattern_handlers.
+        udf_path (str, optional): UDF file used by morph_kgc. When given, the function calls that
+            do not depend on the row data are replaced by their result.
+        shared_sources (tuple, optional): The shared data returned by build_shared_data, and the data sources of
+            its cases and contexts. When given, the case, context and procedure mappings read them instead of the
+            rows of every field.
+    Returns:
+        str: The YARRRML document.
+    """
+
+    if pattern_handlers is None:
+        pattern_handlers = load_pattern_handlers()
+    if shared_sources is not None:
+        pattern_handlers = field_pattern_handlers(pattern_handlers)
+
+    rules = []
+    all_data = []
+    for rows, csv_file_name in field_sources:
+        if hasattr(rows, 'columns'):
+            data, rows = rows, rows_from_dataframe(rows)
+        else:
+            rows = list(rows)
+            data = pd.DataFrame(rows)
+        field_rules = generate_rules_from_rows(rows, pattern_handlers, csv_file_name)
+        if field_rules and udf_path is not None:
+            field_rules = [fold_udfs('\n'.join(field_rules), data, udf_path)]
+        if field_rules:
+            rules.extend(namespace_rules(field_rules, rows[0]['field_id'].strip()))
+        all_data.append(data)
+
+    if shared_sources is None:
+        template = load_template(catalogue_csv_file_name)
+    else:
+        template = template_manager.generate_yarrrml_header() + template_manager.generate_field_mappings(
+            catalogue_csv_file_name)
+    if udf_path is not None and all_data:
+        template = fold_udfs(template, pd.concat(all_data), udf_path)
+    if shared_sources is not None:
+        template += generate_shared_mappings(*shared_sources, udf_path=udf_path)
+    return build_yarrrml(template, rules)
+
+
+def build_shared_data(frames, pattern_handlers=None):
+    """
+    Collects, from the rows of every field, the distinct values read by the mappings that are the same for every
+    field: the case ids, with the cases of each source procedure, and the combinations of context columns.
+    Args:
+        frames (iterable): DataFrames with the preprocessed rows of each field.
+        pattern_handlers (dict, optional): Dictionary mapping pattern types to handler functions.
+            Defaults to the handlers returned by load_pattern_handlers.
+    Returns:
+        dict: 'cases', a DataFrame with one row per case id and a 'procedure_<n>' column per source procedure
+        holding the case id of its cases, 'contexts', a DataFrame with the distinct rows of the CONTEXT_COLUMNS,
+        and 'procedures', the IRI of each source procedure in the order of its column.
+    """
+
+    if pattern_handlers is None:
+        pattern_handlers = load_pattern_handlers()
+
+    case_ids = []
+    contexts = []
+    procedure_cases = {}
+    for data in frames:
+        case_ids.append(data['case_id'])
+        contexts.append(data[CONTEXT_COLUMNS].drop_duplicates())
+
+        # The rules of a field are generated from its first row, see rows_from_dataframe
+        row = rows_from_dataframe(data.head(1))[0]
+        handlers = pattern_handlers.get(row['pattern_type'].strip(), [])
+        source_procedure = row['source_procedure'].strip()
+        if source_procedure and any(handler in SHARED_HANDLERS for handler in handlers):
+            procedure_cases.setdefault(source_procedure, []).append(data['case_id'])
+
+    if not case_ids:
+        return {'cases': pd.DataFrame(columns=['case_id']), 'contexts': pd.DataFrame(columns=CONTEXT_COLUMNS),
+                'procedures': []}
+
+    cases = pd.DataFrame({'case_id': pd.concat(case_ids).drop_duplicates().reset_index(drop=True)})
+    procedures = list(procedure_cases)
+    for number, source_procedure in enumerate(procedures):
+        has_procedure = cases['case_id'].isin(pd.concat(procedure_cases[source_procedure]).unique())
+        cases[f"procedure_{number}"] = cases['case_id'].astype(str).where(has_procedure, '')
+    contexts = pd.concat(contexts).drop_duplicates().reset_index(drop=True)
+    return {'cases': cases, 'contexts': contexts, 'procedures': procedures}
+
+
+def generate_shared_mappings(shared_data, cases_file_name, contexts_file_name, udf_path=None):
+    """
+    Generates the case, context and procedure mappings over the shared data, without the prefixes.
+    Args:
+        shared_data (dict): The shared data returned by build_shared_data.
+        cases_file_name (str): Data source with the cases of shared_data.
+        contexts_file_name (str): Data source with the contexts of shared_data.
+        udf_path (str, optional): UDF file used by morph_kgc. When given, the function calls that
+            do not depend on the row data are replaced by their result.
+    Returns:
+        str: The YARRRML mappings.
+    """
+
+    procedure_rules = [generate_shared_procedure(source_procedure, f"procedure_{number}", cases_file_name)
+                       for number, source_procedure in enumerate(shared_data['procedures'])]
+    context_mappings = template_manager.generate_context_mappings(contexts_file_name)
+    if udf_path is not None:
+        context_mappings = fold_udfs(context_mappings, shared_data['contexts'], udf_path)
+    return template_manager.generate_case_mappings(cases_file_name) + context_mappings + '\n'.join(procedure_rules)
+
+
+def generate_shared_yarrrml(shared_data, cases_file_name, contexts_file_name, udf_path=None):
+    """
+    Generates the YARRRML document of the mappings that are the same for every field, so that they are
+    materialized once per run over the distinct case ids and contexts instead of once per field. Together with the
+    documents of generate_yarrrml with shared=False, it gives the same RDF as the complete document of each field.
+    Args:
+        shared_data (dict): The shared data returned by build_shared_data.
+        cases_file_name (str): Data source with the cases of shared_data.
+        contexts_file_name (str): Data source with the contexts of shared_data.
+        udf_path (str, optional): UDF file used by morph_kgc. When given, the function calls that
+            do not depend on the row data are replaced by their result.
+    Returns:
+        str: The YARRRML document.
+    """
+    return template_manager.generate_yarrrml_header() + generate_shared_mappings(
+        shared_data, cases_file_name, contexts_file_name, udf_path)
     
 
+def write_yarrrml(yarrrml_output, output_file_path):
+    """
+    Writes a YARRRML document to a file.
+    Args:
+        yarrrml_output (str): The YARRRML document.
+        output_file_path (str): Path to the output file.
+    """
+    with open(output_file_path, 'w', encoding='utf-8') as output_file:
+        output_file.write(yarrrml_output)
+        print(f"Generated YARRRML saved at: {output_file_path}")
+
+
 def write_output(template, rules, output_file_path):
     """
     Writes the YARRRML output to a file, combining the template and generated rules.
@@ -418,10 +734,7 @@ def write_output(template, rules, output_file_path):
         rules (list): List of generated rules.
         output_file_path (str): Path to the output file.
     """
-    yarrml_output = template + '\n'.join(rules)
-    with open(output_file_path, 'w', encoding='utf-8') as output_file:
-        output_file.write(yarrml_output)
-        print(f"Generated YARRRML saved at: {output_file_path}")
+    write_yarrrml(build_yarrrml(template, rules), output_file_path)
 
 def main():
     args = parse_arguments()
@@ -2,21 +2,59 @@ import morph_kgc
 import os
 import rdflib
 import argparse
+import importlib.metadata
 import pandas as pd
-import subprocess
+import queue
+import re
 import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from morph_kgc.fnml import fnml_executer
+
+import build_cache
+import dedup
+import generateRules
+import mapping_cache
+import native_backend
+import profiling
+import sharding
+import template_manager
+import udf_cache
+import udf_folding
  
 from config import (
+    CASE_ID_COLUMN,
     PREPROCESSED_FOLDER,
     PREPROCESSED_FILENAME,
+    PREPROCESSED_PARQUET_FILENAME,
     CSV_FOLDER,
     RULES_FOLDER,
     PYTHON_FOLDER,
     UDF_FILENAME,
     INSTANCES_FOLDER,
     FINAL_OUTPUT_FILENAME,
+    FINAL_NT_OUTPUT_FILENAME,
+    EMITTED_CASES_FILENAME,
+    REFERENCE_ROWS_FILENAME,
+    CATALOGUE_NAME,
+    SHARED_NAME,
+    CACHE_FOLDER,
+    OUTPUT_EXTENSIONS,
+    DEDUP_MEMORY_MB,
+    INTERMEDIATE_FORMATS,
+    CACHE_MAX_MB,
+    UDF_CACHE_SIZE,
+    PIPELINE_QUEUE_SIZE,
+    BACKENDS,
 )
 
+# Data of the groups exported with the 'memory' data format, by source name. The backends read them instead of
+# data files, and each group is released once its rules are materialized.
+memory_sources = {}
+
+# Loose check of an N-Triples line: subject, predicate, object and the final dot
+NTRIPLES_LINE_PATTERN = re.compile(r'^(<[^>]*>|_:\S+)\s+<[^>]*>\s+(<[^>]*>|_:\S+|".*"(@[\w-]+|\^\^<[^>]*>)?)\s*\.$')
+
 # Checks if the necessary directories exist, and creates them if they do not.
 def check_or_create_directories(main_folder: str):
     required = [
@@ -30,14 +68,37 @@ def check_or_create_directories(main_folder: str):
         os.makedirs(folder, exist_ok=True)
 
 
-# Checks if the preprocessed CSV file exists, and loads it into a DataFrame.
-def load_preprocessed_csv(main_folder: str) -> pd.DataFrame:
-    csv_path = os.path.join(main_folder, PREPROCESSED_FOLDER, PREPROCESSED_FILENAME)
+# Checks if the preprocessed CSV file exists, and loads it into a DataFrame. subfolder is the folder of a shard
+# inside the preprocessed data folder.
+def load_preprocessed_csv(main_folder: str, subfolder: str = '') -> pd.DataFrame:
+    csv_path = os.path.join(main_folder, PREPROCESSED_FOLDER, subfolder, PREPROCESSED_FILENAME)
     if not os.path.isfile(csv_path):
         raise FileNotFoundError(f"Preprocessed data file not found on path: {csv_path}")
     df = pd.read_csv(csv_path, keep_default_na=False)
     return df
 
+# Checks if the preprocessed Parquet file exists, and loads it into a DataFrame. Missing text values are
+# replaced by empty strings, as keep_default_na=False does for the CSV file, while numeric columns keep their dtype.
+def load_preprocessed_parquet(main_folder: str, subfolder: str = '') -> pd.DataFrame:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    parquet_path = os.path.join(main_folder, PREPROCESSED_FOLDER, subfolder, PREPROCESSED_PARQUET_FILENAME)
+    if not os.path.isfile(parquet_path):
+        raise FileNotFoundError(f"Preprocessed data file not found on path: {parquet_path}")
+    table = pq.read_table(parquet_path)
+    # Filling the nulls in Arrow is much faster than on the pandas string columns
+    columns = [pc.fill_null(column, '') if pa.types.is_string(column.type) else column for column in table.columns]
+    return pa.table(columns, names=table.column_names).to_pandas()
+
+# Converts the DataFrame returned by dataPreprocessing.process_data to the values that load_preprocessed_csv reads
+# from the preprocessed CSV file: the text of each value as the CSV file holds it, with empty strings for missing
+# values. The rules and the RDF are then the same as when the two scripts are run one after the other.
+def preprocessed_text(df: pd.DataFrame) -> pd.DataFrame:
+    return df.astype(str).where(df.notna(), '')
+
+
 # Filters the DataFrame by field_id, and ensures that no rows in each group have an empty pattern_type.
 def filter_valid_groups(df: pd.DataFrame):
     grouped = df.groupby('field_id')
@@ -51,98 +112,916 @@ def export_group_to_csv(group: pd.DataFrame, csv_folder: str, field_id: str) ->
     group.to_csv(output_path, index=False)
     return output_path
 
+# Exports a DataFrame group to a Parquet file in the corresponding folder
+def export_group_to_parquet(group: pd.DataFrame, csv_folder: str, field_id: str) -> str:
+    output_path = os.path.join(csv_folder, f"{field_id}.parquet")
+    group.to_parquet(output_path, index=False)
+    return output_path
 
-# For a given field_id, generates the YARRRML file, materializes the RDF and serializes it to TTL.
-def generate_yarrrml_and_serialize(field_id: str,
-                                  group_csv_path: str,
-                                  main_folder: str) -> str:
+# Keeps a DataFrame group in memory_sources, as the text that morph_kgc reads from the CSV file written by
+# export_group_to_csv, and returns the in-memory data source that the rules reference instead of that file. The
+# string dtype keeps morph_kgc from stripping the quotes of the values, which it does for object columns.
+def export_group_to_memory(group: pd.DataFrame, csv_folder: str, field_id: str) -> str:
+    memory_sources[field_id] = preprocessed_text(group).astype('string')
+    return '{' + field_id + '}'
 
-    rules_dir = os.path.join(main_folder, RULES_FOLDER)
-    python_dir = os.path.join(main_folder, PYTHON_FOLDER)
-    instances_dir = os.path.join(main_folder, INSTANCES_FOLDER)
 
-    udf_path = os.path.join(python_dir, UDF_FILENAME)
-    mapping_path = os.path.join(rules_dir, f"{field_id}_reglasgenericas.yarrrml")
-    ttl_output_path = os.path.join(instances_dir, f"{field_id}_output.ttl")
+# Drops the in-memory data of the given groups once their rules are materialized.
+def release_memory_sources(*names: str):
+    for name in names:
+        memory_sources.pop(name, None)
+
 
+# Returns the in-memory data sources that the rules of a YARRRML file read. The backends get this snapshot instead of
+# memory_sources, which morph_kgc pickles for its processes while the pipeline keeps adding the next fields to it.
+def mapping_memory_sources(mapping_path: str) -> dict:
+    with open(mapping_path, 'r', encoding='utf-8') as mapping_file:
+        sources = mapping_cache.SOURCE_PATTERN.findall(mapping_file.read())
+    names = dict.fromkeys(source[1:-1] for source in sources if source.startswith('{') and source.endswith('}'))
+    return {name: memory_sources[name] for name in names if name in memory_sources}
+
+# Loaders of the preprocessed data and exporters of the per-field data files for each intermediate format.
+# morph_kgc chooses how to read a data file from its extension, so the rules only need the exported path.
+PREPROCESSED_LOADERS = {'csv': load_preprocessed_csv, 'parquet': load_preprocessed_parquet}
+GROUP_EXPORTERS = {'csv': export_group_to_csv, 'parquet': export_group_to_parquet, 'memory': export_group_to_memory}
+
+
+# Loads the preprocessed data of a shard: the file written for it by dataPreprocessing.py --shard-index if there is
+# one, or else its rows in the preprocessed data of the whole run, as selected by sharding.shard_rows.
+def load_shard_data(main_folder: str, intermediate_format: str, shard) -> pd.DataFrame:
+    load_preprocessed = PREPROCESSED_LOADERS[intermediate_format]
     try:
-        subprocess.run(
-            [sys.executable, 'generateRules.py',
-             '--input', group_csv_path,
-             '--output', mapping_path],
-            check=True
-        )
-    except subprocess.CalledProcessError as e:
-        raise RuntimeError(f"Error when executing generateRules.py for '{field_id}': {e}")
-
-    config = "\n".join([
+        return load_preprocessed(main_folder, sharding.shard_name(*shard))
+    except FileNotFoundError:
+        return sharding.shard_rows(load_preprocessed(main_folder), shard)
+
+
+# Builds the morph_kgc configuration for a mapping file. When number_of_processes is None, morph_kgc's default is used.
+def build_materialize_config(udf_path: str, mapping_path: str, number_of_processes: int = None) -> str:
+    lines = [
         "[CONFIGURATION]",
         "output_format=N-QUADS",
         f"udfs={udf_path}",
+    ]
+    if number_of_processes is not None:
+        lines.append(f"number_of_processes={number_of_processes}")
+    lines += [
         "[DataSource]",
         f"mappings={mapping_path}"
-    ])
+    ]
+    return "\n".join(lines)
+
+
+# Makes morph_kgc load the UDF file once per process, instead of once for every function execution.
+def cache_udf_loading():
+    if getattr(fnml_executer.load_udfs, 'cached', False):
+        return
+
+    load_udfs = fnml_executer.load_udfs
+    loaded_udfs = {}
+
+    def load_udfs_once(config):
+        udfs_path = config.get_udfs()
+        if udfs_path not in loaded_udfs:
+            loaded_udfs[udfs_path] = load_udfs(config)
+        return loaded_udfs[udfs_path]
+
+    load_udfs_once.cached = True
+    fnml_executer.load_udfs = load_udfs_once
+
+
+# Returns the peak resident memory of the current process in MB.
+def peak_rss_mb() -> float:
+    return profiling.peak_rss_mb()
 
+
+# Writes the triples returned by morph_kgc.materialize_set as sorted N-Triples lines.
+def write_ntriples(triples, output_path: str):
+    with open(output_path, 'w', encoding='utf-8') as output_file:
+        for triple in sorted(triples):
+            output_file.write(f"{triple.rstrip()} .\n")
+
+
+# Materializes a YARRRML file with morph_kgc or with the native backend, and returns the triples as N-Triples lines.
+# The in-memory data sources of the rules are read from memory_sources.
+def materialize_triples(udf_path: str, mapping_path: str, number_of_processes: int, label: str,
+                        backend: str = 'morph') -> set:
     try:
-        g_morph = morph_kgc.materialize(config)
+        python_source = mapping_memory_sources(mapping_path)
+    except OSError as e:
+        raise RuntimeError(f"Error when reading the rules of {label}: {e}")
+    if backend == 'native':
+        try:
+            return native_backend.materialize_set(mapping_path, udf_path, python_source)
+        except Exception as e:
+            raise RuntimeError(f"Error in the native backend for {label}: {e}")
+
+    config = build_materialize_config(udf_path, mapping_path, number_of_processes)
+    try:
+        return morph_kgc.materialize_set(config, python_source=python_source)
     except Exception as e:
-        raise RuntimeError(f"Error in materialize() for '{field_id}': {e}")
+        raise RuntimeError(f"Error in materialize() for {label}: {e}")
+
+
+# Writes the materialized triples either as TTL or as N-Triples.
+def serialize_triples(triples, output_path: str, output_format: str, label: str) -> str:
+    if output_format == 'ntriples':
+        try:
+            write_ntriples(triples, output_path)
+        except Exception as e:
+            raise RuntimeError(f"Error when writing N-Triples for {label}: {e}")
+        return output_path
 
+    # Same conversion as morph_kgc.materialize
     try:
-        g_morph.serialize(destination=ttl_output_path, format='turtle')
+        g_morph = rdflib.Graph()
+        if triples:
+            g_morph.parse(data='.\n'.join(triples) + '.', format='nquads')
+        g_morph.serialize(destination=output_path, format='turtle')
     except Exception as e:
-        raise RuntimeError(f"Error when serializing TTL for '{field_id}': {e}")
+        raise RuntimeError(f"Error when serializing TTL for {label}: {e}")
+    return output_path
 
-    return ttl_output_path
 
+# Materializes a YARRRML file with morph_kgc or with the native backend, and writes the result either as TTL
+# or as N-Triples. When record is given, the time of each step and the number of triples are added to it, and the
+# mapping cache lookups when it is installed.
+def materialize_and_serialize(udf_path: str, mapping_path: str, number_of_processes: int, output_path: str,
+                              output_format: str, label: str, backend: str = 'morph', record: dict = None) -> str:
+    triples = materialize_and_record(udf_path, mapping_path, number_of_processes, label, backend, record)
+    with profiling.timed(record['seconds'] if record is not None else None, 'serialization'):
+        return serialize_triples(triples, output_path, output_format, label)
 
-# Reads all .ttl files in the specified folder and combines them into a single RDF graph
-def combine_ttl_files(instances_folder: str, combined_output_file: str):
 
-    combined_graph = rdflib.Graph()
+# Materializes a YARRRML file like materialize_triples. When record is given, the time of the materialization, the
+# number of triples and the mapping cache lookups are added to it.
+def materialize_and_record(udf_path: str, mapping_path: str, number_of_processes: int, label: str,
+                           backend: str = 'morph', record: dict = None):
+    seconds = record['seconds'] if record is not None else None
+    mapping_stats = dict(mapping_cache.stats)
+    with profiling.timed(seconds, 'materialization'):
+        triples = materialize_triples(udf_path, mapping_path, number_of_processes, label, backend)
+    if record is not None:
+        record['triples'] = len(triples)
+        if mapping_cache.cache_folder is not None:
+            record['mapping_cache'] = mapping_cache.stats_since(mapping_stats)
+    return triples
+
+
+# Returns the paths of the YARRRML file and of the instance file of a field.
+def field_output_paths(field_id: str, main_folder: str, output_format: str = 'turtle'):
+    mapping_path = os.path.join(main_folder, RULES_FOLDER, f"{field_id}_reglasgenericas.yarrrml")
+    output_path = os.path.join(main_folder, INSTANCES_FOLDER, f"{field_id}_output{OUTPUT_EXTENSIONS[output_format]}")
+    return mapping_path, output_path
+
+
+# Generates the YARRRML file of a field, without the shared mappings, and writes it to mapping_path.
+def generate_field_rules(field_id: str, group: pd.DataFrame, group_csv_path: str, mapping_path: str, udf_path: str,
+                         record: dict = None):
+    try:
+        with profiling.timed(record['seconds'] if record is not None else None, 'rule_generation'):
+            yarrrml = generateRules.generate_yarrrml(group, group_csv_path, udf_path=udf_path, shared=False)
+            generateRules.write_yarrrml(yarrrml, mapping_path)
+    except Exception as e:
+        raise RuntimeError(f"Error when generating the rules for '{field_id}': {e}")
+
+
+# For a given field_id, generates the YARRRML file, materializes the RDF and serializes it to TTL or N-Triples.
+# The case, context and procedure mappings are left out, materialize_shared generates them once for every field.
+def generate_yarrrml_and_serialize(field_id: str,
+                                  group: pd.DataFrame,
+                                  group_csv_path: str,
+                                  main_folder: str,
+                                  number_of_processes: int = None,
+                                  output_format: str = 'turtle',
+                                  backend: str = 'morph',
+                                  record: dict = None) -> str:
+
+    udf_path = os.path.join(main_folder, PYTHON_FOLDER, UDF_FILENAME)
+    mapping_path, output_path = field_output_paths(field_id, main_folder, output_format)
+    generate_field_rules(field_id, group, group_csv_path, mapping_path, udf_path, record)
+    return materialize_and_serialize(udf_path, mapping_path, number_of_processes, output_path, output_format,
+                                     f"'{field_id}'", backend, record)
+
+
+# Hashes everything besides the data that changes the rules or the RDF of a field: the UDF file, the rule
+# generator with its templates and function folding, the backend, the morph_kgc version and the output format.
+def cache_environment(main_folder: str, output_format: str, backend: str = 'morph') -> str:
+    sources = [
+        os.path.join(main_folder, PYTHON_FOLDER, UDF_FILENAME),
+        generateRules.__file__,
+        template_manager.__file__,
+        udf_folding.__file__,
+    ]
+    if backend == 'native':
+        sources.append(native_backend.__file__)
+    return build_cache.build_key(build_cache.hash_files(sources), importlib.metadata.version('morph_kgc'),
+                                 output_format, backend)
+
+
+# Returns the build cache key of a field: the environment, the field, the project folder, the intermediate format
+# and the content of its group.
+def field_cache_key(environment: str, field_id: str, group: pd.DataFrame, main_folder: str,
+                    intermediate_format: str = 'csv') -> str:
+    return build_cache.build_key(environment, field_id, os.path.normpath(main_folder), intermediate_format,
+                                 build_cache.hash_group(group))
+
+
+# Exports the data of a field, generates its rules and materializes it. When environment is given, the rules and
+# the instance file are restored from the build cache if an entry has the same key, and saved to it otherwise.
+# The key covers the group content, which includes the mapping rows of the field, so unchanged fields are
+# neither regenerated nor re-materialized. force skips the lookup but still refreshes the cache.
+# When record is given, the time of each step is added to it, and with profile_path the field runs under cProfile.
+# Returns True on a cache hit.
+def materialize_field(field_id: str,
+                      group: pd.DataFrame,
+                      main_folder: str,
+                      number_of_processes: int = None,
+                      output_format: str = 'turtle',
+                      intermediate_format: str = 'csv',
+                      environment: str = None,
+                      force: bool = False,
+                      backend: str = 'morph',
+                      record: dict = None,
+                      profile_path: str = None) -> bool:
+
+    csv_folder = os.path.join(main_folder, CSV_FOLDER)
+    cache_folder = os.path.join(main_folder, CACHE_FOLDER)
+    cached_files = list(field_output_paths(field_id, main_folder, output_format))
+    seconds = record['seconds'] if record is not None else None
+
+    if environment is not None:
+        with profiling.timed(seconds, 'cache'):
+            key = field_cache_key(environment, field_id, group, main_folder, intermediate_format)
+            hit = not force and build_cache.lookup(cache_folder, key, cached_files)
+        if hit:
+            if record is not None:
+                record['cache_hit'] = True
+            return True
+
+    with profiling.profiled(profile_path):
+        with profiling.timed(seconds, 'export'):
+            group_csv = GROUP_EXPORTERS[intermediate_format](group, csv_folder, field_id)
+        try:
+            generate_yarrrml_and_serialize(field_id, group, group_csv, main_folder, number_of_processes,
+                                           output_format, backend, record)
+        finally:
+            release_memory_sources(field_id)
+
+    if environment is not None:
+        with profiling.timed(seconds, 'cache'):
+            build_cache.store(cache_folder, key, cached_files)
+    return False
+
+
+# Exports the distinct case ids and contexts of the valid fields, as returned by generateRules.build_shared_data.
+# Returns the paths of the cases and of the contexts data files.
+def export_shared_data(shared_data: dict, csv_folder: str, intermediate_format: str = 'csv'):
+    export_group = GROUP_EXPORTERS[intermediate_format]
+    return (export_group(shared_data['cases'], csv_folder, f"{SHARED_NAME}_cases"),
+            export_group(shared_data['contexts'], csv_folder, f"{SHARED_NAME}_contexts"))
+
+
+# Generates the mappings that are the same for every field (the case, context and procedure mappings) over the
+# distinct case ids and contexts of all the fields, and materializes them once into their own instance file, instead
+# of once per field. Uses the build cache like materialize_field, keyed by the shared data.
+# Returns True on a cache hit.
+def materialize_shared(frames,
+                       main_folder: str,
+                       output_format: str = 'turtle',
+                       intermediate_format: str = 'csv',
+                       environment: str = None,
+                       force: bool = False,
+                       backend: str = 'morph',
+                       record: dict = None,
+                       profile_path: str = None) -> bool:
+
+    csv_folder = os.path.join(main_folder, CSV_FOLDER)
+    cache_folder = os.path.join(main_folder, CACHE_FOLDER)
+    udf_path = os.path.join(main_folder, PYTHON_FOLDER, UDF_FILENAME)
+    mapping_path, output_path = field_output_paths(SHARED_NAME, main_folder, output_format)
+    seconds = record['seconds'] if record is not None else None
+
+    with profiling.timed(seconds, 'export'):
+        shared_data = generateRules.build_shared_data(frames)
+    if shared_data['cases'].empty:
+        return False
+    if record is not None:
+        record['rows'] = len(shared_data['cases']) + len(shared_data['contexts'])
+
+    if environment is not None:
+        with profiling.timed(seconds, 'cache'):
+            key = build_cache.build_key(environment, SHARED_NAME, os.path.normpath(main_folder), intermediate_format,
+                                        build_cache.hash_group(shared_data['cases']),
+                                        build_cache.hash_group(shared_data['contexts']),
+                                        '\n'.join(shared_data['procedures']))
+            hit = not force and build_cache.lookup(cache_folder, key, [mapping_path, output_path])
+        if hit:
+            if record is not None:
+                record['cache_hit'] = True
+            return True
+
+    with profiling.profiled(profile_path):
+        with profiling.timed(seconds, 'export'):
+            cases_path, contexts_path = export_shared_data(shared_data, csv_folder, intermediate_format)
+        try:
+            with profiling.timed(seconds, 'rule_generation'):
+                yarrrml = generateRules.generate_shared_yarrrml(shared_data, cases_path, contexts_path, udf_path)
+                generateRules.write_yarrrml(yarrrml, mapping_path)
+        except Exception as e:
+            raise RuntimeError(f"Error when generating the shared rules: {e}")
+        try:
+            materialize_and_serialize(udf_path, mapping_path, None, output_path, output_format, "the shared mappings",
+                                      backend, record)
+        finally:
+            release_memory_sources(f"{SHARED_NAME}_cases", f"{SHARED_NAME}_contexts")
+
+    if environment is not None:
+        with profiling.timed(seconds, 'cache'):
+            build_cache.store(cache_folder, key, [mapping_path, output_path])
+    return False
+
 
+# Generates a single YARRRML document with the rules of every field, materializes it with one morph_kgc call
+# (using its internal multi-process option) or with the native backend, and serializes the result to TTL or N-Triples.
+# When record is given, the time of each step is added to it, and with profile_path the catalogue runs under cProfile.
+def generate_catalogue_and_serialize(groups, main_folder: str, number_of_processes: int,
+                                     output_format: str = 'turtle', intermediate_format: str = 'csv',
+                                     backend: str = 'morph', record: dict = None, profile_path: str = None) -> str:
+
+    csv_folder = os.path.join(main_folder, CSV_FOLDER)
+    rules_dir = os.path.join(main_folder, RULES_FOLDER)
+    python_dir = os.path.join(main_folder, PYTHON_FOLDER)
+    instances_dir = os.path.join(main_folder, INSTANCES_FOLDER)
+
+    udf_path = os.path.join(python_dir, UDF_FILENAME)
+    export_group = GROUP_EXPORTERS[intermediate_format]
+    mapping_path = os.path.join(rules_dir, f"{CATALOGUE_NAME}_reglasgenericas.yarrrml")
+    output_path = os.path.join(instances_dir, f"{CATALOGUE_NAME}_output{OUTPUT_EXTENSIONS[output_format]}")
+
+    seconds = record['seconds'] if record is not None else None
+
+    with profiling.profiled(profile_path):
+        with profiling.timed(seconds, 'export'):
+            field_sources = []
+            field_ids = []
+            for field_id, group in groups:
+                field_sources.append((group, export_group(group, csv_folder, field_id)))
+                field_ids.append(field_id)
+
+            if not field_sources:
+                raise RuntimeError("There are no valid fields to materialize")
+
+            # The shared template only has to see the rows of the valid fields, and the case, context and procedure
+            # mappings only their distinct case ids and contexts
+            catalogue_data = pd.concat([group for group, _ in field_sources])
+            catalogue_csv = export_group(catalogue_data, csv_folder, CATALOGUE_NAME)
+            shared_data = generateRules.build_shared_data(group for group, _ in field_sources)
+            shared_sources = (shared_data, *export_shared_data(shared_data, csv_folder, intermediate_format))
+        if record is not None:
+            record['rows'] = len(catalogue_data)
+
+        try:
+            try:
+                with profiling.timed(seconds, 'rule_generation'):
+                    yarrrml = generateRules.generate_catalogue_yarrrml(field_sources, catalogue_csv,
+                                                                       udf_path=udf_path,
+                                                                       shared_sources=shared_sources)
+                    generateRules.write_yarrrml(yarrrml, mapping_path)
+            except Exception as e:
+                raise RuntimeError(f"Error when generating the catalogue rules: {e}")
+
+            return materialize_and_serialize(udf_path, mapping_path, number_of_processes, output_path,
+                                             output_format, "the catalogue", backend, record)
+        finally:
+            release_memory_sources(*field_ids, CATALOGUE_NAME, f"{SHARED_NAME}_cases", f"{SHARED_NAME}_contexts")
+
+
+# Processes a single field inside a worker process. Errors are returned instead of raised,
+# so that a failing field is logged and skipped like in the serial loop. Also returns the profiling record of the field.
+def process_field_in_worker(field_id: str, group: pd.DataFrame, main_folder: str, output_format: str,
+                            intermediate_format: str = 'csv', environment: str = None, force: bool = False,
+                            backend: str = 'morph', profile_folder: str = None):
+    record = profiling.new_field_record(len(group))
+    try:
+        hit = materialize_field(field_id, group, main_folder, 1, output_format, intermediate_format,
+                                environment, force, backend, record, profiling.profile_path(profile_folder, field_id))
+        error = None
+    except (RuntimeError, OSError) as e:
+        hit = False
+        error = str(e)
+    record['error'] = error
+    record['pid'] = os.getpid()
+    record['peak_rss_mb'] = round(peak_rss_mb(), 1)
+    return field_id, error, hit, os.getpid(), peak_rss_mb(), record
+
+
+# Processes every field in a pool of warm worker processes, scheduling the largest groups first
+# so that a big field does not start last and hold up the run. Prints the peak memory of each worker.
+# When report is given, the profiling record of each field is added to it. The mapping cache lookups of the
+# workers are added to those of this process. Returns the number of cache hits and the fields that failed.
+def process_fields_in_parallel(groups, main_folder: str, workers: int, output_format: str = 'turtle',
+                               intermediate_format: str = 'csv', environment: str = None, force: bool = False,
+                               backend: str = 'morph', report: dict = None, profile_folder: str = None):
+    groups = sorted(groups, key=lambda item: len(item[1]), reverse=True)
+    worker_stats = {}
+    hits = 0
+    failed_fields = []
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=cache_udf_loading) as executor:
+        futures = [executor.submit(process_field_in_worker, field_id, group, main_folder, output_format,
+                                   intermediate_format, environment, force, backend, profile_folder)
+                   for field_id, group in groups]
+        for future in as_completed(futures):
+            field_id, error, hit, pid, rss_mb, record = future.result()
+            if error is not None:
+                print(f"Exiting '{field_id}' due to: {error}", file=sys.stderr)
+                failed_fields.append(field_id)
+            hits += hit
+            if 'mapping_cache' in record:
+                mapping_cache.add_stats(record['mapping_cache'])
+            if report is not None:
+                report['fields'][field_id] = record
+
+            fields, peak = worker_stats.get(pid, (0, 0.0))
+            worker_stats[pid] = (fields + 1, max(peak, rss_mb))
+
+    for pid, (fields, peak) in sorted(worker_stats.items()):
+        print(f"Worker {pid}: {fields} fields, peak RSS {peak:.1f} MB")
+    return hits, failed_fields
+
+
+# Processes every field in a pipeline of three stages connected by bounded queues: a thread looks up the build
+# cache, exports the data of each field and generates its rules, this thread materializes them, and another thread
+# serializes the triples and stores the field in the build cache. While a field is materialized, the next one is
+# prepared and the previous one written. queue_size caps the fields waiting between two stages, and with them the
+# triples held in memory. morph_kgc runs in this process, without its pool of processes. Fields that fail are
+# reported and skipped. When report is given, the profiling record of each field is added to it. Returns the number
+# of valid fields and of cache hits, and the fields that failed.
+def process_fields_in_pipeline(groups, main_folder: str, output_format: str = 'turtle',
+                               intermediate_format: str = 'csv', environment: str = None, force: bool = False,
+                               backend: str = 'morph', report: dict = None, queue_size: int = PIPELINE_QUEUE_SIZE):
+    csv_folder = os.path.join(main_folder, CSV_FOLDER)
+    cache_folder = os.path.join(main_folder, CACHE_FOLDER)
+    udf_path = os.path.join(main_folder, PYTHON_FOLDER, UDF_FILENAME)
+    to_materialize = queue.Queue(maxsize=queue_size)
+    to_serialize = queue.Queue(maxsize=queue_size)
+    counts = {'fields': 0, 'hits': 0}
+    failed_fields = []
+    errors = []
+
+    def skip(field_id, record, error):
+        print(f"Exiting '{field_id}' due to: {error}", file=sys.stderr)
+        failed_fields.append(field_id)
+        if record is not None:
+            record['error'] = str(error)
+            record['peak_rss_mb'] = round(peak_rss_mb(), 1)
+
+    def prepare():
+        try:
+            for field_id, group in groups:
+                counts['fields'] += 1
+                record = profiling.new_field_record(len(group)) if report is not None else None
+                if record is not None:
+                    report['fields'][field_id] = record
+                seconds = record['seconds'] if record is not None else None
+                mapping_path, output_path = field_output_paths(field_id, main_folder, output_format)
+                key = None
+                if environment is not None:
+                    with profiling.timed(seconds, 'cache'):
+                        key = field_cache_key(environment, field_id, group, main_folder, intermediate_format)
+                        hit = not force and build_cache.lookup(cache_folder, key, [mapping_path, output_path])
+                    if hit:
+                        counts['hits'] += 1
+                        if record is not None:
+                            record['cache_hit'] = True
+                            record['peak_rss_mb'] = round(peak_rss_mb(), 1)
+                        continue
+                try:
+                    with profiling.timed(seconds, 'export'):
+                        group_csv = GROUP_EXPORTERS[intermediate_format](group, csv_folder, field_id)
+                    generate_field_rules(field_id, group, group_csv, mapping_path, udf_path, record)
+                except (RuntimeError, OSError) as e:
+                    release_memory_sources(field_id)
+                    skip(field_id, record, e)
+                    continue
+                to_materialize.put((field_id, mapping_path, output_path, key, record))
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            to_materialize.put(None)
+
+    def serialize():
+        while True:
+            item = to_serialize.get()
+            if item is None:
+                return
+            field_id, triples, mapping_path, output_path, key, record = item
+            seconds = record['seconds'] if record is not None else None
+            try:
+                with profiling.timed(seconds, 'serialization'):
+                    serialize_triples(triples, output_path, output_format, f"'{field_id}'")
+                if key is not None:
+                    with profiling.timed(seconds, 'cache'):
+                        build_cache.store(cache_folder, key, [mapping_path, output_path])
+            except Exception as e:
+                # Keeps draining the queue, so that the materialization never blocks on a stopped stage
+                skip(field_id, record, e)
+                continue
+            if record is not None:
+                record['peak_rss_mb'] = round(peak_rss_mb(), 1)
+
+    preparer = threading.Thread(target=prepare, name='prepare', daemon=True)
+    serializer = threading.Thread(target=serialize, name='serialize', daemon=True)
+    preparer.start()
+    serializer.start()
+    try:
+        while True:
+            item = to_materialize.get()
+            if item is None:
+                break
+            field_id, mapping_path, output_path, key, record = item
+            try:
+                # A morph_kgc pool would fork this process while the other stages hold their locks
+                triples = materialize_and_record(udf_path, mapping_path, 1, f"'{field_id}'", backend, record)
+            except RuntimeError as e:
+                skip(field_id, record, e)
+                continue
+            finally:
+                release_memory_sources(field_id)
+            to_serialize.put((field_id, triples, mapping_path, output_path, key, record))
+    finally:
+        to_serialize.put(None)
+    preparer.join()
+    serializer.join()
+    if errors:
+        raise errors[0]
+    return counts['fields'], counts['hits'], failed_fields
+
+
+# Removes the instance files left by a previous run, so that an incremental run only combines the new cases.
+def clear_instance_files(instances_folder: str):
     for filename in os.listdir(instances_folder):
-        if filename.endswith('.ttl'):
-            file_path = os.path.join(instances_folder, filename)
+        if filename.endswith(tuple(OUTPUT_EXTENSIONS.values())):
+            os.remove(os.path.join(instances_folder, filename))
+
+
+# Returns the reference rows of the incremental runs (see sharding.reference_rows): those of the previous runs, read
+# from reference_path, and then those of the new preprocessed rows, so that each field keeps the first row a full run
+# over every case would generate its rules from.
+def incremental_reference_rows(reference_path: str, df: pd.DataFrame) -> pd.DataFrame:
+    new_reference = sharding.reference_rows(df)
+    if not os.path.isfile(reference_path):
+        return new_reference
+    previous = pd.read_csv(reference_path, keep_default_na=False)
+    return sharding.reference_rows(pd.concat([previous, new_reference], ignore_index=True))
+
+
+# Adds before the preprocessed rows the reference rows of their fields that belong to the cases of previous runs.
+# Returns the rows and the ids of those cases.
+def prepend_reference_rows(df: pd.DataFrame, reference: pd.DataFrame):
+    reference_cases = reference[CASE_ID_COLUMN].astype(str)
+    foreign = reference[reference['field_id'].isin(df['field_id'].unique())
+                        & ~reference_cases.isin(df[CASE_ID_COLUMN].astype(str).unique())]
+    if foreign.empty:
+        return df, set()
+    return pd.concat([foreign, df], ignore_index=True), set(foreign[CASE_ID_COLUMN].astype(str))
+
+
+# Removes from the instance files the triples of the reference rows of previous runs, which the output already has,
+# so that only the triples of the new cases are appended to it. Files that cannot be parsed are left for the
+# combination to report.
+def drop_reference_triples(instances_folder: str, case_ids: set, foreign_ids: set):
+    for filename in os.listdir(instances_folder):
+        file_path = os.path.join(instances_folder, filename)
+        if filename.endswith(OUTPUT_EXTENSIONS['ntriples']):
+            with open(file_path, 'r', encoding='utf-8') as instance_file:
+                lines = instance_file.read().splitlines()
+            with open(file_path, 'w', encoding='utf-8') as instance_file:
+                instance_file.writelines(f"{line}\n" for line in sharding.own_lines(lines, case_ids, foreign_ids))
+        elif filename.endswith(OUTPUT_EXTENSIONS['turtle']):
+            graph = rdflib.Graph()
             try:
-                combined_graph.parse(file_path, format='turtle')
+                graph.parse(file_path, format='turtle')
             except Exception:
-                pass
+                continue
+            triples = {' '.join(term.n3() for term in triple) + ' .': triple for triple in graph}
+            for line in set(triples) - set(sharding.own_lines(list(triples), case_ids, foreign_ids)):
+                graph.remove(triples[line])
+            graph.serialize(file_path, format='turtle')
+
+
+# Appends the case ids of the materialized data to the state file of incremental runs, one per line. The cases with
+# rows in a field that failed are left out, so that the next incremental run materializes them again.
+# Returns the number of cases left out.
+def record_emitted_cases(state_path: str, df: pd.DataFrame, failed_fields=()) -> int:
+    case_ids = df[CASE_ID_COLUMN].astype(str)
+    failed_cases = set(case_ids[df['field_id'].isin(failed_fields)])
+    with open(state_path, 'a', encoding='utf-8') as state_file:
+        for case_id in pd.unique(case_ids):
+            if case_id not in failed_cases:
+                state_file.write(f"{case_id}\n")
+    return len(failed_cases)
+
+
+# Reads all .ttl files in the specified folder and combines them into a single RDF graph.
+# With append, the graph is added at the end of an existing output file: Turtle allows prefix directives
+# anywhere in a document, and the generated RDF has no blank nodes whose labels could clash.
+def combine_ttl_files(instances_folder: str, combined_output_file: str, append: bool = False):
+    file_paths = [os.path.join(instances_folder, filename) for filename in os.listdir(instances_folder)
+                  if filename.endswith('.ttl')]
+    combine_ttl_paths(file_paths, combined_output_file, append)
+
+
+# Combines the given Turtle files into a single RDF graph, like combine_ttl_files.
+def combine_ttl_paths(file_paths, combined_output_file: str, append: bool = False):
+
+    combined_graph = rdflib.Graph()
+
+    for file_path in file_paths:
+        try:
+            combined_graph.parse(file_path, format='turtle')
+        except Exception as e:
+            print(f"Skipping '{file_path}', it could not be parsed: {e}", file=sys.stderr)
+
+    if append and os.path.isfile(combined_output_file):
+        with open(combined_output_file, 'a', encoding='utf-8') as output_file:
+            output_file.write('\n' + combined_graph.serialize(format='turtle'))
+    else:
+        combined_graph.serialize(destination=combined_output_file, format='turtle')
+
+
+# Reads the lines of all .nt files in the specified folder. Lines that are not valid N-Triples are
+# reported, added to invalid_lines and skipped.
+def read_nt_lines(instances_folder: str, invalid_lines: list):
+    return read_nt_paths(instance_nt_paths(instances_folder), invalid_lines)
+
+
+# Returns the .nt files in the specified folder, sorted by name.
+def instance_nt_paths(instances_folder: str):
+    return [os.path.join(instances_folder, filename) for filename in sorted(os.listdir(instances_folder))
+            if filename.endswith('.nt')]
+
+
+# Reads the lines of the given N-Triples files in order, like read_nt_lines.
+def read_nt_paths(file_paths, invalid_lines: list):
+    for file_path in file_paths:
+        with open(file_path, 'r', encoding='utf-8') as input_file:
+            for line_number, line in enumerate(input_file, start=1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                if not NTRIPLES_LINE_PATTERN.match(line):
+                    print(f"Skipping line {line_number} of '{file_path}', it is not valid N-Triples: {line[:200]}",
+                          file=sys.stderr)
+                    invalid_lines.append((file_path, line_number))
+                    continue
+                yield line
+
+
+# Concatenates all .nt files in the specified folder into a single N-Triples file, line by line,
+# so memory does not grow with the number of triples. Lines that are not valid N-Triples are reported and skipped.
+# When memory_budget_mb is given, duplicate triples are removed using at most that much memory for the seen set,
+# spilling to disk when needed. With append, the lines are added at the end of an existing output file.
+# Returns the number of invalid lines and the deduplication statistics.
+def combine_nt_files(instances_folder: str, combined_output_file: str, memory_budget_mb: float = None,
+                     append: bool = False):
+    return combine_nt_paths(instance_nt_paths(instances_folder), combined_output_file, memory_budget_mb, append)
+
+
+# Concatenates the given N-Triples files, in order, into a single N-Triples file, like combine_nt_files.
+def combine_nt_paths(file_paths, combined_output_file: str, memory_budget_mb: float = None, append: bool = False):
+    invalid_lines = []
+    lines = read_nt_paths(file_paths, invalid_lines)
+    stats = None
+
+    with open(combined_output_file, 'a' if append else 'w', encoding='utf-8') as output_file:
+        if memory_budget_mb is None:
+            for line in lines:
+                output_file.write(line + '\n')
+        else:
+            input_bytes = sum(os.path.getsize(file_path) for file_path in file_paths)
+            stats = dedup.deduplicate_lines(lines, output_file, input_bytes, memory_budget_mb,
+                                            spill_folder=os.path.dirname(os.path.abspath(combined_output_file)))
+
+    return len(invalid_lines), stats
 
-    combined_graph.serialize(destination=combined_output_file, format='turtle')
 
 def main():
 
     parser = argparse.ArgumentParser(description='RDF Generation using preprocessed CSV')
     parser.add_argument('main_folder', type=str, help='Path to the project root directory')
+    parser.add_argument('--mode', choices=['field', 'catalogue'], default='field',
+                        help='Materialize each field separately, or every field in a single morph_kgc call')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help='Number of morph_kgc processes used in catalogue mode')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of worker processes used to materialize fields in parallel')
+    parser.add_argument('--pipeline', type=int, nargs='?', const=PIPELINE_QUEUE_SIZE, default=None, metavar='SIZE',
+                        help='Overlap the export and rule generation, the materialization and the serialization of '
+                             'consecutive fields in threads connected by queues of SIZE fields (default '
+                             f'{PIPELINE_QUEUE_SIZE})')
+    parser.add_argument('--output-format', choices=sorted(OUTPUT_EXTENSIONS), default='turtle',
+                        help='Format of the instance files and of the combined output')
+    parser.add_argument('--dedup-memory-mb', type=float, default=DEDUP_MEMORY_MB,
+                        help='Memory budget for removing duplicate triples from the N-Triples output, 0 to keep them')
+    parser.add_argument('--intermediate-format', choices=INTERMEDIATE_FORMATS, default='csv',
+                        help='Format of the preprocessed data and of the per-field data files (parquet requires pyarrow)')
+    parser.add_argument('--in-memory', action='store_true',
+                        help='Hand the data of each field to the backend in memory, instead of writing it to csv/ '
+                             'for the backend to read it back')
+    parser.add_argument('--force', action='store_true',
+                        help='Regenerate and re-materialize every field even if the build cache has it')
+    parser.add_argument('--cache-max-mb', type=float, default=CACHE_MAX_MB,
+                        help='Size cap of the build cache, least recently used entries are evicted, 0 to disable it')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Append the triples of the preprocessed cases to the existing output, and record '
+                             'those cases so that dataPreprocessing.py --incremental-state skips them next time')
+    parser.add_argument('--backend', choices=BACKENDS, default='morph',
+                        help='Materialize the rules with morph_kgc, or with the native backend that evaluates the '
+                             'generated YARRRML with vectorized string building and writes the triples directly')
+    parser.add_argument('--udf-cache', type=int, nargs='?', const=UDF_CACHE_SIZE, default=None, metavar='SIZE',
+                        help='Memoize the results of the UDFs, keeping SIZE results per function, and print the '
+                             'calls, cache hits and time of each UDF at the end. 0 only counts the calls')
+    parser.add_argument('--profile-report', type=str, default=None, metavar='PATH',
+                        help='Write a JSON report with the time of each stage and, for each field, the time of '
+                             'each step, its row and triple counts and the peak memory')
+    parser.add_argument('--profile-fields', type=int, default=0, metavar='N',
+                        help='With --profile-report, run every field under cProfile and keep the dumps of the N '
+                             'slowest ones in a folder named after the report')
+    parser.add_argument('--shard-index', type=int, default=None,
+                        help='Only materialize the cases of this shard, in the shards/shard-<i>-of-<n> folder')
+    parser.add_argument('--shard-count', type=int, default=None,
+                        help='Number of shards the cases are split into by a hash of their case id')
     args = parser.parse_args()
+    if args.pipeline is not None and (args.mode != 'field' or args.workers):
+        parser.error("--pipeline only applies to the field mode without --workers")
+    if args.pipeline is not None and args.pipeline < 1:
+        parser.error("--pipeline needs a queue size of at least 1")
+    if args.pipeline is not None and args.profile_fields > 0:
+        parser.error("--profile-fields cannot profile the threads of --pipeline")
+    shard = sharding.check_shard_arguments(parser, args)
     main_folder = args.main_folder
+    if shard is not None:
+        # A shard only reads the project folder, and writes everything to its own folder
+        main_folder = sharding.prepare_shard_folder(args.main_folder, shard)
+
+    report = profile_folder = None
+    if args.profile_report:
+        report = profiling.new_report('initiate.py')
+        if args.profile_fields > 0:
+            profile_folder = os.path.splitext(args.profile_report)[0] + '_profiles'
+            os.makedirs(profile_folder, exist_ok=True)
 
     # 1. Additional directories verification and creation
     check_or_create_directories(main_folder)
 
-    # 2. Load preprocessed CSV file
+    # 2. Load preprocessed data file
     try:
-        df = load_preprocessed_csv(main_folder)
+        with profiling.stage(report, 'load_preprocessed') as entry:
+            if shard is not None:
+                df = load_shard_data(args.main_folder, args.intermediate_format, shard)
+            else:
+                df = PREPROCESSED_LOADERS[args.intermediate_format](main_folder)
+            entry['rows'] = len(df)
     except Exception as e:
-        print(f"Error when loading the preprocessed data CSV file: {e}", file=sys.stderr)
-        sys.exit(1)
+        if args.incremental and isinstance(e, pd.errors.EmptyDataError):
+            df = pd.DataFrame()
+        else:
+            print(f"Error when loading the preprocessed data {args.intermediate_format} file: {e}", file=sys.stderr)
+            sys.exit(1)
+
+    # In incremental mode the preprocessed data only has the new cases, and their triples are appended to the output
+    # of the previous runs. The rules of each field are generated from the reference rows of every run, as in a full
+    # run, and the triples of those of previous cases are dropped before appending.
+    instances_folder = os.path.join(main_folder, INSTANCES_FOLDER)
+    if args.incremental:
+        if df.empty:
+            print("There are no new cases to materialize")
+            return
+        clear_instance_files(instances_folder)
+        # The reference rows of other shards are not emitted by this one
+        emitted_df = sharding.select_shard(df, shard)
+        case_ids = set(df[CASE_ID_COLUMN].astype(str))
+        reference_path = os.path.join(main_folder, REFERENCE_ROWS_FILENAME)
+        reference = incremental_reference_rows(reference_path, df)
+        df, reference_ids = prepend_reference_rows(df, reference)
 
     # 3. Process each group of data
-    for field_id, group in filter_valid_groups(df):
-        csv_folder = os.path.join(main_folder, CSV_FOLDER)
-        group_csv = export_group_to_csv(group, csv_folder, field_id)
+    cache_udf_loading()
+    if args.udf_cache is not None:
+        udf_cache.install(args.udf_cache)
+    environment = None
+    if args.cache_max_mb > 0:
+        environment = cache_environment(main_folder, args.output_format, args.backend)
+        if args.backend == 'morph':
+            mapping_cache.install(os.path.join(main_folder, CACHE_FOLDER))
+    # The data of each field is written in the intermediate format, unless it is handed to the backend in memory
+    data_format = 'memory' if args.in_memory else args.intermediate_format
+    valid_fields = hits = 0
+    failed_fields = []
+    with profiling.stage(report, 'materialize'):
+        if args.mode == 'field':
+            # The mappings shared by every field are materialized once, before the fields
+            record = profiling.new_field_record(0) if report is not None else None
+            try:
+                materialize_shared((group for _, group in filter_valid_groups(df)), main_folder, args.output_format,
+                                   data_format, environment, args.force, args.backend, record,
+                                   profiling.profile_path(profile_folder, SHARED_NAME))
+            except RuntimeError as e:
+                print(f"Exiting due to: {e}", file=sys.stderr)
+                sys.exit(1)
+            if record is not None:
+                record['peak_rss_mb'] = round(peak_rss_mb(), 1)
+                report['fields'][SHARED_NAME] = record
 
-        try:
-            generate_yarrrml_and_serialize(field_id, group_csv, main_folder)
-        except RuntimeError as e:
-            print(f"Exiting '{field_id}' due to: {e}", file=sys.stderr)
-            continue
+        if args.mode == 'catalogue':
+            record = profiling.new_field_record(0) if report is not None else None
+            try:
+                generate_catalogue_and_serialize(filter_valid_groups(df), main_folder, args.processes,
+                                                 args.output_format, data_format, args.backend,
+                                                 record, profiling.profile_path(profile_folder, CATALOGUE_NAME))
+            except RuntimeError as e:
+                print(f"Exiting due to: {e}", file=sys.stderr)
+                sys.exit(1)
+            if record is not None:
+                record['peak_rss_mb'] = round(peak_rss_mb(), 1)
+                report['fields'][CATALOGUE_NAME] = record
+        elif args.pipeline is not None:
+            valid_fields, hits, failed_fields = process_fields_in_pipeline(filter_valid_groups(df), main_folder,
+                                                                           args.output_format, data_format,
+                                                                           environment, args.force, args.backend,
+                                                                           report, args.pipeline)
+        elif args.workers:
+            groups = list(filter_valid_groups(df))
+            valid_fields = len(groups)
+            hits, failed_fields = process_fields_in_parallel(groups, main_folder, args.workers, args.output_format,
+                                                             data_format, environment, args.force, args.backend,
+                                                             report, profile_folder)
+        else:
+            for field_id, group in filter_valid_groups(df):
+                valid_fields += 1
+                record = profiling.new_field_record(len(group)) if report is not None else None
+                try:
+                    hits += materialize_field(field_id, group, main_folder, output_format=args.output_format,
+                                              intermediate_format=data_format,
+                                              environment=environment, force=args.force, backend=args.backend,
+                                              record=record,
+                                              profile_path=profiling.profile_path(profile_folder, field_id))
+                except RuntimeError as e:
+                    print(f"Exiting '{field_id}' due to: {e}", file=sys.stderr)
+                    failed_fields.append(field_id)
+                    if record is not None:
+                        record['error'] = str(e)
+                if record is not None:
+                    record['peak_rss_mb'] = round(peak_rss_mb(), 1)
+                    report['fields'][field_id] = record
 
-    # 4. Combine TTL files into a single output file
-    instances_folder = os.path.join(main_folder, INSTANCES_FOLDER)
-    combined_output_file = os.path.join(main_folder, FINAL_OUTPUT_FILENAME)
-    combine_ttl_files(instances_folder, combined_output_file)
+    if environment is not None:
+        removed, cache_bytes = build_cache.evict(os.path.join(main_folder, CACHE_FOLDER), args.cache_max_mb)
+        if args.mode == 'field':
+            print(f"Build cache: {hits} of {valid_fields} fields reused, {removed} entries evicted, "
+                  f"{cache_bytes / 1024 / 1024:.1f} MB in use")
+        if mapping_cache.cache_folder is not None:
+            print(mapping_cache.format_stats(mapping_cache.stats))
+
+    # 4. Combine the instance files into a single output file
+    with profiling.stage(report, 'combine'):
+        if args.incremental and reference_ids:
+            drop_reference_triples(instances_folder, case_ids, reference_ids)
+        if args.output_format == 'ntriples':
+            combined_output_file = os.path.join(main_folder, FINAL_NT_OUTPUT_FILENAME)
+            memory_budget_mb = args.dedup_memory_mb or None
+            invalid_lines, stats = combine_nt_files(instances_folder, combined_output_file, memory_budget_mb,
+                                                    append=args.incremental)
+            if invalid_lines:
+                print(f"{invalid_lines} invalid N-Triples lines were skipped", file=sys.stderr)
+            if stats is not None:
+                print(f"Removed {stats['duplicates']} duplicate triples out of {stats['lines']} "
+                      f"using {stats['partitions']} partitions, peak RSS {peak_rss_mb():.1f} MB")
+        else:
+            combined_output_file = os.path.join(main_folder, FINAL_OUTPUT_FILENAME)
+            combine_ttl_files(instances_folder, combined_output_file, append=args.incremental)
+
+    # 5. Record the cases that are now in the output
+    if args.incremental:
+        left_out = record_emitted_cases(os.path.join(main_folder, EMITTED_CASES_FILENAME), emitted_df,
+                                        failed_fields)
+        reference.to_csv(reference_path, index=False)
+        if left_out:
+            print(f"{left_out} cases with fields that failed were not recorded, the next incremental run "
+                  f"materializes them again", file=sys.stderr)
+
+    # 6. Report the time spent in each UDF
+    if args.udf_cache is not None:
+        print(udf_cache.format_stats(udf_cache.read_stats()))
+
+    # 7. Write the profiling report, keeping the cProfile dumps of the slowest fields
+    if report is not None:
+        if profile_folder is not None:
+            report['profiles'] = profiling.keep_slowest_profiles(report, profile_folder, args.profile_fields)
+        profiling.write_report(report, args.profile_report)
+        print(f"Profiling report written to '{args.profile_report}'")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,169 @@
+import importlib.metadata
+import os
+import pickle
+import re
+import shutil
+import tempfile
+import time
+
+import morph_kgc
+from morph_kgc.mapping.mapping_parser import retrieve_mappings
+
+import build_cache
+
+# Data sources of the generated rules. Rules that only differ in their data sources share an entry.
+SOURCE_PATTERN = re.compile(r"\['([^'\n]+)~csv'\]")
+SOURCE_PLACEHOLDER = 'MAPPINGCACHESOURCE{}'
+ENTRY_FILENAME = 'mappings.pkl'
+# Options of morph_kgc that do not change the parsed mappings, left out of the key so that every field of a run
+# shares the entries whatever the number of processes
+IGNORED_OPTIONS = {'number_of_processes', 'output_format', 'output_file', 'output_dir', 'logging_level',
+                   'logging_file'}
+
+# Lookups, and seconds spent parsing on misses and loading on hits, in the current process
+stats = {'hits': 0, 'misses': 0, 'parse_seconds': 0.0, 'load_seconds': 0.0}
+cache_folder = None
+
+
+def normalize_sources(text):
+    """
+    Replaces the data sources of a YARRRML document by numbered placeholders, in order of appearance. The
+    placeholders of in-memory data sources keep their braces, as morph_kgc reads them differently from files.
+    Returns:
+        tuple: The normalized text and the list of data sources.
+    """
+
+    sources = list(dict.fromkeys(SOURCE_PATTERN.findall(text)))
+    numbers = {source: number for number, source in enumerate(sources)}
+
+    def placeholder(match):
+        source = match.group(1)
+        name = SOURCE_PLACEHOLDER.format(numbers[source])
+        if source.startswith('{') and source.endswith('}'):
+            name = '{' + name + '}'
+        return f"['{name}~csv']"
+
+    return SOURCE_PATTERN.sub(placeholder, text), sources
+
+
+def mapping_key(config):
+    """
+    Returns the cache key of the mappings of a morph_kgc configuration, and the data sources of its mapping files.
+    The key covers the mapping files without their data sources, the options that change the parsing and the
+    morph_kgc version.
+    """
+
+    parts = [importlib.metadata.version('morph_kgc')]
+    parts += [f"{option}={value}" for option, value in config.items(config.configuration_section)
+              if option not in IGNORED_OPTIONS]
+    sources = []
+    for section in sorted(config.get_data_sources_sections()):
+        parts += [f"{option}={value}" for option, value in config.items(section) if option != 'mappings']
+        for mapping_path in config.get_mappings_files(section):
+            with open(mapping_path, 'r', encoding='utf-8') as mapping_file:
+                text, mapping_sources = normalize_sources(mapping_file.read())
+            parts.append(text)
+            sources += mapping_sources
+    return build_cache.build_key(*parts), sources
+
+
+def replace_sources(rml_df, replacements):
+    rml_df = rml_df.copy()
+    rml_df['logical_source_value'] = rml_df['logical_source_value'].replace(replacements)
+    return rml_df
+
+
+def load(key, sources):
+    """
+    Returns the parsed mappings of a cache entry with its placeholders replaced by the given data sources, or None
+    if there is no such entry.
+    """
+
+    entry = os.path.join(cache_folder, key)
+    try:
+        with open(os.path.join(entry, ENTRY_FILENAME), 'rb') as entry_file:
+            rml_df, fnml_df, http_api_df, source_count = pickle.load(entry_file)
+    except Exception:
+        # A missing entry, or one written by other versions of pandas
+        return None
+    if source_count != len(sources):
+        return None
+    os.utime(entry)
+    placeholders = {SOURCE_PLACEHOLDER.format(number): source for number, source in enumerate(sources)}
+    return replace_sources(rml_df, placeholders), fnml_df, http_api_df
+
+
+def save(key, sources, mappings):
+    """
+    Saves parsed mappings as a cache entry, with their data sources replaced by placeholders.
+    """
+
+    rml_df, fnml_df, http_api_df = mappings
+    placeholders = {source: SOURCE_PLACEHOLDER.format(number) for number, source in enumerate(sources)}
+    staging = tempfile.mkdtemp(prefix='mappings_')
+    try:
+        with open(os.path.join(staging, ENTRY_FILENAME), 'wb') as entry_file:
+            pickle.dump((replace_sources(rml_df, placeholders), fnml_df, http_api_df, len(sources)), entry_file,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        build_cache.store(cache_folder, key, [os.path.join(staging, ENTRY_FILENAME)])
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+def retrieve_cached_mappings(config):
+    """
+    Drop-in replacement of morph_kgc's retrieve_mappings that reuses the parsed mappings of a previous call with the
+    same mapping files, up to their data sources, and saves them otherwise.
+    """
+
+    try:
+        key, sources = mapping_key(config)
+    except OSError:
+        return retrieve_mappings(config)
+
+    start = time.perf_counter()
+    mappings = load(key, sources)
+    if mappings is not None:
+        stats['hits'] += 1
+        stats['load_seconds'] += time.perf_counter() - start
+        return mappings
+
+    start = time.perf_counter()
+    mappings = retrieve_mappings(config)
+    stats['misses'] += 1
+    stats['parse_seconds'] += time.perf_counter() - start
+    try:
+        save(key, sources, mappings)
+    except (OSError, pickle.PicklingError) as e:
+        print(f"The parsed mappings could not be cached: {e}")
+    return mappings
+
+
+def install(folder):
+    """
+    Makes morph_kgc.materialize_set reuse the mappings parsed by previous calls, persisted as entries of the build
+    cache in folder. Parsing the YARRRML, translating it to RML and partitioning the rules takes most of the time
+    of a morph_kgc call on the rules of a single field. It must be called before worker processes are forked.
+    """
+
+    global cache_folder
+    cache_folder = folder
+    morph_kgc.retrieve_mappings = retrieve_cached_mappings
+
+
+def stats_since(previous):
+    """
+    Returns the counters of the current process since a copy of them was taken.
+    """
+    return {name: value - previous[name] for name, value in stats.items()}
+
+
+def add_stats(other):
+    for name, value in other.items():
+        stats[name] += value
+
+
+def format_stats(totals):
+    lookups = totals['hits'] + totals['misses']
+    return (f"Mapping cache: {totals['hits']} of {lookups} parsed mappings reused, "
+            f"{totals['parse_seconds']:.1f} s parsing, {totals['load_seconds']:.1f} s loading")
@@ -0,0 +1,59 @@
+import argparse
+import os
+import sys
+
+import initiate
+import sharding
+from config import DEDUP_MEMORY_MB, FINAL_NT_OUTPUT_FILENAME, FINAL_OUTPUT_FILENAME
+
+OUTPUT_FILENAMES = {'turtle': FINAL_OUTPUT_FILENAME, 'ntriples': FINAL_NT_OUTPUT_FILENAME}
+
+
+def main(main_folder, shard_count, output_format='turtle', memory_budget_mb=DEDUP_MEMORY_MB):
+    """
+    Combines the outputs of every shard of a run, written by initiate.py --shard-index, into the output of the
+    project, in shard order. The triples that several shards produce, such as the context entities, are written
+    once, so the result has the same triples as a run over every case.
+    Returns:
+        tuple: Path of the merged output, and the deduplication statistics for N-Triples.
+    Raises:
+        FileNotFoundError: If a shard has no output yet.
+    """
+
+    output_filename = OUTPUT_FILENAMES[output_format]
+    shard_paths = sharding.shard_outputs(main_folder, shard_count, output_filename)
+    missing = [path for path in shard_paths if not os.path.isfile(path)]
+    if missing:
+        raise FileNotFoundError(f"{len(missing)} of {shard_count} shards have no output: {', '.join(missing)}")
+
+    output_path = os.path.join(main_folder, output_filename)
+    stats = None
+    if output_format == 'ntriples':
+        invalid_lines, stats = initiate.combine_nt_paths(shard_paths, output_path, memory_budget_mb or None)
+        if invalid_lines:
+            print(f"{invalid_lines} invalid N-Triples lines were skipped", file=sys.stderr)
+    else:
+        initiate.combine_ttl_paths(shard_paths, output_path)
+    return output_path, stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge the RDF outputs of the shards of a run.")
+    parser.add_argument('main_folder', type=str, help='Path to the project root directory')
+    parser.add_argument('--shard-count', type=int, required=True, help='Number of shards of the run')
+    parser.add_argument('--output-format', choices=sorted(OUTPUT_FILENAMES), default='turtle',
+                        help='Format the shards were written in')
+    parser.add_argument('--dedup-memory-mb', type=float, default=DEDUP_MEMORY_MB,
+                        help='Memory budget in MB for removing duplicate N-Triples across shards, 0 keeps them')
+    args = parser.parse_args()
+    if args.shard_count < 1:
+        parser.error("--shard-count must be at least 1")
+    try:
+        path, stats = main(args.main_folder, args.shard_count, args.output_format, args.dedup_memory_mb)
+    except FileNotFoundError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    print(f"Merged {args.shard_count} shards into '{path}'")
+    if stats is not None:
+        print(f"Removed {stats['duplicates']} duplicate triples out of {stats['lines']} "
+              f"using {stats['partitions']} partitions")
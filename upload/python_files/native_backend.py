@@ -0,0 +1,436 @@
+import os
+from urllib.parse import quote
+
+import pandas as pd
+from ruamel.yaml import YAML
+
+import udf_folding
+
+RDF_TYPE = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#type'
+XSD_BOOLEAN = 'http://www.w3.org/2001/XMLSchema#boolean'
+XSD_DATETIME = 'http://www.w3.org/2001/XMLSchema#dateTime'
+XSD_INTEGER = 'http://www.w3.org/2001/XMLSchema#integer'
+XSD_STRING = 'http://www.w3.org/2001/XMLSchema#string'
+
+# Prefixes that morph_kgc adds to every YARRRML document, overriding the declared ones with the same name
+DEFAULT_PREFIXES = {
+    'rml': 'http://w3id.org/rml/',
+    'fno': 'https://w3id.org/function/ontology#',
+    'xsd': 'http://www.w3.org/2001/XMLSchema#',
+    'rdfs': 'http://www.w3.org/2000/01/rdf-schema#',
+    'owl': 'http://www.w3.org/2002/07/owl#',
+    'prov': 'http://www.w3.org/ns/prov#',
+    'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+    'rr': 'http://www.w3.org/ns/r2rml#',
+    'skos': 'http://www.w3.org/2004/02/skos/core#',
+    'dc': 'http://purl.org/dc/terms/',
+    'dcterms': 'http://purl.org/dc/terms/',
+    'foaf': 'http://xmlns.com/foaf/0.1/',
+    'schema': 'http://schema.org/',
+}
+
+# Long and short YARRRML key names
+KEY_NAMES = {
+    'mapping': 'mappings', 'm': 'mappings',
+    'subject': 'subjects', 's': 'subjects',
+    'predicateobject': 'predicateobjects', 'po': 'predicateobjects',
+    'predicate': 'predicates', 'p': 'predicates',
+    'inversepredicate': 'inversepredicates', 'i': 'inversepredicates',
+    'object': 'objects', 'o': 'objects',
+    'graph': 'graphs', 'g': 'graphs',
+    'fn': 'function', 'f': 'function',
+    'pms': 'parameters',
+    'pm': 'parameter',
+    'v': 'value',
+}
+# Keys of a mapping and of a term map that the native backend evaluates
+MAPPING_KEYS = {'sources', 'subjects', 'predicateobjects'}
+TERM_MAP_KEYS = {'value', 'type', 'datatype', 'language', 'function', 'parameters'}
+TERM_TYPES = ('iri', 'literal', 'blanknode')
+
+
+def normalize_keys(node):
+    if isinstance(node, dict):
+        return {KEY_NAMES.get(key, key): normalize_keys(value) for key, value in node.items()}
+    if isinstance(node, list):
+        return [normalize_keys(value) for value in node]
+    return node
+
+
+def expand_prefixes(node, prefixes):
+    """
+    Expands the prefixes of every string of a YARRRML document the way morph_kgc does: a string that starts with a
+    prefix has every occurrence of that prefix replaced.
+    """
+
+    if isinstance(node, dict):
+        return {key: expand_prefixes(value, prefixes) for key, value in node.items()}
+    if isinstance(node, list):
+        return [expand_prefixes(value, prefixes) for value in node]
+    if isinstance(node, str):
+        for prefix, namespace in prefixes.items():
+            if node.startswith(f'{prefix}:'):
+                node = node.replace(f'{prefix}:', namespace)
+    return node
+
+
+def parse_template(value):
+    """
+    Splits a YARRRML template into its text and its references.
+    Returns:
+        list: Pairs (is_reference, text) in order of appearance.
+    """
+
+    parts = []
+    start = value.find('$(')
+    while start != -1:
+        if start:
+            parts.append((False, value[:start]))
+        end = value.find(')', start)
+        parts.append((True, value[start + 2:end]))
+        value = value[end + 1:]
+        start = value.find('$(')
+    if value:
+        parts.append((False, value))
+    return parts
+
+
+def compile_value(value):
+    """
+    Compiles a YARRRML value into a term map. Like morph_kgc, a value that starts with its only reference is an RML
+    reference, a value with references is a template, 'a' is rdf:type and other values are constants, IRIs if they
+    start with http or ftp and literals otherwise.
+    Returns:
+        dict: The kind of term map, its parts, its references and its default term type as an object.
+    """
+
+    value = str(value)
+    if value.startswith('$(') and value.count('$(') == 1:
+        reference = value[2:-1]
+        return {'kind': 'reference', 'parts': [(True, reference)], 'references': [reference], 'termtype': 'literal'}
+    if '$(' in value:
+        parts = parse_template(value)
+        references = [text for is_reference, text in parts if is_reference]
+        return {'kind': 'template', 'parts': parts, 'references': references, 'termtype': 'iri'}
+    if value == 'a':
+        return {'kind': 'constant', 'parts': [(False, RDF_TYPE)], 'references': [], 'termtype': 'iri'}
+    termtype = 'iri' if value.startswith(('http', 'ftp')) else 'literal'
+    return {'kind': 'constant', 'parts': [(False, value)], 'references': [], 'termtype': termtype}
+
+
+def compile_function(term_map, functions):
+    function_iri = term_map['function']
+    if function_iri not in functions:
+        raise ValueError(f"Unknown function '{function_iri}'")
+    function, argument_names = functions[function_iri]
+
+    arguments = []
+    references = []
+    for parameter in term_map.get('parameters') or []:
+        if isinstance(parameter, list):
+            parameter = {'parameter': parameter[0], 'value': parameter[1]}
+        if isinstance(parameter['value'], dict):
+            raise ValueError(f"Composite functions are not supported by the native backend: '{function_iri}'")
+        value = compile_value(parameter['value'])
+        # morph_kgc drops the rows with missing values in any parameter, even the ones the function ignores
+        references += value['references']
+        if parameter['parameter'] in argument_names:
+            arguments.append((argument_names[parameter['parameter']], value))
+
+    return {'kind': 'function', 'function': function, 'arguments': arguments, 'references': references,
+            'termtype': 'literal'}
+
+
+def compile_term(value, functions, position):
+    """
+    Compiles the subject, predicate or object of a YARRRML rule, with its ~iri, ~literal or ~blanknode suffix, its
+    function, or its datatype and language. As in morph_kgc, a datatype or a language makes the term a literal and
+    takes precedence over its type, and subjects and predicates are IRIs unless a type is given.
+    """
+
+    termtype = datatype = language = None
+    if isinstance(value, dict):
+        unsupported = set(value) - TERM_MAP_KEYS
+        if unsupported:
+            raise ValueError(f"The YARRRML keys {sorted(unsupported)} are not supported by the native backend")
+        datatype, language, termtype = value.get('datatype'), value.get('language'), value.get('type')
+        term = compile_function(value, functions) if 'function' in value else compile_value(value['value'])
+    else:
+        value = str(value)
+        if value.rpartition('~')[2] in TERM_TYPES and '~' in value:
+            value, _, termtype = value.rpartition('~')
+        term = compile_value(value)
+
+    if position == 'predicate':
+        termtype = 'iri'
+    elif position == 'object' and (datatype or language):
+        termtype = 'literal'
+    elif termtype is None:
+        termtype = 'iri' if position == 'subject' else term['termtype']
+    # xsd:string is the same as no datatype, and morph_kgc drops it
+    term.update(termtype=termtype, datatype=None if datatype == XSD_STRING else datatype, language=language)
+    return term
+
+
+def as_list(value):
+    return value if isinstance(value, list) else [value]
+
+
+def predicate_objects(predicate_object):
+    """
+    Returns the (predicate, object) pairs of a po entry in any of its YARRRML forms.
+    """
+
+    if isinstance(predicate_object, list):
+        if len(predicate_object) == 2:
+            predicates, objects = predicate_object
+        else:
+            predicates, value, lang_datatype = predicate_object
+            if lang_datatype.endswith('~lang'):
+                objects = {'value': value, 'language': lang_datatype[:-5]}
+            else:
+                objects = {'value': value, 'datatype': lang_datatype}
+    else:
+        unsupported = set(predicate_object) - {'predicates', 'objects', 'type', 'datatype', 'language'}
+        if unsupported:
+            raise ValueError(f"The YARRRML keys {sorted(unsupported)} are not supported by the native backend")
+        predicates = predicate_object['predicates']
+        objects = predicate_object['objects']
+        # type, datatype and language can also be given at the po level
+        shared = {key: predicate_object[key] for key in ('type', 'datatype', 'language') if key in predicate_object}
+        if shared and isinstance(objects, str):
+            value, _, termtype = objects.rpartition('~')
+            objects = {'value': value, 'type': termtype} if termtype in TERM_TYPES else {'value': objects}
+        if shared and isinstance(objects, dict):
+            objects = dict(objects, **shared)
+
+    objects = as_list(objects)
+    if objects and isinstance(objects[0], list):
+        objects = [{'value': value, 'language': lang_datatype[:-5]} if lang_datatype.endswith('~lang')
+                   else {'value': value, 'datatype': lang_datatype} for value, lang_datatype in objects]
+    return [(predicate, obj) for predicate in as_list(predicates) for obj in objects]
+
+
+def compile_mappings(mapping_path, udf_path):
+    """
+    Reads a YARRRML file and compiles every triple it describes into a rule with a source and three term maps.
+    Args:
+        mapping_path (str): Path to the YARRRML file.
+        udf_path (str): Path to the UDF file with the functions used by the mappings.
+    Returns:
+        list: One dict per rule, with its source path and its subject, predicate and object term maps.
+    Raises:
+        ValueError: If the mappings use YARRRML features that the native backend does not support.
+    """
+
+    with open(mapping_path, 'r', encoding='utf-8') as mapping_file:
+        document = normalize_keys(YAML(typ='safe', pure=True).load(mapping_file))
+    prefixes = dict(document.get('prefixes') or {})
+    prefixes.update(DEFAULT_PREFIXES)
+    mappings = expand_prefixes(document.get('mappings') or {}, prefixes)
+    functions = udf_folding.load_udfs(udf_path) if udf_path else {}
+
+    if set(document) - {'prefixes', 'mappings', 'authors'}:
+        raise ValueError(f"The YARRRML keys {sorted(set(document) - {'prefixes', 'mappings', 'authors'})} are not "
+                         f"supported by the native backend")
+
+    rules = []
+    for name, mapping in mappings.items():
+        if set(mapping) - MAPPING_KEYS:
+            raise ValueError(f"The keys {sorted(set(mapping) - MAPPING_KEYS)} of mapping '{name}' are not supported "
+                             f"by the native backend")
+        if 'subjects' not in mapping:
+            raise ValueError(f"Mapping '{name}' has no subject, blank node subjects are not supported")
+        sources = []
+        for source in as_list(mapping['sources']):
+            source = source[0] if isinstance(source, list) else source
+            if not isinstance(source, str):
+                raise ValueError(f"Mapping '{name}' has a source that is not a file")
+            sources.append(source.split('~')[0])
+
+        subjects = [compile_term(subject, functions, 'subject') for subject in as_list(mapping['subjects'])]
+        for predicate_object in as_list(mapping.get('predicateobjects') or []):
+            for predicate, obj in predicate_objects(predicate_object):
+                predicate_term = compile_term(predicate, functions, 'predicate')
+                object_term = compile_term(obj, functions, 'object')
+                for source in sources:
+                    for subject_term in subjects:
+                        rules.append({'source': source, 'subject': subject_term, 'predicate': predicate_term,
+                                      'object': object_term})
+    return rules
+
+
+def read_source(source, python_source=None):
+    """
+    Reads every column of a data source as text, as morph_kgc does. Sources named in braces are in-memory data, read
+    from python_source like morph_kgc does.
+    """
+
+    if source.startswith('{') and source.endswith('}'):
+        if python_source is None or source[1:-1] not in python_source:
+            raise ValueError(f"The in-memory source '{source}' was not given")
+        return python_source[source[1:-1]].astype(object)
+    if source.endswith('.parquet'):
+        return pd.read_parquet(source, engine='pyarrow').astype(str)
+    if not source.endswith('.csv'):
+        raise ValueError(f"Only CSV and Parquet sources are supported by the native backend: '{source}'")
+    return pd.read_csv(source, dtype=str, keep_default_na=False, na_filter=False, encoding='utf-8', engine='c')
+
+
+def escape_literal(values):
+    return (values.str.replace('\\', '\\\\', regex=False).str.replace('\n', '\\n', regex=False)
+            .str.replace('\r', '\\r', regex=False).str.replace('"', '\\"', regex=False))
+
+
+def natural_mapping(values, datatype):
+    # Natural mapping of SQL values, as done by morph_kgc
+    if datatype == XSD_BOOLEAN:
+        return values.str.lower()
+    if datatype == XSD_DATETIME:
+        return values.str.replace(' ', 'T', regex=False)
+    if datatype == XSD_INTEGER:
+        return values.astype(float).astype(int).astype(str)
+    return values
+
+
+def percent_encode(values):
+    # Each distinct value is encoded once
+    distinct = values.unique()
+    return values.map(dict(zip(distinct, (quote(value, safe='') for value in distinct))))
+
+
+def fill_template(frame, term, prepared=None):
+    """
+    Builds the text of a reference, template or constant term map for every row, with string operations over whole
+    columns. References in IRI templates are percent-encoded and references in literals are escaped.
+    Args:
+        frame (pd.DataFrame): Rows of the rule.
+        term (dict): The term map.
+        prepared (dict, optional): Encoded and escaped columns of the frame, reused by the rules that share it.
+    Returns:
+        pd.Series or str: The text of the term for every row, or a string if the term has no references.
+    """
+
+    prepared = {} if prepared is None else prepared
+    text = None
+    for is_reference, part in term['parts']:
+        if is_reference:
+            if term['termtype'] == 'iri' and term['kind'] == 'template':
+                key = (part, 'iri')
+                if key not in prepared:
+                    prepared[key] = percent_encode(frame[part])
+                part = prepared[key]
+            elif term['termtype'] == 'literal':
+                key = (part, 'literal', term['datatype'])
+                if key not in prepared:
+                    prepared[key] = escape_literal(natural_mapping(frame[part], term['datatype']))
+                part = prepared[key]
+            else:
+                part = frame[part]
+        text = part if text is None else text + part
+    return '' if text is None else text
+
+
+def call_function(frame, term):
+    """
+    Calls the function of a term map once per distinct combination of its arguments. Rows where the function
+    returns nothing get a missing value.
+    """
+
+    columns = []
+    for _, value in term['arguments']:
+        column = fill_template(frame, dict(value, termtype=''))
+        columns.append([column] * len(frame) if isinstance(column, str) else column)
+    names = [name for name, _ in term['arguments']]
+    keys = list(zip(*columns)) if columns else [()] * len(frame)
+
+    results = {}
+    for key in set(keys):
+        result = term['function'](**dict(zip(names, key)))
+        if isinstance(result, list):
+            raise ValueError("Functions that return lists are not supported by the native backend")
+        results[key] = None if result is None or str(result) in udf_folding.MISSING_VALUES else str(result)
+    return pd.Series([results[key] for key in keys], index=frame.index, dtype=object)
+
+
+def format_term(frame, term, prepared=None):
+    """
+    Returns the N-Triples form of a term map for every row, missing where the term is not generated, or a string if
+    it is a constant.
+    """
+
+    if term['kind'] == 'function':
+        text = call_function(frame, term)
+        if term['termtype'] == 'iri':
+            text = text.str.strip()
+    else:
+        text = fill_template(frame, term, prepared)
+
+    if term['termtype'] == 'iri':
+        return '<' + text + '>'
+    if term['termtype'] == 'blanknode':
+        return '_:' + text
+    text = '"' + text + '"'
+    if term['language']:
+        return text + '@' + term['language']
+    if term['datatype']:
+        return text + f"^^<{term['datatype']}>"
+    return text
+
+
+def materialize_set(mapping_path, udf_path, python_source=None):
+    """
+    Materializes a YARRRML file without morph_kgc. Every rule is evaluated over its data source with vectorized
+    string building, and Python functions are only called once per distinct combination of arguments. The result is
+    the same set of triples that morph_kgc.materialize_set returns for the mappings generated by generateRules.
+    Args:
+        mapping_path (str): Path to the YARRRML file.
+        udf_path (str): Path to the UDF file.
+        python_source (dict, optional): The DataFrame of each in-memory data source, by name.
+    Returns:
+        set: N-Triples lines without the final dot.
+    Raises:
+        ValueError: If the mappings use YARRRML features that the native backend does not support.
+    """
+
+    sources = {}
+    frames = {}
+    triples = set()
+    for rule in compile_mappings(mapping_path, udf_path):
+        terms = (rule['subject'], rule['predicate'], rule['object'])
+        references = list(dict.fromkeys(reference for term in terms for reference in term['references']))
+
+        if rule['source'] not in sources:
+            sources[rule['source']] = read_source(os.path.normpath(rule['source']), python_source)
+        data = sources[rule['source']]
+        missing = [reference for reference in references if reference not in data.columns]
+        if missing:
+            raise ValueError(f"Columns {missing} are not in the source '{rule['source']}'")
+
+        # Like morph_kgc, rows with a missing value in any reference of the rule are dropped
+        frame_key = (rule['source'], tuple(references))
+        if frame_key not in frames:
+            frame = data[references]
+            if references:
+                frame = frame[~frame.isin(udf_folding.MISSING_VALUES).any(axis=1)].drop_duplicates()
+            else:
+                frame = pd.DataFrame(index=[0])
+            frames[frame_key] = (frame, {})
+        frame, prepared = frames[frame_key]
+        if not len(frame):
+            continue
+
+        # The subject of a mapping is shared by its rules, so it is only formatted once per frame
+        subject_key = ('subject', id(rule['subject']))
+        if subject_key not in prepared:
+            prepared[subject_key] = format_term(frame, rule['subject'], prepared)
+        subject = prepared[subject_key]
+        predicate = format_term(frame, rule['predicate'], prepared)
+        obj = format_term(frame, rule['object'], prepared)
+
+        triple = subject + ' ' + predicate + ' ' + obj
+        if isinstance(triple, str):
+            triples.add(triple)
+        else:
+            triples.update(triple.dropna())
+    return triples
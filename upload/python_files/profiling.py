@@ -0,0 +1,152 @@
+import contextlib
+import cProfile
+import json
+import os
+import resource
+import sys
+import time
+from datetime import datetime
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident memory of the current process in MB.
+    """
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def new_report(script):
+    """
+    Returns an empty profiling report of a run of a script.
+    """
+
+    return {
+        'script': script,
+        'argv': sys.argv[1:],
+        'started': datetime.now().isoformat(timespec='seconds'),
+        'start_time': time.perf_counter(),
+        'stages': {},
+        'fields': {},
+    }
+
+
+def new_field_record(rows):
+    """
+    Returns the record of a field in a profiling report, with the number of rows of its group.
+    """
+
+    return {'rows': rows, 'seconds': {}, 'triples': None, 'cache_hit': False, 'error': None}
+
+
+@contextlib.contextmanager
+def timed(timings, name):
+    """
+    Adds the time spent in the block to timings[name]. Does nothing when timings is None.
+    """
+
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+
+@contextlib.contextmanager
+def stage(report, name):
+    """
+    Records the time spent in the block as a stage of the report, together with the peak memory of the process
+    at its end. Does nothing when report is None.
+    Args:
+        report (dict): Profiling report, as returned by new_report.
+        name (str): Name of the stage. The time of stages that run several times is added up.
+    Yields:
+        dict: The entry of the stage, where other measures such as a row count can be set.
+    """
+
+    if report is None:
+        yield {}
+        return
+    entry = report['stages'].setdefault(name, {'seconds': 0.0})
+    start = time.perf_counter()
+    try:
+        yield entry
+    finally:
+        entry['seconds'] += time.perf_counter() - start
+        entry['peak_rss_mb'] = round(peak_rss_mb(), 1)
+
+
+@contextlib.contextmanager
+def profiled(profile_path):
+    """
+    Runs the block under cProfile and dumps the statistics to profile_path. Does nothing when profile_path is None.
+    """
+
+    if profile_path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_path)
+
+
+def profile_path(profile_folder, field_id):
+    """
+    Returns the path of the cProfile dump of a field, or None when no folder is given.
+    """
+
+    if profile_folder is None:
+        return None
+    return os.path.join(profile_folder, f"{field_id}.prof")
+
+
+def keep_slowest_profiles(report, profile_folder, count):
+    """
+    Keeps the cProfile dumps of the count fields that took the longest, and removes the rest. The fields are
+    profiled while they run, so the dumps of the slowest ones are available without running them again.
+    Returns:
+        dict: Path of the dump of each kept field.
+    """
+
+    def field_seconds(item):
+        return sum(item[1]['seconds'].values())
+
+    slowest = sorted(report['fields'].items(), key=field_seconds, reverse=True)[:count]
+    kept = {}
+    for field_id, _ in slowest:
+        path = profile_path(profile_folder, field_id)
+        if os.path.isfile(path):
+            kept[field_id] = path
+
+    for filename in os.listdir(profile_folder):
+        path = os.path.join(profile_folder, filename)
+        if filename.endswith('.prof') and path not in kept.values():
+            os.remove(path)
+    return kept
+
+
+def write_report(report, path):
+    """
+    Adds the total time and the peak memory of the run to the report, and writes it as JSON. The fields are
+    sorted from the slowest.
+    """
+
+    total_seconds = time.perf_counter() - report.pop('start_time')
+    fields = sorted(report['fields'].items(), key=lambda item: sum(item[1]['seconds'].values()), reverse=True)
+    output = dict(report, total_seconds=round(total_seconds, 3), peak_rss_mb=round(peak_rss_mb(), 1))
+    output['stages'] = {name: dict(entry, seconds=round(entry['seconds'], 3))
+                        for name, entry in report['stages'].items()}
+    output['fields'] = {field_id: dict(record, seconds={name: round(seconds, 3)
+                                                          for name, seconds in record['seconds'].items()})
+                        for field_id, record in fields}
+    if not output['fields']:
+        del output['fields']
+    with open(path, 'w', encoding='utf-8') as report_file:
+        json.dump(output, report_file, indent=2)
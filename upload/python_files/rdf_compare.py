@@ -0,0 +1,301 @@
+import os
+import re
+from decimal import Decimal, InvalidOperation
+
+import rdflib
+from rdflib.plugins.parsers.notation3 import BadSyntax, RDFSink, SinkParser
+
+import dedup
+
+XSD = 'http://www.w3.org/2001/XMLSchema#'
+XSD_STRING = XSD + 'string'
+
+# Terms of an N-Triples or N-Quads line. The object groups are the lexical form, language and datatype of a literal.
+IRI = r'<(?:[^>\\]|\\.)*>'
+BLANK_NODE = r'_:\S+'
+LITERAL = r'"((?:[^"\\]|\\.)*)"(?:@([A-Za-z0-9-]+)|\^\^(' + IRI + r'))?'
+NTRIPLES_PATTERN = re.compile(rf'^({IRI}|{BLANK_NODE})\s+({IRI})\s+({IRI}|{BLANK_NODE}|{LITERAL})'
+                              rf'(?:\s+(?:{IRI}|{BLANK_NODE}))?\s*\.$')
+ESCAPE_PATTERN = re.compile(r'\\(?:u([0-9A-Fa-f]{4})|U([0-9A-Fa-f]{8})|(.))')
+ESCAPES = {'t': '\t', 'b': '\b', 'n': '\n', 'r': '\r', 'f': '\f', '"': '"', "'": "'", '\\': '\\'}
+
+TURTLE_EXTENSIONS = ('.ttl', '.turtle')
+
+
+def unescape(text):
+    """
+    Replaces the escape sequences of an N-Triples string or IRI by the characters they stand for.
+    """
+
+    if '\\' not in text:
+        return text
+
+    def replace(match):
+        code = match.group(1) or match.group(2)
+        if code:
+            return chr(int(code, 16))
+        return ESCAPES.get(match.group(3), match.group(0))
+
+    return ESCAPE_PATTERN.sub(replace, text)
+
+
+def canonical_boolean(lexical):
+    return {'true': 'true', '1': 'true', 'false': 'false', '0': 'false'}[lexical.strip()]
+
+
+def canonical_decimal(lexical):
+    value = Decimal(lexical.strip())
+    if not value.is_finite():
+        raise ValueError(lexical)
+    text = format(value.normalize(), 'f')
+    return text if '.' in text else text + '.0'
+
+
+# Canonical lexical form of the datatypes that serializers write in more than one way, e.g. rdflib writes the
+# double "3" as 3.0 in Turtle
+CANONICAL_LEXICAL = {
+    XSD + 'boolean': canonical_boolean,
+    XSD + 'integer': lambda lexical: str(int(lexical)),
+    XSD + 'decimal': canonical_decimal,
+    XSD + 'double': lambda lexical: repr(float(lexical)),
+    XSD + 'float': lambda lexical: repr(float(lexical)),
+}
+
+
+def canonical_literal(lexical, language=None, datatype=None):
+    """
+    Returns the canonical N-Triples form of a literal: only backslashes, quotes and line breaks are escaped, the
+    language tag is lowercase, and xsd:string, which is the datatype of every plain literal, is left out.
+    Numbers and booleans are written in the canonical form of their value, so "3" and "3.0" are the same double;
+    ill-typed values are kept as they are.
+    """
+
+    if datatype in CANONICAL_LEXICAL:
+        try:
+            lexical = CANONICAL_LEXICAL[datatype](lexical)
+        except (ValueError, KeyError, InvalidOperation):
+            pass
+    lexical = lexical.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').replace('\r', '\\r')
+    if language:
+        return f'"{lexical}"@{language.lower()}'
+    if datatype and datatype != XSD_STRING:
+        return f'"{lexical}"^^<{datatype}>'
+    return f'"{lexical}"'
+
+
+def canonical_term(term):
+    """
+    Returns the canonical N-Triples form of an rdflib term.
+    """
+
+    if isinstance(term, rdflib.Literal):
+        return canonical_literal(str(term), term.language, str(term.datatype) if term.datatype else None)
+    if isinstance(term, rdflib.BNode):
+        return f"_:{term}"
+    return f"<{term}>"
+
+
+def canonical_ntriples_line(line):
+    """
+    Returns the canonical form of an N-Triples or N-Quads line, without its graph, or None if it is not a triple.
+    """
+
+    match = NTRIPLES_PATTERN.match(line)
+    if not match:
+        return None
+    subject, predicate, term, lexical, language, datatype = match.groups()
+
+    if lexical is not None:
+        term = canonical_literal(unescape(lexical), language, unescape(datatype[1:-1]) if datatype else None)
+    elif term.startswith('<'):
+        term = f"<{unescape(term[1:-1])}>"
+    if subject.startswith('<'):
+        subject = f"<{unescape(subject[1:-1])}>"
+    return f"{subject} <{unescape(predicate[1:-1])}> {term} ."
+
+
+def read_ntriples(path, invalid_lines):
+    """
+    Yields the canonical form of each triple of an N-Triples or N-Quads file, line by line. Lines that are not
+    triples are added to invalid_lines and skipped.
+    """
+
+    with open(path, 'r', encoding='utf-8-sig') as input_file:
+        for line_number, line in enumerate(input_file, start=1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            canonical = canonical_ntriples_line(line)
+            if canonical is None:
+                invalid_lines.append((path, line_number))
+                continue
+            yield canonical
+
+
+class TripleSink(RDFSink):
+    """
+    Sink of rdflib's Turtle parser that keeps the canonical form of each parsed triple instead of adding it to a
+    graph, and keeps the lexical form of typed literals as written.
+    """
+
+    def __init__(self):
+        super().__init__(rdflib.Graph())
+        self.lines = []
+
+    def newLiteral(self, s, dt, lang):
+        if dt:
+            return rdflib.Literal(s, datatype=dt, normalize=False)
+        return rdflib.Literal(s, lang=lang, normalize=False)
+
+    def makeStatement(self, quadruple, why=None):
+        f, p, s, o = quadruple
+        terms = (self.normalise(f, s), self.normalise(f, p), self.normalise(f, o))
+        self.lines.append(' '.join(canonical_term(term) for term in terms) + ' .')
+
+
+def turtle_blocks(turtle_file):
+    """
+    Splits a Turtle document into blocks at the blank lines that follow the end of a statement. rdflib writes
+    each subject in its own block, so the document can be parsed block by block.
+    """
+
+    block = []
+    last_line = ''
+    for line in turtle_file:
+        block.append(line)
+        stripped = line.strip()
+        if stripped:
+            last_line = stripped
+        elif last_line.endswith('.'):
+            yield ''.join(block)
+            block = []
+            last_line = ''
+    if block:
+        yield ''.join(block)
+
+
+def read_turtle(path):
+    """
+    Yields the canonical form of each triple of a Turtle file. The file is parsed block by block, so only the
+    triples of the current block are in memory. A block that ends inside a long literal with a blank line fails
+    to parse and is retried once together with the next one; the triples it already produced are repeated, which
+    the comparison ignores.
+    Raises:
+        BadSyntax: If a block does not parse together with the next one either, at the first line of the block.
+    """
+
+    uri = 'file://' + os.path.abspath(path)
+    sink = TripleSink()
+    parser = SinkParser(sink, baseURI=rdflib.URIRef(uri), turtle=True)
+    parser.startDoc()
+
+    def feed(text, line_number):
+        try:
+            parser.feed(text)
+        except BadSyntax as e:
+            # The parser counts the lines of everything it was fed, including the blocks fed twice
+            raise BadSyntax(uri, line_number - 1, text, e._i, e._why) from None
+
+    with open(path, 'r', encoding='utf-8-sig') as turtle_file:
+        pending = ''
+        pending_line = line_number = 1
+        for block in turtle_blocks(turtle_file):
+            if pending:
+                feed(pending + block, pending_line)
+                pending = ''
+            else:
+                try:
+                    parser.feed(block)
+                except BadSyntax:
+                    pending, pending_line = block, line_number
+            line_number += block.count('\n')
+            if not pending:
+                yield from sink.lines
+                sink.lines = []
+
+    if pending:
+        feed(pending, pending_line)
+        yield from sink.lines
+    parser.endDoc()
+
+
+def canonical_lines(path, invalid_lines):
+    """
+    Yields the canonical form of each triple of an N-Triples, N-Quads or Turtle file, chosen by its extension.
+    """
+
+    if path.endswith(TURTLE_EXTENSIONS):
+        return read_turtle(path)
+    return read_ntriples(path, invalid_lines)
+
+
+def diff_sorted(left, right):
+    """
+    Walks two sorted iterators of distinct lines at the same time.
+    Yields:
+        tuple: '-' and a line only in left, '+' and a line only in right, or ' ' and a line in both.
+    """
+
+    left_line = next(left, None)
+    right_line = next(right, None)
+    while left_line is not None or right_line is not None:
+        if right_line is None or (left_line is not None and left_line < right_line):
+            yield '-', left_line
+            left_line = next(left, None)
+        elif left_line is None or right_line < left_line:
+            yield '+', right_line
+            right_line = next(right, None)
+        else:
+            yield ' ', left_line
+            left_line = next(left, None)
+            right_line = next(right, None)
+
+
+def compare_files(left_path, right_path, memory_budget_mb, diff_path=None, examples=5, spill_folder=None):
+    """
+    Compares the triples of two RDF files, in any of the formats of canonical_lines. The canonical lines of each
+    file are sorted with an external sort, so memory stays bounded whatever the size of the files, and both
+    sorted streams are then compared line by line. Repeated triples count once, and graph names are ignored.
+    Args:
+        left_path (str): Path to the reference file.
+        right_path (str): Path to the file compared with it.
+        memory_budget_mb (float): Memory available for sorting, shared by both files, in MB.
+        diff_path (str, optional): File where every removed ('- ') and added ('+ ') triple is written.
+        examples (int): Number of removed and added triples kept in the result.
+        spill_folder (str, optional): Folder for the temporary sort files. Defaults to the system temp folder.
+    Returns:
+        dict: Distinct triples of each file, triples in both, removed and added triples, invalid lines of each file,
+        and some removed and added triples as examples.
+    """
+
+    left_invalid, right_invalid = [], []
+    left = dedup.sort_unique_lines(canonical_lines(left_path, left_invalid), memory_budget_mb / 2, spill_folder)
+    right = dedup.sort_unique_lines(canonical_lines(right_path, right_invalid), memory_budget_mb / 2, spill_folder)
+
+    counts = {'-': 0, '+': 0, ' ': 0}
+    found = {'-': [], '+': []}
+    diff_file = open(diff_path, 'w', encoding='utf-8') if diff_path else None
+    try:
+        for sign, line in diff_sorted(left, right):
+            counts[sign] += 1
+            if sign == ' ':
+                continue
+            if len(found[sign]) < examples:
+                found[sign].append(line)
+            if diff_file is not None:
+                diff_file.write(f"{sign} {line}\n")
+    finally:
+        if diff_file is not None:
+            diff_file.close()
+
+    return {
+        'left': counts['-'] + counts[' '],
+        'right': counts['+'] + counts[' '],
+        'common': counts[' '],
+        'removed': counts['-'],
+        'added': counts['+'],
+        'left_invalid': len(left_invalid),
+        'right_invalid': len(right_invalid),
+        'removed_examples': found['-'],
+        'added_examples': found['+'],
+    }
@@ -0,0 +1,325 @@
+import argparse
+import collections
+import contextlib
+import io
+import json
+import os
+import shutil
+import signal
+import socketserver
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import numpy as np
+import pandas as pd
+
+import config
+import dataPreprocessing
+import initiate
+import sharding
+
+# Latency percentiles reported by GET /stats
+PERCENTILES = (50, 90, 99)
+
+
+class WarmPipeline:
+    """
+    Runs the preprocessing and the catalogue materialization of initiate.py on the data rows of each request,
+    keeping warm what every run of the scripts loads again: the libraries, the mappings with their compiled indices,
+    and the UDFs of udf.py. The mappings file is reloaded as soon as it changes.
+    The rules of a field are generated from its first row, so the rows of each request are preceded by the first row
+    of their fields in the preprocessed data of the batch build, as sharding.shard_rows does for the shards. A case
+    then gets the same triples as in the batch build, and the triples of the reference rows of other cases are left
+    out of the response.
+    """
+
+    def __init__(self, main_folder, mapping_path, backend='native', latency_window=config.DAEMON_LATENCY_WINDOW):
+        self.main_folder = main_folder
+        self.mapping_path = mapping_path
+        self.backend = backend
+        self.work_folder = prepare_work_folder(main_folder)
+        self.mapping_df = None
+        self.mapping_mtime = None
+        self.indices = None
+        self.reference = None
+        self.reloads = 0
+        self.latency_window = latency_window
+        self.latencies = {}
+        self.reload_mappings()
+        initiate.cache_udf_loading()
+
+    def reload_mappings(self):
+        """
+        Reads and cleans the mappings file, and loads its compiled mapping indices, which are kept in the work
+        folder so that a restarted daemon does not build them again. The reference rows are loaded again too.
+        Raises:
+            KeyError: If the mappings file lacks a required column. The previous mappings are kept.
+        """
+
+        mtime = os.stat(self.mapping_path).st_mtime_ns
+        mapping_df = dataPreprocessing.clean_data(pd.read_csv(self.mapping_path, encoding='utf-8-sig'))
+        missing = config.REQUIRED_MAPPING_COLS - set(mapping_df.columns)
+        if missing:
+            raise KeyError(f"The following columns are missing in the mappings file: {missing}")
+        if self.mapping_df is not None:
+            self.reloads += 1
+        index_path = os.path.join(self.work_folder, config.PREPROCESSED_FOLDER, config.MAPPING_INDEX_FILENAME)
+        self.indices = dataPreprocessing.load_mapping_index(self.mapping_path, mapping_df, index_path)
+        self.mapping_df = mapping_df
+        self.mapping_mtime = mtime
+        self.load_reference()
+
+    def load_reference(self):
+        """
+        Loads the reference rows of the preprocessed data of the batch build, written by dataPreprocessing.py in the
+        main folder. Without that file, the rules of each field are generated from the first row of the request.
+        """
+
+        try:
+            reference = sharding.reference_rows(initiate.load_preprocessed_csv(self.main_folder))
+        except FileNotFoundError as e:
+            self.reference = None
+            print(f"No reference rows, the rules of each request come from its own rows: {e}", file=sys.stderr)
+            return
+        self.reference = self.current_reference_rows(reference)
+
+    def current_reference_rows(self, reference):
+        """
+        Leaves out the reference rows of the fields whose mappings changed since the batch build, as the rules
+        generated from them would be those of the previous mappings. The rules of those fields come from the first
+        row of each request until the batch build is run again with the new mappings.
+        """
+
+        if reference.empty:
+            return reference
+        # procedure_result is replaced by its IRI in the preprocessed rows
+        columns = [column for column in self.mapping_df.columns
+                   if column in reference.columns and column != 'procedure_result']
+        mapping_rows = set(map(tuple, initiate.preprocessed_text(self.mapping_df[columns]).to_numpy().tolist()))
+        current = [tuple(row) in mapping_rows
+                   for row in initiate.preprocessed_text(reference[columns]).to_numpy().tolist()]
+        stale_fields = reference.loc[[not row for row in current], 'field_id'].unique()
+        if len(stale_fields):
+            print(f"The mappings of {len(stale_fields)} fields changed since the batch build, their rules come from "
+                  f"the rows of each request: {', '.join(map(str, stale_fields))}", file=sys.stderr)
+        return reference[~reference['field_id'].isin(stale_fields)]
+
+    def with_reference_rows(self, df):
+        """
+        Adds the reference rows of the fields of the given preprocessed rows that belong to other cases before them.
+        """
+
+        if self.reference is None or self.reference.empty or df.empty:
+            return df
+        reference = self.reference
+        case_ids = reference[config.CASE_ID_COLUMN].astype(str)
+        foreign = reference[reference['field_id'].isin(df['field_id'].unique())
+                            & ~case_ids.isin(df[config.CASE_ID_COLUMN].astype(str).unique())]
+        if foreign.empty:
+            return df
+        return pd.concat([foreign, df], ignore_index=True)
+
+    def check_mappings(self):
+        """
+        Reloads the mappings file if it changed since it was read. A file that cannot be read is reported and the
+        previous mappings are kept until it is fixed.
+        """
+
+        try:
+            if os.stat(self.mapping_path).st_mtime_ns != self.mapping_mtime:
+                self.reload_mappings()
+                print(f"Reloaded the mappings from '{self.mapping_path}'")
+        except (OSError, KeyError, pd.errors.ParserError, pd.errors.EmptyDataError) as e:
+            print(f"Keeping the previous mappings, '{self.mapping_path}' could not be reloaded: {e}",
+                  file=sys.stderr)
+
+    def read_cases(self, source):
+        # The columns and dtypes that are read depend on the mappings
+        self.check_mappings()
+        return dataPreprocessing.read_data_file(source, self.mapping_df)
+
+    def preprocess(self, data_df):
+        """
+        Processes data rows like dataPreprocessing.py, and returns them as initiate.py reads them from the
+        preprocessed CSV file, so that the values have the same text.
+        """
+
+        dataPreprocessing.validate_inputs(data_df, self.mapping_df)
+        mapping_by_field, proc_result_index, dispatch = dataPreprocessing.select_mapping_indices(self.indices,
+                                                                                                 data_df.columns)
+        result_df = dataPreprocessing.process_with_indices(data_df, mapping_by_field, proc_result_index,
+                                                           dispatch=dispatch)
+        return initiate.preprocessed_text(result_df)
+
+    def materialize(self, data_df):
+        """
+        Returns the sorted N-Triples lines of the given data rows, which may hold one or many cases.
+        """
+
+        self.check_mappings()
+        df = self.preprocess(data_df)
+        if df.empty:
+            return []
+        rows = self.with_reference_rows(df)
+        groups = list(initiate.filter_valid_groups(rows))
+        if not groups:
+            return []
+        # generateRules prints every field it generates
+        with contextlib.redirect_stdout(io.StringIO()):
+            output_path = initiate.generate_catalogue_and_serialize(groups, self.work_folder, None, 'ntriples',
+                                                                    'memory', self.backend)
+        with open(output_path, 'r', encoding='utf-8') as output_file:
+            lines = output_file.read().splitlines()
+        case_ids = set(df[config.CASE_ID_COLUMN].astype(str))
+        return sharding.own_lines(lines, case_ids, set(rows[config.CASE_ID_COLUMN].astype(str)) - case_ids)
+
+    def record(self, endpoint, seconds):
+        self.latencies.setdefault(endpoint, collections.deque(maxlen=self.latency_window)).append(seconds)
+
+    def stats(self):
+        """
+        Returns the number of requests of each endpoint and the percentiles of their latency, in milliseconds,
+        over the last latency_window requests.
+        """
+
+        endpoints = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            milliseconds = np.array(latencies) * 1000
+            endpoints[endpoint] = {'requests': len(milliseconds), 'max_ms': round(float(milliseconds.max()), 1)}
+            for percentile in PERCENTILES:
+                endpoints[endpoint][f"p{percentile}_ms"] = round(float(np.percentile(milliseconds, percentile)), 1)
+        return {'backend': self.backend, 'mappings': self.mapping_path, 'reloads': self.reloads,
+                'endpoints': endpoints}
+
+
+def prepare_work_folder(main_folder):
+    """
+    Creates the folder where the daemon writes the rules and instances of each request, with a copy of the UDF
+    file of the project. The data of the requests is handed to the backend in memory.
+    """
+
+    work_folder = os.path.join(main_folder, config.DAEMON_FOLDER)
+    initiate.check_or_create_directories(work_folder)
+    shutil.copyfile(os.path.join(main_folder, config.PYTHON_FOLDER, config.UDF_FILENAME),
+                    os.path.join(work_folder, config.PYTHON_FOLDER, config.UDF_FILENAME))
+    return work_folder
+
+
+class DaemonHandler(BaseHTTPRequestHandler):
+    """
+    POST /cases: data rows as a CSV document with the header of the data file, one or many cases. Returns their
+        triples as N-Triples.
+    POST /jobs: a JSON object with the 'data' path of a data file, and optionally an 'output' path. Writes the
+        triples of every case of the file to output, or returns them when there is no output.
+    POST /reload: reloads the mappings file.
+    GET /stats: the number of requests and the latency percentiles of each endpoint, as JSON.
+    """
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.send_text(200, json.dumps(self.server.pipeline.stats(), indent=2), 'application/json')
+        else:
+            self.send_text(404, f"Unknown endpoint: {self.path}\n")
+
+    def do_POST(self):
+        handlers = {'/cases': self.post_cases, '/jobs': self.post_jobs, '/reload': self.post_reload}
+        if self.path not in handlers:
+            self.send_text(404, f"Unknown endpoint: {self.path}\n")
+            return
+        start = time.perf_counter()
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        try:
+            status, text, content_type = handlers[self.path](body)
+        except (KeyError, ValueError, pd.errors.ParserError, pd.errors.EmptyDataError, OSError) as e:
+            status, text, content_type = 400, f"Invalid request: {e}\n", 'text/plain'
+        except RuntimeError as e:
+            status, text, content_type = 500, f"Materialization failed: {e}\n", 'text/plain'
+        self.send_text(status, text, content_type)
+        self.server.pipeline.record(self.path, time.perf_counter() - start)
+
+    def post_cases(self, body):
+        data_df = self.server.pipeline.read_cases(body)
+        lines = self.server.pipeline.materialize(data_df)
+        return 200, ''.join(f"{line}\n" for line in lines), 'application/n-triples'
+
+    def post_jobs(self, body):
+        job = json.loads(body)
+        data_df = self.server.pipeline.read_cases(job['data'])
+        lines = self.server.pipeline.materialize(data_df)
+        if not job.get('output'):
+            return 200, ''.join(f"{line}\n" for line in lines), 'application/n-triples'
+        with open(job['output'], 'w', encoding='utf-8') as output_file:
+            output_file.writelines(f"{line}\n" for line in lines)
+        summary = {'cases': int(data_df[config.CASE_ID_COLUMN].nunique()), 'triples': len(lines),
+                   'output': job['output']}
+        return 200, json.dumps(summary), 'application/json'
+
+    def post_reload(self, body):
+        self.server.pipeline.reload_mappings()
+        return 200, f"Reloaded the mappings from '{self.server.pipeline.mapping_path}'\n", 'text/plain'
+
+    def send_text(self, status, text, content_type='text/plain'):
+        data = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', f"{content_type}; charset=utf-8")
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class UnixHTTPServer(socketserver.UnixStreamServer):
+    """
+    HTTP server listening on a Unix socket. Clients have no address, which the request log expects.
+    """
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ('local', 0)
+
+
+def main(main_folder, mapping_path, backend='native', host='127.0.0.1', port=config.DAEMON_PORT, socket_path=None):
+    pipeline = WarmPipeline(main_folder, mapping_path, backend)
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, DaemonHandler)
+        address = f"unix:{socket_path}"
+    else:
+        server = HTTPServer((host, port), DaemonHandler)
+        address = f"http://{host}:{port}"
+    server.pipeline = pipeline
+
+    # Stopping the daemon with kill also removes the socket and prints the latencies
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    print(f"Serving on {address}, with the mappings of '{mapping_path}'")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+        print(json.dumps(pipeline.stats(), indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the pipeline over HTTP, keeping its state warm.")
+    parser.add_argument('main_folder', type=str, help='Path to the project root directory')
+    parser.add_argument('csv_mapping_path', type=str, help='Path to the CSV mapping file, reloaded when it changes')
+    parser.add_argument('--backend', choices=config.BACKENDS, default='native',
+                        help='Materialize with the native backend, or with morph_kgc')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=config.DAEMON_PORT, help='Port to listen on')
+    parser.add_argument('--socket', type=str, default=None, metavar='PATH',
+                        help='Listen on a Unix socket instead of a TCP port')
+    args = parser.parse_args()
+    try:
+        main(args.main_folder, args.csv_mapping_path, args.backend, args.host, args.port, args.socket)
+    except (FileNotFoundError, KeyError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,190 @@
+import argparse
+import contextlib
+import os
+import shutil
+import sys
+import tempfile
+
+import pandas as pd
+
+import config
+import dataPreprocessing
+import initiate
+import profiling
+
+OUTPUT_FILENAMES = {'turtle': config.FINAL_OUTPUT_FILENAME, 'ntriples': config.FINAL_NT_OUTPUT_FILENAME}
+
+
+def read_inputs(data_path, mapping_path, csv_engine='c', text_categories=False):
+    """
+    Reads and checks the mappings file and the data file, which is read from standard input when its path is '-'.
+    Returns:
+        tuple: The data rows and the cleaned mappings.
+    Raises:
+        KeyError: If a required column is missing in the data or in the mappings.
+    """
+
+    mapping_df = dataPreprocessing.clean_data(pd.read_csv(mapping_path, encoding='utf-8-sig'))
+    source = sys.stdin.buffer.read() if data_path == '-' else data_path
+    data_df = dataPreprocessing.read_data_file(source, mapping_df, csv_engine, text_categories)
+    dataPreprocessing.validate_inputs(data_df, mapping_df)
+    return data_df, mapping_df
+
+
+def prepare_work_folder(work_folder, udf_path):
+    """
+    Creates the folders of initiate.py in the work folder, with a copy of the UDF file.
+    """
+
+    initiate.check_or_create_directories(work_folder)
+    target = os.path.join(work_folder, config.PYTHON_FOLDER, config.UDF_FILENAME)
+    if os.path.abspath(udf_path) != os.path.abspath(target):
+        shutil.copyfile(udf_path, target)
+
+
+def materialize(df, work_folder, mode='catalogue', output_format='ntriples', data_format='memory', backend='morph',
+                processes=None, report=None):
+    """
+    Materializes the preprocessed rows of every valid field like initiate.py, and combines the result into the
+    output file of the work folder.
+    Returns:
+        str: Path of the combined output, or None when no field is valid.
+    Raises:
+        RuntimeError: If the catalogue or the shared mappings cannot be materialized.
+    """
+
+    groups = list(initiate.filter_valid_groups(df))
+    if not groups:
+        return None
+    initiate.cache_udf_loading()
+
+    if mode == 'catalogue':
+        # The instance file of the catalogue is the whole output
+        with profiling.stage(report, 'materialize'):
+            return initiate.generate_catalogue_and_serialize(groups, work_folder, processes, output_format,
+                                                             data_format, backend)
+
+    output_path = os.path.join(work_folder, OUTPUT_FILENAMES[output_format])
+    with profiling.stage(report, 'materialize'):
+        initiate.materialize_shared((group for _, group in groups), work_folder, output_format, data_format,
+                                    backend=backend)
+        for field_id, group in groups:
+            try:
+                initiate.materialize_field(field_id, group, work_folder, output_format=output_format,
+                                           intermediate_format=data_format, backend=backend)
+            except RuntimeError as e:
+                print(f"Exiting '{field_id}' due to: {e}", file=sys.stderr)
+
+    with profiling.stage(report, 'combine'):
+        instances_folder = os.path.join(work_folder, config.INSTANCES_FOLDER)
+        if output_format == 'ntriples':
+            invalid_lines, _ = initiate.combine_nt_files(instances_folder, output_path, config.DEDUP_MEMORY_MB)
+            if invalid_lines:
+                print(f"{invalid_lines} invalid N-Triples lines were skipped", file=sys.stderr)
+        else:
+            initiate.combine_ttl_files(instances_folder, output_path)
+    return output_path
+
+
+def write_output(output_path, destination, stdout):
+    """
+    Copies the combined output to its destination, or to the binary stream stdout when it is '-'. Without output,
+    an empty file is written.
+    """
+
+    if destination == '-':
+        if output_path is not None:
+            with open(output_path, 'rb') as output_file:
+                shutil.copyfileobj(output_file, stdout)
+        stdout.flush()
+        return
+    if output_path is None:
+        open(destination, 'w', encoding='utf-8').close()
+    elif os.path.abspath(output_path) != os.path.abspath(destination):
+        shutil.copyfile(output_path, destination)
+
+
+def main(data_path, mapping_path, output='-', mode='catalogue', output_format='ntriples', backend='morph',
+         processes=None, engine='columnar', csv_engine='c', keep_intermediates=None, udf_path=None,
+         profile_report=None, stdout=None, text_categories=False):
+    """
+    Runs dataPreprocessing.py and initiate.py in a single process: the DataFrame of the preprocessing is handed to
+    the materialization, and the data of each field to the backend, without writing them to files. Only the rules and
+    instance files of the backends are written, to a temporary folder removed at the end, unless keep_intermediates
+    names a folder where every intermediate file of both scripts is kept. The output is written to the binary
+    stream stdout when it is '-', standard output by default.
+    """
+
+    report = profiling.new_report('run_pipeline.py') if profile_report else None
+    udf_path = udf_path or os.path.join(os.path.dirname(os.path.abspath(__file__)), config.UDF_FILENAME)
+    work_folder = keep_intermediates or tempfile.mkdtemp(prefix='rdf_pipeline_')
+    try:
+        prepare_work_folder(work_folder, udf_path)
+        with profiling.stage(report, 'read_inputs') as entry:
+            data_df, mapping_df = read_inputs(data_path, mapping_path, csv_engine, text_categories)
+            entry['rows'] = len(data_df)
+
+        indices = None
+        if keep_intermediates:
+            indices = dataPreprocessing.load_mapping_index(
+                mapping_path, mapping_df,
+                os.path.join(work_folder, config.PREPROCESSED_FOLDER, config.MAPPING_INDEX_FILENAME))
+        result_df = dataPreprocessing.process_data(data_df, mapping_df, engine, report, indices)
+        if keep_intermediates:
+            with profiling.stage(report, 'write_preprocessed'):
+                result_df.to_csv(os.path.join(work_folder, config.PREPROCESSED_FOLDER, config.PREPROCESSED_FILENAME),
+                                 index=False, encoding='utf-8-sig')
+
+        with profiling.stage(report, 'to_text') as entry:
+            df = initiate.preprocessed_text(result_df)
+            entry['rows'] = len(df)
+        data_format = 'csv' if keep_intermediates else 'memory'
+        output_path = materialize(df, work_folder, mode, output_format, data_format, backend, processes, report)
+        write_output(output_path, output, stdout or sys.stdout.buffer)
+    finally:
+        if not keep_intermediates:
+            shutil.rmtree(work_folder, ignore_errors=True)
+    if report is not None:
+        profiling.write_report(report, profile_report)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Preprocess a data file and generate its RDF in a single process.")
+    parser.add_argument('csv_data_path', type=str, help="Path to the CSV data file, or '-' to read it from stdin")
+    parser.add_argument('csv_mapping_path', type=str, help='Path to the CSV mapping file')
+    parser.add_argument('-o', '--output', type=str, default='-',
+                        help="Path of the RDF output, or '-' to write it to stdout (the default)")
+    parser.add_argument('--mode', choices=['field', 'catalogue'], default='catalogue',
+                        help='Materialize every field in a single backend call, or each field separately')
+    parser.add_argument('--output-format', choices=sorted(OUTPUT_FILENAMES), default='ntriples',
+                        help='Format of the RDF output')
+    parser.add_argument('--backend', choices=config.BACKENDS, default='morph',
+                        help='Materialize the rules with morph_kgc, or with the native backend')
+    parser.add_argument('--processes', type=int, default=None,
+                        help="Number of morph_kgc processes used in catalogue mode, morph_kgc's default if not given")
+    parser.add_argument('--engine', choices=['columnar', 'rows'], default='columnar',
+                        help='Process whole columns at once, or iterate over every data row')
+    parser.add_argument('--csv-engine', choices=config.CSV_ENGINES, default='c',
+                        help='Parser of the data file, pyarrow is faster on large files (requires pyarrow)')
+    parser.add_argument('--text-categories', action='store_true',
+                        help='Read the text fields as categorical columns with the text of the file, which uses less '
+                             'memory but parses slower')
+    parser.add_argument('--keep-intermediates', type=str, default=None, metavar='FOLDER',
+                        help='Write the preprocessed data, the data file of each field, the rules and the instance '
+                             'files to FOLDER, laid out like the project folder of initiate.py')
+    parser.add_argument('--udf', type=str, default=None, metavar='PATH',
+                        help='UDF file of the rules, udf.py next to this script by default')
+    parser.add_argument('--profile-report', type=str, default=None, metavar='PATH',
+                        help='Write a JSON report with the time, row count and peak memory of each stage')
+    args = parser.parse_args()
+
+    # Everything the scripts print goes to stderr, so that stdout only carries the RDF
+    stdout = sys.stdout.buffer
+    with contextlib.redirect_stdout(sys.stderr if args.output == '-' else sys.stdout):
+        try:
+            main(args.csv_data_path, args.csv_mapping_path, args.output, args.mode, args.output_format, args.backend,
+                 args.processes, args.engine, args.csv_engine, args.keep_intermediates, args.udf,
+                 args.profile_report, stdout, args.text_categories)
+        except (FileNotFoundError, KeyError, RuntimeError, pd.errors.EmptyDataError, pd.errors.ParserError) as e:
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
@@ -0,0 +1,197 @@
+import os
+import re
+import shutil
+import zlib
+from urllib.parse import quote
+
+import pandas as pd
+
+import config
+
+
+def shard_name(shard_index, shard_count):
+    return f"shard-{shard_index}-of-{shard_count}"
+
+
+def check_shard_arguments(parser, args):
+    """
+    Checks the --shard-index and --shard-count arguments of a script, and exits with a usage error if they are not
+    given together or the index is out of range.
+    Returns:
+        tuple: The shard index and count, or None when the script does not run a shard.
+    """
+
+    if args.shard_index is None and args.shard_count is None:
+        return None
+    if args.shard_index is None or args.shard_count is None:
+        parser.error("--shard-index and --shard-count must be given together")
+    if args.shard_count < 1 or not 0 <= args.shard_index < args.shard_count:
+        parser.error("--shard-index must be between 0 and --shard-count - 1")
+    return args.shard_index, args.shard_count
+
+
+def case_shards(case_ids, shard_count):
+    """
+    Assigns each case id to a shard with a hash of its text, which is the same on every machine and Python process,
+    unlike hash(). Every row of a case goes to the same shard.
+    Args:
+        case_ids (pd.Series): The case id of each row.
+        shard_count (int): Number of shards.
+    Returns:
+        pd.Series: The shard of each row, with the index of case_ids.
+    """
+
+    case_ids = case_ids.astype(str)
+    shards = {case_id: zlib.crc32(case_id.encode('utf-8')) % shard_count for case_id in pd.unique(case_ids)}
+    return case_ids.map(shards)
+
+
+def select_shard(data_df, shard):
+    """
+    Keeps only the rows of the cases of a shard.
+    Args:
+        data_df (pd.DataFrame): Data or preprocessed rows, with a case id column.
+        shard (tuple): The shard index and count, or None to keep every row.
+    """
+
+    if shard is None or data_df.empty:
+        return data_df
+    shard_index, shard_count = shard
+    return data_df[case_shards(data_df[config.CASE_ID_COLUMN], shard_count) == shard_index]
+
+
+def reference_rows(preprocessed_df):
+    """
+    Returns the preprocessed rows that decide the rules of each field in initiate.py: its first row, which the rules
+    are generated from, and its first row with an empty pattern type, which leaves the whole field out.
+    """
+
+    if preprocessed_df.empty:
+        return preprocessed_df
+    first_rows = preprocessed_df.drop_duplicates('field_id')
+    pattern_types = preprocessed_df['pattern_type']
+    empty_patterns = preprocessed_df[pattern_types.isna() | (pattern_types.astype(str) == '')]
+    empty_patterns = empty_patterns.drop_duplicates('field_id')
+    return pd.concat([first_rows, empty_patterns[~empty_patterns.index.isin(first_rows.index)]])
+
+
+def foreign_reference_rows(reference, shard, field_ids):
+    """
+    Returns the reference rows of the given fields that belong to the cases of other shards.
+    """
+
+    if reference is None or reference.empty:
+        return pd.DataFrame([])
+    foreign = reference[reference['field_id'].isin(field_ids)]
+    return foreign[case_shards(foreign[config.CASE_ID_COLUMN], shard[1]) != shard[0]]
+
+
+def shard_rows(preprocessed_df, shard, reference=None):
+    """
+    Keeps the preprocessed rows of the cases of a shard, preceded by the reference rows of its fields that belong to
+    other shards. Every shard then generates the rules of a field from the same row as a run over every case, and
+    leaves out the same fields, so the triples of all the shards together are the triples of that run. The few
+    triples of the reference rows that a shard repeats are removed when the shards are merged.
+    Args:
+        preprocessed_df (pd.DataFrame): Preprocessed rows of every case.
+        shard (tuple): The shard index and count.
+        reference (pd.DataFrame, optional): The reference rows of every case. Defaults to those of preprocessed_df.
+    Returns:
+        pd.DataFrame: The rows of the shard.
+    """
+
+    if reference is None:
+        reference = reference_rows(preprocessed_df)
+    rows = select_shard(preprocessed_df, shard)
+    if rows.empty:
+        return rows
+    foreign = foreign_reference_rows(reference, shard, rows['field_id'].unique())
+    if foreign.empty:
+        return rows
+    return pd.concat([foreign, rows], ignore_index=True)
+
+
+def own_lines(lines, case_ids, foreign_ids):
+    """
+    Leaves out the triples of the reference rows of other cases, which are added to the rows of a run to generate
+    its rules. The IRIs of the nodes of a case end with its identifier, so a triple whose IRIs only name foreign
+    cases comes from their rows. The triples that name no case, such as the classes of the concepts, are kept.
+    Args:
+        lines (list): N-Triples lines.
+        case_ids (set): Identifiers of the cases of the run.
+        foreign_ids (set): Identifiers of the cases of the reference rows that were added.
+    Returns:
+        list: The lines of the cases of the run.
+    """
+
+    if not foreign_ids:
+        return lines
+    # The longest identifiers first, so that an identifier that ends another one is not taken for it
+    identifiers = case_ids | foreign_ids
+    identifiers = sorted(identifiers | {quote(case_id, safe='') for case_id in identifiers}, key=len, reverse=True)
+    pattern = re.compile(r"_({})>".format('|'.join(map(re.escape, identifiers))))
+    foreign = foreign_ids | {quote(case_id, safe='') for case_id in foreign_ids}
+    kept = []
+    for line in lines:
+        named = set(pattern.findall(line))
+        if not named or not named <= foreign:
+            kept.append(line)
+    return kept
+
+
+def shard_folder(main_folder, shard):
+    return os.path.join(main_folder, config.SHARDS_FOLDER, shard_name(*shard))
+
+
+def prepare_shard_folder(main_folder, shard):
+    """
+    Creates the folder where a shard writes its data files, rules, instance files, cache and output, with a copy of
+    the UDF file of the project, so that shards running at the same time on a shared filesystem never write the
+    same files.
+    Returns:
+        str: The shard folder, used by initiate.py as its main folder.
+    """
+
+    folder = shard_folder(main_folder, shard)
+    python_folder = os.path.join(folder, config.PYTHON_FOLDER)
+    os.makedirs(python_folder, exist_ok=True)
+    shutil.copyfile(os.path.join(main_folder, config.PYTHON_FOLDER, config.UDF_FILENAME),
+                    os.path.join(python_folder, config.UDF_FILENAME))
+    return folder
+
+
+def shard_outputs(main_folder, shard_count, output_filename):
+    """
+    Returns the output file of every shard of a run, in shard order.
+    """
+
+    return [os.path.join(shard_folder(main_folder, (shard_index, shard_count)), output_filename)
+            for shard_index in range(shard_count)]
+
+
+class ChunkSharder:
+    """
+    Applies shard_rows to preprocessed data produced in chunks: keeps the rows of the shard of each chunk and the
+    reference rows of the chunks seen so far, and returns the foreign reference rows once every chunk is processed.
+    """
+
+    def __init__(self, shard):
+        self.shard = shard
+        self.reference = None
+        self.field_ids = set()
+
+    def select(self, chunk_df):
+        if self.shard is None or chunk_df.empty:
+            return chunk_df
+        chunk_reference = reference_rows(chunk_df)
+        if self.reference is not None:
+            chunk_reference = reference_rows(pd.concat([self.reference, chunk_reference], ignore_index=True))
+        self.reference = chunk_reference.reset_index(drop=True)
+        rows = select_shard(chunk_df, self.shard)
+        self.field_ids.update(rows['field_id'])
+        return rows
+
+    def foreign_rows(self):
+        if self.shard is None:
+            return pd.DataFrame([])
+        return foreign_reference_rows(self.reference, self.shard, self.field_ids)
@@ -0,0 +1,167 @@
+import argparse
+import os
+import sys
+import uuid
+
+import numpy as np
+import pandas as pd
+
+import config
+import dataPreprocessing
+
+# Ranges of the Integer fields whose values have a clinical meaning, the rest are drawn from DEFAULT_INTEGER_RANGE
+INTEGER_RANGES = {
+    'age': (18, 100),
+    'systolic_pressure': (80, 220),
+    'diastolic_pressure': (40, 130),
+    'nihss_score': (0, 43),
+    'aspects_score': (0, 11),
+    'cholesterol': (1, 10),
+    'glucose': (3, 25),
+}
+DEFAULT_INTEGER_RANGE = (0, 100)
+BOOLEAN_VALUES = np.array(['VERDADERO', 'FALSO'], dtype=object)
+QUARTERS = np.array(['Q1', 'Q2', 'Q3', 'Q4'], dtype=object)
+# Columns of the data file that are not fields of the mappings file
+PROVIDER_COLUMNS = {'provider': 'Demo hospital', 'provider_id': '1', 'source': '67'}
+# Suffix of the copies of a field when more fields than the mappings file has are requested
+COPY_SUFFIX = '__copy'
+
+
+def select_fields(mapping_df, fields):
+    """
+    Returns the mapping rows of the first fields of the mappings file. When more fields than the file has are
+    requested, the fields are repeated as copies with a numbered suffix, so that the cohort can also grow along
+    the number of fields.
+    Args:
+        mapping_df (pd.DataFrame): The cleaned mapping DataFrame.
+        fields (int, optional): Number of fields, None for all of them.
+    Returns:
+        pd.DataFrame: The mapping rows of the selected fields.
+    """
+
+    mapping_df = mapping_df[mapping_df['field_id'].notna() & (mapping_df['field_id'] != '')]
+    field_ids = list(dict.fromkeys(mapping_df['field_id']))
+    if fields is None or fields <= len(field_ids):
+        return mapping_df[mapping_df['field_id'].isin(field_ids[:fields])]
+
+    copies = [mapping_df]
+    for copy in range(1, -(-fields // len(field_ids))):
+        copied_ids = field_ids[:fields - copy * len(field_ids)]
+        copied = mapping_df[mapping_df['field_id'].isin(copied_ids)].copy()
+        copied['field_id'] = copied['field_id'] + f"{COPY_SUFFIX}{copy}"
+        copies.append(copied)
+    return pd.concat(copies, ignore_index=True)
+
+
+def generate_values(field_rows, cases, rng):
+    """
+    Generates the raw values of a field for every case, as they appear in the data files: the categorical values
+    of the field, VERDADERO/FALSO for Boolean fields, and numbers, timestamps, quarters or text otherwise.
+    Args:
+        field_rows (pd.DataFrame): The mapping rows of the field.
+        cases (int): Number of values.
+        rng (np.random.Generator): Random generator.
+    Returns:
+        np.ndarray: Object array with the values.
+    """
+
+    field_id = field_rows['field_id'].iloc[0].split(COPY_SUFFIX)[0]
+    value_type = str(field_rows['value_type'].iloc[0]).strip()
+    categorical_values = pd.unique(field_rows['categorical_value'].dropna())
+    categorical_values = np.array([value for value in categorical_values if value != ''], dtype=object)
+
+    if len(categorical_values):
+        return rng.choice(categorical_values, cases)
+    if value_type == 'Boolean':
+        return rng.choice(BOOLEAN_VALUES, cases)
+    if value_type == 'Integer':
+        low, high = INTEGER_RANGES.get(field_id, DEFAULT_INTEGER_RANGE)
+        return rng.integers(low, high, cases).astype(str).astype(object)
+    if value_type == 'Float':
+        low, high = INTEGER_RANGES.get(field_id, DEFAULT_INTEGER_RANGE)
+        return np.round(rng.uniform(low, high, cases), 1).astype(str).astype(object)
+    if value_type == 'DateTime':
+        seconds = rng.integers(0, 365 * 24 * 3600, cases)
+        timestamps = np.datetime64('2023-01-01T00:00:00') + seconds.astype('timedelta64[s]')
+        return np.datetime_as_string(timestamps).astype(object)
+    if value_type == 'Date':
+        return ('2023 ' + rng.choice(QUARTERS, cases)).astype(object)
+    return np.char.add('value ', rng.integers(0, 50, cases).astype(str)).astype(object)
+
+
+def generate_cohort(mapping_df, cases, missing_rate=0.1, seed=0, first_case=0):
+    """
+    Generates a data file with one row per case and one column per field of the mappings file.
+    Args:
+        mapping_df (pd.DataFrame): The mapping rows of the fields, as returned by select_fields.
+        cases (int): Number of cases.
+        missing_rate (float): Fraction of empty values of each field.
+        seed (int): Seed of the random generator, the same seed gives the same cohort.
+        first_case (int): Number of cases generated before, used to continue a cohort in chunks.
+    Returns:
+        pd.DataFrame: The data of the cohort.
+    """
+
+    rng = np.random.default_rng([seed, first_case])
+    case_ids = [str(uuid.UUID(bytes=rng.bytes(16), version=4)) for _ in range(cases)]
+    columns = {config.CASE_ID_COLUMN: case_ids}
+    columns.update({column: [value] * cases for column, value in PROVIDER_COLUMNS.items()})
+
+    for field_id, field_rows in mapping_df.groupby('field_id', sort=False):
+        values = generate_values(field_rows, cases, rng)
+        values[rng.random(cases) < missing_rate] = ''
+        columns[field_id] = values
+    return pd.DataFrame(columns)
+
+
+def write_cohort(mapping_df, cases, output_path, missing_rate=0.1, seed=0, chunksize=100000):
+    """
+    Writes a synthetic cohort to a CSV file in chunks of cases, so that memory does not grow with the cohort.
+    """
+
+    for first_case in range(0, cases, chunksize):
+        chunk = generate_cohort(mapping_df, min(chunksize, cases - first_case), missing_rate, seed, first_case)
+        chunk.to_csv(output_path, index=False, header=first_case == 0, mode='w' if first_case == 0 else 'a',
+                     encoding='utf-8-sig' if first_case == 0 else 'utf-8')
+
+
+def main(path_csv_mapping, output_folder, cases, fields=None, missing_rate=0.1, seed=0, chunksize=100000):
+    """
+    Writes the data file of a synthetic cohort and the mappings file of its fields to output_folder.
+    Returns:
+        tuple: Paths of the data file and of the mappings file.
+    """
+
+    if not os.path.exists(path_csv_mapping):
+        raise FileNotFoundError(f"The CSV mapping file does not exist: {path_csv_mapping}")
+
+    mapping_df = dataPreprocessing.clean_data(pd.read_csv(path_csv_mapping, encoding='utf-8-sig'))
+    mapping_df = select_fields(mapping_df, fields)
+
+    os.makedirs(output_folder, exist_ok=True)
+    data_path = os.path.join(output_folder, 'synthetic_data.csv')
+    mappings_path = os.path.join(output_folder, 'synthetic_mappings.csv')
+    mapping_df.to_csv(mappings_path, index=False, encoding='utf-8-sig')
+    write_cohort(mapping_df, cases, data_path, missing_rate, seed, chunksize)
+    return data_path, mappings_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic cohort from the mappings file.")
+    parser.add_argument('csv_mapping_path', type=str, help='Path to the CSV mapping file')
+    parser.add_argument('output_folder', type=str, help='Folder for the data file and the mappings file')
+    parser.add_argument('--cases', type=int, default=1000, help='Number of cases')
+    parser.add_argument('--fields', type=int, default=None,
+                        help='Number of fields, repeating the fields of the mappings file when it has fewer')
+    parser.add_argument('--missing-rate', type=float, default=0.1, help='Fraction of empty values of each field')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random generator')
+    parser.add_argument('--chunksize', type=int, default=100000, help='Number of cases generated at once')
+    args = parser.parse_args()
+    try:
+        paths = main(args.csv_mapping_path, args.output_folder, args.cases, args.fields, args.missing_rate,
+                     args.seed, args.chunksize)
+    except (FileNotFoundError, KeyError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    print(f"Wrote {args.cases} cases to '{paths[0]}' and their mappings to '{paths[1]}'")
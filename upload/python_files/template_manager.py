@@ -1,5 +1,5 @@
-def generate_yarrrml_template(csv_file_name):
-    template = f"""
+def generate_yarrrml_header():
+    header = """
     authors: Catalina Martinez-Costa <cmartinezcosta@um.es>
     prefixes:
       base: http://stratifai-resources/ontologies/stratifai-data#
@@ -7,7 +7,7 @@ def generate_yarrrml_template(csv_file_name):
       sct: http://snomed.info/id/
       scdm: http://www.semanticweb.org/catimc/SemanticCommonDataModel#
       btl2: http://purl.org/biotop/btl2.owl#
-      fno:  https://w3id.org/function/ontology# 
+      fno:  https://w3id.org/function/ontology#
       fnom: https://w3id.org/function/vocabulary/mapping#
       ex: http://example.org/functions#
       stratifai-function: http://ontology.stratifai.um.es/STRATIF-AI_Functions/
@@ -17,16 +17,19 @@ def generate_yarrrml_template(csv_file_name):
 
 
     mappings:
+"""
 
-        ClinicalCase:
-            sources: 
+    return header
+
+
+# Mappings that depend on the field of each row, read from the data of the field
+def generate_field_mappings(csv_file_name):
+    mappings = f"""
+        ClinicalCasePart:
+            sources:
                     - ['{csv_file_name}~csv']
             s: base:Case_$(case_id)
             po:
-              - [a, stratifai:ClinicalCase]
-              - [stratifai:caseId, $(case_id), xsd:string]
-              - [scdm:hasInformationAboutProvider, base:InformationAboutStratifAIProviderOfInformation_$(case_id)~iri]
-              - [scdm:hasInformationAboutProvider, base:InformationAboutStratifAISourceOfInformation_$(case_id)~iri]
               - p: scdm:hasPart
                 o:
                 - function: stratifai-function:generatePart
@@ -39,9 +42,27 @@ def generate_yarrrml_template(csv_file_name):
                     value: $(ontology_mapping)
                   - parameter: grel:valueParam3
                     value: $(case_id)
-                  type: iri       
+                  type: iri
+"""
+
+    return mappings
+
+
+# Mappings that only depend on the case id, the same for every field of a case
+def generate_case_mappings(csv_file_name):
+    mappings = f"""
+        ClinicalCase:
+            sources:
+                    - ['{csv_file_name}~csv']
+            s: base:Case_$(case_id)
+            po:
+              - [a, stratifai:ClinicalCase]
+              - [stratifai:caseId, $(case_id), xsd:string]
+              - [scdm:hasInformationAboutProvider, base:InformationAboutStratifAIProviderOfInformation_$(case_id)~iri]
+              - [scdm:hasInformationAboutProvider, base:InformationAboutStratifAISourceOfInformation_$(case_id)~iri]
+
         InformationAboutProvider:
-            sources: 
+            sources:
                     - ['{csv_file_name}~csv']
             s: base:InformationAboutStratifAIProviderOfInformation_$(case_id)
             po:
@@ -49,30 +70,37 @@ def generate_yarrrml_template(csv_file_name):
               - [btl2:represents, base:StratifAIProvider_$(case_id)~iri]
 
         InformationAboutSource:
-            sources: 
+            sources:
                     - ['{csv_file_name}~csv']
             s: base:InformationAboutStratifAISourceOfInformation_$(case_id)
             po:
               - [a, stratifai:InformationAboutStratifAISourceOfInformation]
               - [btl2:represents, base:StratifAISource_$(case_id)~iri]
-        
+
         StratifAIProvider:
-            sources: 
+            sources:
                     - ['{csv_file_name}~csv']
             s: base:StratifAIProvider_$(case_id)
             po:
-              - [a, stratifai:StratifAIProvider] 
+              - [a, stratifai:StratifAIProvider]
 
         StratifAISource:
-            sources: 
+            sources:
                     - ['{csv_file_name}~csv']
             s: base:StratifAISource_$(case_id)
             po:
               - [a, stratifai:StratifAISource]
-              #- [base:sourceId,$(source)]        
-        
+              #- [base:sourceId,$(source)]
+"""
+
+    return mappings
+
+
+# Mappings of the context entities, which only depend on the context columns and not on the case
+def generate_context_mappings(csv_file_name):
+    mappings = f"""
         StatementTemporalContext:
-            sources: 
+            sources:
                 - ['{csv_file_name}~csv']
             s:
             - function: stratifai-function:generate_temporal_context
@@ -82,9 +110,9 @@ def generate_yarrrml_template(csv_file_name):
               type: iri
             po:
                 - [a, $(temporal_context)~iri]
-            
+
         StatementContext:
-            sources: 
+            sources:
                 - ['{csv_file_name}~csv']
             s:
             - function: stratifai-function:generate_statement_context
@@ -96,7 +124,7 @@ def generate_yarrrml_template(csv_file_name):
                 - [a, $(statement_context)~iri]
 
         ProcedureLocation:
-            sources: 
+            sources:
                 - ['{csv_file_name}~csv']
             s:
             - function: stratifai-function:generate_procedure_location
@@ -108,7 +136,7 @@ def generate_yarrrml_template(csv_file_name):
                 - [a, $(procedure_location)~iri]
 
         ProcedureReason:
-            sources: 
+            sources:
                 - ['{csv_file_name}~csv']
             s:
             - function: stratifai-function:generate_procedure_reason
@@ -118,20 +146,28 @@ def generate_yarrrml_template(csv_file_name):
               type: iri
             po:
                 - [a, $(procedure_reason)~iri]
-        
-        ProcedureDateTime:        
-          sources: 
+
+        ProcedureDateTime:
+          sources:
               - ['{csv_file_name}~csv']
-          s: 
+          s:
           - function: stratifai-function:generate_procedure_dateTime
-            parameters: 
+            parameters:
             - parameter: grel:valueParam
               value: $(procedure)
             - parameter: grel:valueParam1
               value: $(categorical_ontology_mapping)
             type: iri
           po:
-            - [a, $(categorical_ontology_mapping)~iri]  
-    """
+            - [a, $(categorical_ontology_mapping)~iri]
+"""
+
+    return mappings
+
+
+# Template with every mapping reading the same data file
+def generate_yarrrml_template(csv_file_name):
+    template = (generate_yarrrml_header() + generate_field_mappings(csv_file_name)
+                + generate_case_mappings(csv_file_name) + generate_context_mappings(csv_file_name))
 
-    return template
\ No newline at end of file
+    return template
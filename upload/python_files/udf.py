@@ -1,7 +1,16 @@
 import morph_kgc
+import sys
+from functools import lru_cache
 from rdflib import URIRef
 
 
+# Returns the part of an IRI after the last '#', or after the last '/' if it has no '#'.
+# The same few IRIs are passed for every case, so the results are cached and interned.
+@lru_cache(maxsize=4096)
+def local_name(iri):
+    return sys.intern(iri.rpartition('#')[2] if '#' in iri else iri.rpartition('/')[2])
+
+
 @udf( # type: ignore
     fun_id = "http://ontology.stratifai.um.es/STRATIF-AI_Functions/add_procedure_dateTime",
     procedure = "http://users.ugent.be/bjdmeest/function/grel.ttl#valueParam",
@@ -12,7 +21,7 @@ def add_procedure_dateTime(procedure,temporal_context):
     base = "http://stratifai-resources/ontologies/stratifai-data#"
     if procedure != 'dateTime':
         return
-    uri = temporal_context.split('#')[-1] if '#' in temporal_context else temporal_context.split('/')[-1]
+    uri = local_name(temporal_context)
     return f"{base}{uri}"
 
 @udf( # type: ignore
@@ -25,7 +34,7 @@ def generate_procedure_dateTime(procedure,temporal_context):
     base = "http://stratifai-resources/ontologies/stratifai-data#"
     if procedure != 'dateTime':
         return
-    uri = temporal_context.split('#')[-1] if '#' in temporal_context else temporal_context.split('/')[-1]
+    uri = local_name(temporal_context)
     return f"{base}{uri}"
 
 @udf( # type: ignore
@@ -36,7 +45,7 @@ def add_temporal_context(temporal_context):
     base = "http://stratifai-resources/ontologies/stratifai-data#"
     if temporal_context == 'nan':
         return None
-    uri = temporal_context.split('#')[-1] if '#' in temporal_context else temporal_context.split('/')[-1]
+    uri = local_name(temporal_context)
     return f"{base}{uri}"
 
 @udf( # type: ignore
@@ -47,7 +56,7 @@ def generate_temporal_context(temporal_context):
     base = "http://stratifai-resources/ontologies/stratifai-data#"
     if temporal_context == 'nan':
         return None
-    uri = temporal_context.split('#')[-1] if '#' in temporal_context else temporal_context.split('/')[-1]
+    uri = local_name(temporal_context)
     return f"{base}{uri}"
 
 @udf( # type: ignore
@@ -58,7 +67,7 @@ def generate_procedure_location(location):
     base = "http://stratifai-resources/ontologies/stratifai-data#"
     if location.strip() == 'nan':
         return None
-    uri =location.split('#')[-1] if '#' in location else location.split('/')[-1]
+    uri =local_name(location)
     return f"{base}ProcedureLocation_{uri}"
 
 @udf( # type: ignore
@@ -69,7 +78,7 @@ def generate_procedure_reason(reason):
     base = "http://stratifai-resources/ontologies/stratifai-data#"
     if reason.strip() == 'nan':
         return None
-    uri =reason.split('#')[-1] if '#' in reason else reason.split('/')[-1]
+    uri =local_name(reason)
     return f"{base}ProcedureReason_{uri}"
 
 
@@ -81,7 +90,7 @@ def generate_statement_context(statement_context):
     base = "http://stratifai-resources/ontologies/stratifai-data#"
     if statement_context.strip() == 'nan':
         return None
-    uri = statement_context.split('#')[-1] if '#' in statement_context else statement_context.split('/')[-1]
+    uri = local_name(statement_context)
     return f"{base}{uri}"
 # case ObservationResultStatement and boolean datatype (onset_time_known)
 # if field_value is true then known present
@@ -118,7 +127,7 @@ def add_situation_context(datatype,field_value,context):
         if field_value in ['FALSE','FALSO']:
             return "http://snomed.info/id/410516002" #known absent
     elif datatype.strip() == 'Categorical':
-        uri = context.split('#')[-1] if '#' in context else context.split('/')[-1]
+        uri = local_name(context)
         return f"{base}{uri}"
     return
 
@@ -153,7 +162,7 @@ def add_procedure_statement_context(datatype,field_value,categorical_mapping):
 def add_procedure_reason(type,reason):
     base = "http://stratifai-resources/ontologies/stratifai-data#"
     if type == 'procedureReason':
-        reason = reason.split('#')[-1] if '#' in reason else reason.split('/')[-1]
+        reason = local_name(reason)
         return f"{base}ProcedureReason_{reason}"
     return
 
@@ -165,7 +174,7 @@ def add_procedure_reason(type,reason):
 def add_procedure_location(type,location):
     base = "http://stratifai-resources/ontologies/stratifai-data#"
     if type == 'procedureLocation':
-        location = location.split('#')[-1] if '#' in location else location.split('/')[-1]
+        location = local_name(location)
         return f"{base}ProcedureLocation_{location}"
     return
 
@@ -190,13 +199,13 @@ def add_procedure_performer(type):
 def generateDynamicSubject(type,procedure,field_value,categorical_ontology_mapping,case_id):
     base = "http://stratifai-resources/ontologies/stratifai-data#"
     if type == 'Boolean':
-        uri = procedure.split('#')[-1] if '#' in procedure else procedure.split('/')[-1]
+        uri = local_name(procedure)
     #Categorical
     else:
         if field_value.capitalize() in ['Yes','No']:
-            uri = procedure.split('#')[-1] if '#' in procedure else procedure.split('/')[-1]
+            uri = local_name(procedure)
         else:
-            uri = categorical_ontology_mapping.split('#')[-1] if '#' in categorical_ontology_mapping else categorical_ontology_mapping.split('/')[-1]
+            uri = local_name(categorical_ontology_mapping)
     return f"{base}{uri}_{case_id}"
 
 
@@ -228,7 +237,7 @@ def generateDynamicObject(type,procedure,field_value,categorical_ontology_mappin
 )
 def extract_last_part(uri,case_id):
     base = "http://stratifai-resources/ontologies/stratifai-data#"
-    uri = uri.split('#')[-1] if '#' in uri else uri.split('/')[-1]
+    uri = local_name(uri)
     #print(f"base:{uri}_{case_id}")
     return f"{base}{uri}_{case_id}"
  
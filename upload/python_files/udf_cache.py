@@ -0,0 +1,164 @@
+import functools
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from morph_kgc import materializer
+from morph_kgc.fnml import fnml_executer
+
+# Calls, cache hits and seconds spent in each UDF by the current process
+stats = {}
+# Cache hits that each memoized UDF had already counted when the current process was forked
+hits_offset = {}
+memoized_functions = {}
+stats_folder = None
+
+
+def memoize(fun_id, function, maxsize):
+    """
+    Wraps a UDF so that its calls and the time spent in it are counted. When maxsize is not 0, the results are
+    also kept in a bounded LRU cache keyed by the arguments.
+    Args:
+        fun_id (str): IRI of the function.
+        function (callable): The Python function.
+        maxsize (int): Number of results kept, 0 to only count the calls.
+    Returns:
+        callable: The wrapped function.
+    """
+
+    counters = stats.setdefault(fun_id, [0, 0, 0.0])
+    cached = functools.lru_cache(maxsize=maxsize)(function) if maxsize else None
+    if cached is not None:
+        memoized_functions[fun_id] = cached
+    perf_counter = time.perf_counter
+
+    def wrapper(**arguments):
+        counters[0] += 1
+        start = perf_counter()
+        try:
+            if cached is None:
+                return function(**arguments)
+            try:
+                return cached(**arguments)
+            except TypeError:
+                # morph_kgc passes lists for parameters with several values, which cannot be cache keys
+                return function(**arguments)
+        finally:
+            counters[2] += perf_counter() - start
+
+    wrapper.memoized = True
+    return functools.update_wrapper(wrapper, function)
+
+
+def memoize_udfs(udf_dict, maxsize):
+    """
+    Wraps every function of a dictionary of UDFs loaded by morph_kgc, in place.
+    """
+
+    for fun_id, udf in udf_dict.items():
+        if not getattr(udf['function'], 'memoized', False):
+            udf['function'] = memoize(fun_id, udf['function'], maxsize)
+    return udf_dict
+
+
+def current_stats():
+    """
+    Returns the counters of the current process, with the hits of each cache since the process started.
+    """
+
+    result = {}
+    for fun_id, (calls, _, seconds) in stats.items():
+        hits = 0
+        if fun_id in memoized_functions:
+            hits = memoized_functions[fun_id].cache_info().hits - hits_offset.get(fun_id, 0)
+        result[fun_id] = [calls, hits, seconds]
+    return result
+
+
+def flush_stats():
+    if stats_folder is None or not stats:
+        return
+    path = os.path.join(stats_folder, f"{os.getpid()}.json")
+    with open(path + '.tmp', 'w', encoding='utf-8') as stats_file:
+        json.dump(current_stats(), stats_file)
+    os.replace(path + '.tmp', path)
+
+
+def reset_after_fork():
+    # A forked process keeps the warm caches of its parent, but counts its own calls from zero
+    for counters in stats.values():
+        counters[:] = [0, 0, 0.0]
+    for fun_id, cached in memoized_functions.items():
+        hits_offset[fun_id] = cached.cache_info().hits
+
+
+def install(maxsize):
+    """
+    Makes morph_kgc wrap the UDFs it loads with memoize, and makes every process save its counters after each
+    function execution, so that read_stats can add up the counters of the processes spawned by morph_kgc and of
+    the worker processes. It must be called before those processes are forked.
+    Args:
+        maxsize (int): Number of results kept per function, 0 to only count the calls.
+    """
+
+    global stats_folder
+    if getattr(fnml_executer.load_udfs, 'memoized', False):
+        return
+
+    stats_folder = tempfile.mkdtemp(prefix='udf_stats_')
+    load_udfs = fnml_executer.load_udfs
+    execute_fnml = materializer.execute_fnml
+
+    def load_memoized_udfs(config):
+        return memoize_udfs(load_udfs(config), maxsize)
+
+    def execute_fnml_with_stats(*args, **kwargs):
+        try:
+            return execute_fnml(*args, **kwargs)
+        finally:
+            flush_stats()
+
+    load_memoized_udfs.memoized = True
+    load_memoized_udfs.cached = getattr(load_udfs, 'cached', False)
+    fnml_executer.load_udfs = load_memoized_udfs
+    materializer.execute_fnml = execute_fnml_with_stats
+    os.register_at_fork(after_in_child=reset_after_fork)
+
+
+def read_stats():
+    """
+    Adds up the counters saved by every process, and removes them.
+    Returns:
+        dict: Calls, cache hits and seconds of each function IRI.
+    """
+
+    flush_stats()
+    totals = {}
+    if stats_folder is None or not os.path.isdir(stats_folder):
+        return totals
+
+    for filename in os.listdir(stats_folder):
+        if not filename.endswith('.json'):
+            continue
+        with open(os.path.join(stats_folder, filename), 'r', encoding='utf-8') as stats_file:
+            for fun_id, counters in json.load(stats_file).items():
+                total = totals.setdefault(fun_id, [0, 0, 0.0])
+                for i, value in enumerate(counters):
+                    total[i] += value
+    shutil.rmtree(stats_folder, ignore_errors=True)
+    return totals
+
+
+def format_stats(totals):
+    """
+    Returns a table with the counters of each function, the most expensive first.
+    """
+
+    lines = [f"{'UDF':<40} {'calls':>10} {'hits':>10} {'hit rate':>9} {'seconds':>9}"]
+    for fun_id, (calls, hits, seconds) in sorted(totals.items(), key=lambda item: item[1][2], reverse=True):
+        name = fun_id.rsplit('/', 1)[-1]
+        rate = f"{hits / calls:.1%}" if calls else '-'
+        lines.append(f"{name:<40} {calls:>10} {hits:>10} {rate:>9} {seconds:>9.3f}")
+    return '\n'.join(lines)
@@ -0,0 +1,203 @@
+import os
+import re
+
+FUNCTION_PREFIX = 'stratifai-function:'
+FUNCTION_NAMESPACE = 'http://ontology.stratifai.um.es/STRATIF-AI_Functions/'
+PARAMETER_PREFIX = 'grel:'
+PARAMETER_NAMESPACE = 'http://users.ugent.be/bjdmeest/function/grel.ttl#'
+
+# Values that morph_kgc reads as missing. Rows with a missing function argument are dropped before the call.
+MISSING_VALUES = ('', 'nan')
+
+# Absolute IRIs that can be written in a YARRRML flow sequence and in an RML template without escaping
+SAFE_IRI_PATTERN = re.compile(r"^[A-Za-z][A-Za-z0-9+.-]*:[A-Za-z0-9\-._:/#?=&%@!*+;]*$")
+# Case ids that are not percent-encoded when they are part of an IRI template
+SAFE_CASE_ID_PATTERN = re.compile(r'^[A-Za-z0-9._-]+$')
+CASE_ID_SENTINEL = 'CASEIDSENTINEL0'
+
+# A function term map: the function, its parameters and the iri term type
+FUNCTION_BODY = (r'(?P<findent>[ ]*)- function: (?P<function>\S+)[ \t]*\n'
+                 r'[ ]*parameters:[ \t]*\n'
+                 r'(?P<parameters>(?:[ ]*- parameter: \S+[ \t]*\n[ ]*value: .*\n)+)'
+                 r'[ ]*type: iri[ \t]*(?:\n|$)')
+OBJECT_FUNCTION_PATTERN = re.compile(
+    r'^(?P<indent>[ ]*)- p: (?P<predicate>\S+)[ \t]*\n[ ]*o:[ \t]*\n' + FUNCTION_BODY, re.MULTILINE)
+SUBJECT_FUNCTION_PATTERN = re.compile(r'^(?P<indent>[ ]*)s:[ \t]*\n' + FUNCTION_BODY, re.MULTILINE)
+PARAMETER_PATTERN = re.compile(r'- parameter: (\S+)[ \t]*\n[ ]*value: (.*)\n')
+REFERENCE_PATTERN = re.compile(r'^\$\(([^()]+)\)$')
+# The predicate-object list of a mapping, up to the end of the mapping
+PREDICATE_OBJECTS_PATTERN = re.compile(r'^[ ]*po:[ \t]*\n(?P<entries>[\s\S]*)', re.MULTILINE)
+
+# Results of the folding of a function term map
+NEVER = 'never'
+KEEP = 'keep'
+
+loaded_udfs = {}
+
+
+def load_udfs(udf_path):
+    """
+    Executes the UDF file with a 'udf' decorator that only records each function with its parameters, so that the
+    functions can be evaluated outside morph_kgc.
+    Args:
+        udf_path (str): Path to the UDF file.
+    Returns:
+        dict: Maps each function IRI to the Python function and to the argument name of each parameter IRI.
+    """
+
+    udf_path = os.path.abspath(udf_path)
+    if udf_path in loaded_udfs:
+        return loaded_udfs[udf_path]
+
+    functions = {}
+
+    def udf(fun_id, **parameters):
+        def register(function):
+            functions[fun_id] = (function, {iri: name for name, iri in parameters.items()})
+            return function
+        return register
+
+    with open(udf_path, 'r', encoding='utf-8') as udf_file:
+        source = udf_file.read()
+    exec(compile(source, udf_path, 'exec'), {'udf': udf, '__name__': 'udf'})
+
+    loaded_udfs[udf_path] = functions
+    return functions
+
+
+def expand(term, prefix, namespace):
+    return namespace + term[len(prefix):] if term.startswith(prefix) else term
+
+
+def fold_call(function, arguments, references, data):
+    """
+    Evaluates a function on every distinct combination of its arguments in the rows that morph_kgc would pass to it,
+    and decides how the function term map can be written without the function.
+    Args:
+        function (callable): The Python function.
+        arguments (list): Argument name of each parameter.
+        references (list): Data column of each parameter.
+        data (pd.DataFrame): All the rows of the data source of the rule.
+    Returns:
+        str: NEVER if the function never produces a term, KEEP if its result depends on the row data in a way that
+        a template cannot express, or otherwise the constant IRI or the IRI template that replaces it.
+    """
+
+    # morph_kgc reads every value as a string
+    distinct_rows = data[list(dict.fromkeys(references))].drop_duplicates().fillna('').astype(str)
+    values = set()
+    has_missing = False
+    for row in distinct_rows.to_dict('records'):
+        row_values = tuple(row[reference] for reference in references)
+        if any(value in MISSING_VALUES for value in row_values):
+            has_missing = True
+        else:
+            values.add(row_values)
+
+    results = {}
+    for row_values in values:
+        result = function(**dict(zip(arguments, row_values)))
+        results[row_values] = result if result not in (None, '') else None
+
+    if all(result is None for result in results.values()):
+        return NEVER
+    # Without the function, rows with a missing argument would no longer be dropped
+    if has_missing or any(result is None for result in results.values()):
+        return KEEP
+
+    distinct_results = set(results.values())
+    if len(distinct_results) == 1 and SAFE_IRI_PATTERN.match(next(iter(distinct_results))):
+        return next(iter(distinct_results))
+
+    if 'case_id' not in references:
+        return KEEP
+    case_position = references.index('case_id')
+
+    # The result must be the same template filled with the case id for every row
+    templates = set()
+    for row_values, result in results.items():
+        case_id = row_values[case_position]
+        if not SAFE_CASE_ID_PATTERN.match(case_id):
+            return KEEP
+        sentinel_values = list(row_values)
+        sentinel_values[case_position] = CASE_ID_SENTINEL
+        sentinel_result = function(**dict(zip(arguments, sentinel_values)))
+        if not isinstance(sentinel_result, str) or sentinel_result.count(CASE_ID_SENTINEL) != 1:
+            return KEEP
+        if sentinel_result.replace(CASE_ID_SENTINEL, case_id) != result:
+            return KEEP
+        templates.add(sentinel_result)
+
+    if len(templates) != 1:
+        return KEEP
+    template = templates.pop()
+    if not SAFE_IRI_PATTERN.match(template):
+        return KEEP
+    return template.replace(CASE_ID_SENTINEL, '$(case_id)')
+
+
+def fold_match(match, functions, data):
+    """
+    Folds the function term map of a regular expression match, or returns KEEP if it is not a known function with
+    data references as parameters.
+    """
+
+    function_iri = expand(match.group('function'), FUNCTION_PREFIX, FUNCTION_NAMESPACE)
+    if function_iri not in functions:
+        return KEEP
+    function, argument_names = functions[function_iri]
+
+    arguments = []
+    references = []
+    for parameter, value in PARAMETER_PATTERN.findall(match.group('parameters')):
+        reference = REFERENCE_PATTERN.match(value.strip())
+        parameter_iri = expand(parameter, PARAMETER_PREFIX, PARAMETER_NAMESPACE)
+        if not reference or parameter_iri not in argument_names or reference.group(1) not in data.columns:
+            return KEEP
+        arguments.append(argument_names[parameter_iri])
+        references.append(reference.group(1))
+
+    try:
+        return fold_call(function, arguments, references, data)
+    except Exception:
+        return KEEP
+
+
+def fold_mapping(mapping, functions, data):
+    """
+    Evaluates at rule generation time the functions of a mapping whose result does not depend on the row data, and
+    replaces them by constant IRIs or IRI templates on the case id. Functions that never produce a term for the rows
+    are removed together with their predicate, or with the whole mapping if they build its subject. The rest are
+    kept, so the RDF is the same while morph_kgc makes fewer calls to Python functions per row.
+    Args:
+        mapping (str): YARRRML text of a single mapping.
+        functions (dict): The functions of the UDF file, as returned by load_udfs.
+        data (pd.DataFrame): All the rows of the data source of the mapping.
+    Returns:
+        str: The folded mapping, or an empty string if its subject or all of its objects are never generated.
+    """
+
+    subject = SUBJECT_FUNCTION_PATTERN.search(mapping)
+    if subject:
+        folded = fold_match(subject, functions, data)
+        if folded == NEVER:
+            return ''
+        if folded != KEEP:
+            mapping = mapping[:subject.start()] + f"{subject.group('indent')}s: {folded}\n" + mapping[subject.end():]
+
+    def fold_object(match):
+        folded = fold_match(match, functions, data)
+        if folded == NEVER:
+            return ''
+        if folded == KEEP:
+            return match.group(0)
+        return f"{match.group('indent')}- [{match.group('predicate')}, {folded}~iri]\n"
+
+    mapping = OBJECT_FUNCTION_PATTERN.sub(fold_object, mapping)
+
+    # morph_kgc fails on a mapping whose predicate-object list is empty, which generates nothing anyway
+    predicate_objects = PREDICATE_OBJECTS_PATTERN.search(mapping)
+    if predicate_objects and not any(line.strip().startswith('-')
+                                     for line in predicate_objects.group('entries').splitlines()):
+        return ''
+    return mapping